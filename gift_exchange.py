@@ -1,7 +1,26 @@
-from random import shuffle, random
-import copy
-import logging
-logging.basicConfig(level=logging.WARNING, encoding='utf-8')
+from random import shuffle, random, getrandbits, Random, seed
+from collections import deque
+from array import array
+import heapq
+import time
+# Importing the module has no side effects, and only imports what every 
+# call needs. The rest (asyncio, copy, inspect, json, logging, 
+# multiprocessing, threading, numpy, scipy) is imported where it's used.
+# What `from gift_exchange import *` gives, leaving out the imports above
+# and the helpers starting with _
+__all__ = [
+	'ValidationError', 'ResultError', 'SearchLimitError', 'weighted_shuffle',
+	'FeatureWeights', 'ReceiverOrders', 'ReceiverOrder',
+	'HistoryIndex', 'HistoryStore', 'HistoryArchive', 
+	'AttributeRestriction', 'RestrictionMatrix', 'SKIP_REASONS', 'LoggingTrace', 
+	'VALIDATE_MODES', 'ValidateParameters', 'SearchLimits', 'ExchangeStats', 
+	'ExchangeProblem', 'BacktrackEngine', 'ForwardCheckingEngine', 
+	'MaximumMatching', 'Precheck', 'ExplainNoResults', 'MatchingEngine', 
+	'OptimalEngine', 'ENGINES', 'TOPOLOGIES', 'SingleCycle', 'JoinCycles', 
+	'MixCycles', 'PreparedExchange', 'ExchangeResults', 'RelaxedResults', 
+	'GiftExchange', 'GiftExchangeBatch', 'GiftExchangeAsync', 'CompiledExchange', 
+	'CommandLine',
+	]
 ordinal = lambda n: '%d%s' % (n,'tsnrhtdd'[(n//10%10!=1)*(n%10<4)*n%10::4])
 
 class ValidationError(Exception):
@@ -9,22 +28,970 @@ class ValidationError(Exception):
 		self.message = message
 		super().__init__(self.message)
 
+# report = list of lines explaining why, when it's known
 class ResultError(Exception):
-	def __init__ (self):
-		self.message = 'Error: no assignment combinations found.'
+	def __init__ (self, message='Error: no assignment combinations found.', report=None):
+		self.summary = message
+		self.report = report or []
+		self.message = '\n'.join([message] + self.report)
 		super().__init__(self.message)
 
+	# keeps the report when sent between processes (GiftExchange's workers)
+	def __reduce__(self):
+		return (ResultError, (self.summary, self.report))
+
+# Raised when the search stops at one of its limits (GiftExchange's timeout
+# or maxAttempts), before finding out whether there's an assignment.
+# stats = progress when it stopped, see SearchLimits.stats
+class SearchLimitError(ResultError):
+	def __init__ (self, message='Error: search limit reached.', stats=None):
+		self.stats = stats or {}
+		super().__init__(message, [ f'{k}: {v}' for k, v in self.stats.items() ])
+
+	def __reduce__(self):
+		return (SearchLimitError, (self.summary, self.stats))
+
 # Reference:
 # http://utopia.duth.gr/~pefraimi/research/data/2007EncOfAlg.pdf
 # implementation speed: O(n log(n))
 def weighted_shuffle(items, weights):
-	# NOT reversing the sort to align with my definition of "heavier = more likely"
+	# NOT reversing the sort: smaller weights come first, matching 
+	# f_compatibility's "smaller = more likely" (weights of 0 or less first)
 	# This is because of the way that the formula calculates likelyhood.
 	#	Lower numbers are almost always at the forefront, 
 	# 	while things even out after that first quartile
 	order = sorted(range(len(items)), key=lambda i: random() ** (1.0 / weights[i]) if weights[i] > 0 else 0, reverse=False)
 	return [items[i] for i in order]
 
+# The gift_exchange logger (also gift_exchange.logger), importing logging
+# the first time it's needed
+def _logger():
+	import logging
+	return logging.getLogger(__name__)
+
+def __getattr__(name):
+	if name == 'logger':
+		return _logger()
+	raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+# NumPy is optional. Returns the numpy module, or None when it isn't installed
+def _numpy():
+	try:
+		import numpy
+	except ImportError:
+		return None
+	return numpy
+
+# Compatibility Weights -------------------------------------------------
+# Alternative to f_compatibility for large exchanges, giving the weights 
+# of every giver/receiver pair at once instead of calling a lambda n^2 times.
+# GiftExchange(compatibilityWeights=...) accepts either:
+#	- a grid of weights, weights[giver][receiver] (index in users), as a 
+#		NumPy array or a list of lists
+#	- FeatureWeights, working out the weights from one feature of each user
+class FeatureWeights():
+	# f_feature = lambda returning a number for a user (ex: lambda x: x.age)
+	# compare = how the giver's and receiver's features become a weight
+	#	'difference' = abs(giver - receiver)
+	#	'product'    = giver * receiver
+	#	'same'       = 1 when they're equal, otherwise 0
+	compares = ('difference', 'product', 'same')
+
+	def __init__ (self, f_feature, compare='difference'):
+		if not callable(f_feature):
+			raise ValidationError('Parameter, f_feature, must be a lambda function')
+		if compare not in self.compares:
+			raise ValidationError(f'Parameter, compare, must be one of: {", ".join(self.compares)}')
+		self.f_feature = f_feature
+		self.compare = compare
+
+	# Weights grid for the users, a NumPy array when NumPy is installed
+	def weights(self, users):
+		features = [ self.f_feature(x) for x in users ]
+		numpy = _numpy()
+		if numpy is not None:
+			features = numpy.asarray(features, dtype=float)
+			if self.compare == 'difference':
+				return numpy.abs(features[:, None] - features[None, :])
+			if self.compare == 'product':
+				return features[:, None] * features[None, :]
+			return (features[:, None] == features[None, :]).astype(float)
+		if self.compare == 'difference':
+			return [ [ abs(g - r) for r in features ] for g in features ]
+		if self.compare == 'product':
+			return [ [ g * r for r in features ] for g in features ]
+		return [ [ float(g == r) for r in features ] for g in features ]
+
+	# Lambda returning one giver's row of weights, without making the grid
+	#	features = each user's f_feature, worked out here when None
+	def rows(self, users, features=None):
+		if features is None:
+			features = [ self.f_feature(x) for x in users ]
+		numpy = _numpy()
+		if numpy is not None:
+			features = numpy.asarray(features, dtype=float)
+		if self.compare == 'difference':
+			if numpy is not None:
+				return lambda giver: numpy.abs(features - features[giver])
+			return lambda giver: [ abs(features[giver] - r) for r in features ]
+		if self.compare == 'product':
+			if numpy is not None:
+				return lambda giver: features * features[giver]
+			return lambda giver: [ features[giver] * r for r in features ]
+		if numpy is not None:
+			return lambda giver: (features == features[giver]).astype(float)
+		return lambda giver: [ float(features[giver] == r) for r in features ]
+
+	# Lambda returning the weight of one giver/receiver pair
+	def pairs(self, users, features=None):
+		if features is None:
+			features = [ self.f_feature(x) for x in users ]
+		if self.compare == 'difference':
+			return lambda giver, receiver: abs(features[giver] - features[receiver])
+		if self.compare == 'product':
+			return lambda giver, receiver: features[giver] * features[receiver]
+		return lambda giver, receiver: float(features[giver] == features[receiver])
+
+# Receiver Orders -------------------------------------------------------
+# Each giver's randomized order of receivers, drawn as the search asks for
+# them instead of shuffling a full list for every giver up front. Most
+# givers settle on one of their first few receivers, so memory stays close
+# to the number of users instead of users x users.
+#	receivers_byGiver[giver][k] = k-th receiver in the giver's order
+# The order is the same as weighted_shuffle (or a plain shuffle without 
+# weights). Each giver has its own seed, so drawing more receivers 
+# re-creates the same keys and takes the next ones in line, 
+# O(users) time and memory while drawing, nothing kept afterwards.
+# Without weights the first headCount receivers take O(headCount), so an
+# exchange where most givers take one of their first few isn't O(users^2).
+#	f_weightsRow = lambda returning a giver's weights, weights[receiver],
+#		None for a plain shuffle
+#	stats = ExchangeStats timing the draws ('shuffle') and f_weightsRow
+#		('weights'), None to not time them
+class ReceiverOrders():
+	# NumPy is used to draw when installed, for exchanges of at least this
+	# many users. It's slower to set up than it's worth for small ones.
+	numpyMinUsers = 64
+	# Receivers drawn one at a time, without weights, before drawing the
+	# rest in O(users)
+	headCount = 16
+
+	def __init__ (self, userCount, f_weightsRow=None, stats=None):
+		self.userCount = userCount
+		self.f_weightsRow = f_weightsRow
+		self.stats = stats
+		self.seed = getrandbits(64)
+		self.orders = [None] * userCount
+
+	def __len__ (self):
+		return self.userCount
+
+	def __getitem__ (self, giver):
+		order = self.orders[giver]
+		if order is None:
+			order = self.orders[giver] = ReceiverOrder(self, giver)
+		return order
+
+	# Receivers ranked start to stop (not included) in the giver's order,
+	# as an array('i')
+	def draw(self, giver, start, stop):
+		if self.stats is None:
+			return self._draw(giver, start, stop)
+		previous = self.stats.switch('shuffle')
+		try:
+			return self._draw(giver, start, stop)
+		finally:
+			self.stats.switch(previous)
+
+	def _draw(self, giver, start, stop):
+		receivers = array('i')
+		numpy = _numpy() if self.userCount >= self.numpyMinUsers else None
+		seed = self.seed + giver
+		row = None
+		if self.f_weightsRow:
+			if self.stats:
+				self.stats.switch('weights')
+			row = self.f_weightsRow(giver)
+			if self.stats:
+				self.stats.switch('shuffle')
+
+		# Without weights, the first few receivers are a lazy Fisher-Yates 
+		# shuffle, only O(receivers drawn), and the rest (after headCount) 
+		# are drawn like weighted ones, all with the same weight
+		head = []
+		generator = Random(seed)
+		if row is None:
+			head = self._shuffledHead(generator, min(stop, self.headCount))
+			if stop <= len(head):
+				receivers.fromlist(head[start:stop])
+				return receivers
+		count = stop - len(head)
+
+		if numpy is not None:
+			keys = numpy.random.default_rng(seed).random(self.userCount)
+			if row is not None:
+				weights = numpy.asarray(row, dtype=float)
+				positive = weights > 0
+				# random() ** (1 / weight), or 0 when the weight isn't positive
+				with numpy.errstate(divide='ignore'):
+					exponents = 1.0 / weights
+				keys = numpy.power(keys, exponents, out=numpy.zeros(self.userCount), where=positive)
+			keys[head] = numpy.inf
+			# ties (keys of 0, from weights of 0) stay in user order and come
+			# first, same as weighted_shuffle. The rest are sorted by key.
+			zeros = numpy.flatnonzero(keys == 0)
+			if len(zeros) >= count:
+				ranked = zeros[:count]
+			else:
+				if count < self.userCount:
+					candidates = numpy.argpartition(keys, count - 1)[:count]
+					candidates = candidates[keys[candidates] > 0]
+				else:
+					candidates = numpy.flatnonzero(keys > 0)
+				ranked = numpy.concatenate((zeros, candidates[numpy.argsort(keys[candidates])]))
+			receivers.fromlist(head)
+			receivers.frombytes(ranked[:count].astype(numpy.intc).tobytes())
+			return receivers[start:]
+
+		if row is None:
+			keys = [ generator.random() for _ in range(self.userCount) ]
+		else:
+			keys = [ generator.random() ** (1.0 / w) if w > 0 else 0 for w in row ]
+		for r in head:
+			keys[r] = float('inf')
+		receivers.fromlist(head)
+		receivers.fromlist(heapq.nsmallest(count, range(self.userCount), key=keys.__getitem__))
+		return receivers[start:]
+
+	# First count receivers of a uniform random order, drawing each one 
+	# from those not drawn yet (Fisher-Yates, with only the swaps kept)
+	def _shuffledHead(self, generator, count):
+		userCount = self.userCount
+		swapped = {}
+		head = []
+		for k in range(count):
+			j = k + int(generator.random() * (userCount - k))
+			head.append(swapped.get(j, j))
+			swapped[j] = swapped.get(k, k)
+		return head
+
+# One giver's order from ReceiverOrders, drawing more receivers when an
+# index past the ones drawn so far is asked for
+class ReceiverOrder():
+	# one for every giver that's drawn from, so without a __dict__ each
+	__slots__ = ('orders', 'giver', 'drawn')
+
+	def __init__ (self, orders, giver):
+		self.orders = orders
+		self.giver = giver
+		self.drawn = array('i')
+
+	def __len__ (self):
+		return self.orders.userCount
+
+	def __getitem__ (self, k):
+		userCount = self.orders.userCount
+		if isinstance(k, slice):
+			start, stop, step = k.indices(userCount)
+			self.drawUpTo(stop if step > 0 else userCount)
+			return self.drawn[k].tolist()
+		if k < 0:
+			k += userCount
+		if k >= len(self.drawn):
+			if not 0 <= k < userCount:
+				raise IndexError('receiver order index out of range')
+			self.drawUpTo(min(userCount, max(k + 1, 2 * len(self.drawn), 8)))
+		return self.drawn[k]
+
+	def __iter__ (self):
+		for k in range(self.orders.userCount):
+			yield self[k]
+
+	# The first draw takes at least headCount receivers. Every draw after
+	# that costs O(users) however few receivers it takes, so it draws well
+	# ahead (8x as many).
+	def drawUpTo(self, stop):
+		drawn = len(self.drawn)
+		if stop > drawn:
+			stop = min(self.orders.userCount, max(stop, 8 * drawn, self.orders.headCount))
+			self.drawn.extend(self.orders.draw(self.giver, drawn, stop))
+
+# History Index ---------------------------------------------------------
+# Groups the history parameter by giver, built once so each user's recent
+# recipients can be looked up without scanning every exchange.
+# Reusable: pass the same HistoryIndex as the history parameter to several
+# GiftExchange calls. Build a new one after the history list changes.
+#	byGiver
+#		key = uniqueID of a "giver" user
+#		value = list of (position of exchange in history, uniqueID of receiver)
+#			most recent first, same order as history
+class HistoryIndex():
+	def __init__ (self, history):
+		self.history = history
+		self.byGiver = {}
+		for i_hist, historicExchange in enumerate(history):
+			for giverID, recipientID in historicExchange.items():
+				self.byGiver.setdefault(giverID, []).append((i_hist, recipientID))
+
+	# Returns list of (position of exchange in history, uniqueID of receiver)
+	# for the exchanges within the historyLimit of the given user.
+	#	history_ParticipationRequired == TRUE 
+	#		the user's last X exchanges they participated in
+	#	history_ParticipationRequired == FALSE 
+	#		the last X exchanges, whether the user participated or not
+	def recentRecipients(self, userID, historyLimit, history_ParticipationRequired):
+		entries = self.byGiver.get(userID, [])
+		if history_ParticipationRequired:
+			return entries[:historyLimit]
+		recent = []
+		for i_hist, recipientID in entries:
+			if i_hist >= historyLimit:
+				break
+			recent.append((i_hist, recipientID))
+		return recent
+
+# Each user's recent recipients from a history list, the same as 
+# HistoryIndex.recentRecipients gives them, without indexing all of it.
+# The exchanges are gone through from the most recent, stopping once every
+# user has historyLimit of them (or, without history_ParticipationRequired,
+# after historyLimit exchanges), so a long history costs no more than the
+# part that's needed.
+#	returns windows[i] = recent recipients of userIDs[i]
+def _recentInList(history, userIDs, historyLimit, history_ParticipationRequired):
+	windows = [ [] for _ in userIDs ]
+	needing = list(range(len(userIDs)))
+	for i_hist, historicExchange in enumerate(history):
+		if not needing or (not history_ParticipationRequired and i_hist >= historyLimit):
+			break
+		stillNeeding = []
+		for i_user in needing:
+			userID = userIDs[i_user]
+			if userID in historicExchange:
+				windows[i_user].append((i_hist, historicExchange[userID]))
+			if len(windows[i_user]) < historyLimit:
+				stillNeeding.append(i_user)
+		needing = stillNeeding
+	return windows
+
+# History Store ---------------------------------------------------------
+# Keeps only what GiftExchange needs from history: for every user, their
+# last historyLimit exchanges as a giver. Pass it as the history parameter
+# in place of a list, and add each accepted result to it.
+#	- adding a result only touches the users in that result
+#	- looking up a user's history doesn't depend on how many exchanges 
+#		have happened in total
+#	- can be saved to, and loaded from, a file
+#	windows
+#		key = uniqueID of a "giver" user
+#		value = deque of (exchange number, uniqueID of receiver), oldest first
+#			exchange number counts up from 0 as results are added
+class HistoryStore():
+	def __init__ (self, historyLimit):
+		if not isinstance(historyLimit, int) or historyLimit < 0:
+			raise ValidationError('Parameter, historyLimit, must be a positive Integer')
+		self.historyLimit = historyLimit
+		self.exchangeCount = 0
+		self.windows = {}
+
+	# Builds a store from a history list (most recent exchange first)
+	@classmethod
+	def fromHistory(cls, history, historyLimit):
+		store = cls(historyLimit)
+		for historicExchange in reversed(history):
+			store.addExchange(historicExchange)
+		return store
+
+	# Adds an accepted exchange, same format as the results of GiftExchange
+	def addExchange(self, results):
+		exchangeNumber = self.exchangeCount
+		for giverID, recipientID in results.items():
+			window = self.windows.get(giverID)
+			if window is None:
+				window = self.windows[giverID] = deque(maxlen=self.historyLimit)
+			window.append((exchangeNumber, recipientID))
+		self.exchangeCount += 1
+
+	# Same as HistoryIndex.recentRecipients, position 0 = most recent exchange
+	def recentRecipients(self, userID, historyLimit, history_ParticipationRequired):
+		recent = []
+		for exchangeNumber, recipientID in reversed(self.windows.get(userID, ())):
+			position = self.exchangeCount - 1 - exchangeNumber
+			if len(recent) >= historyLimit:
+				break
+			if not history_ParticipationRequired and position >= historyLimit:
+				break
+			recent.append((position, recipientID))
+		return recent
+
+	# File format, JSON:
+	#	historyLimit, exchangeCount
+	#	ids = every uniqueID in the store, listed once
+	#	windows = for each giver: [index of giver in ids, 
+	#		exchange number, index of receiver in ids, exchange number, ...]
+	# uniqueIDs must be JSON friendly (numbers, strings)
+	def save(self, path):
+		idIndexes = {}
+		def idIndex(userID):
+			if userID not in idIndexes:
+				idIndexes[userID] = len(idIndexes)
+			return idIndexes[userID]
+
+		windows = []
+		for giverID, window in self.windows.items():
+			row = [idIndex(giverID)]
+			for exchangeNumber, recipientID in window:
+				row += [exchangeNumber, idIndex(recipientID)]
+			windows.append(row)
+		data = {
+			'historyLimit': self.historyLimit,
+			'exchangeCount': self.exchangeCount,
+			'ids': list(idIndexes),
+			'windows': windows,
+			}
+		import json
+		with open(path, 'w', encoding='utf-8') as file:
+			json.dump(data, file, separators=(',', ':'))
+
+	@classmethod
+	def load(cls, path):
+		import json
+		with open(path, 'r', encoding='utf-8') as file:
+			data = json.load(file)
+		store = cls(data['historyLimit'])
+		store.exchangeCount = data['exchangeCount']
+		ids = data['ids']
+		for row in data['windows']:
+			window = deque(maxlen=store.historyLimit)
+			for i in range(1, len(row), 2):
+				window.append((row[i], ids[row[i + 1]]))
+			store.windows[ids[row[0]]] = window
+		return store
+
+# History Archive -------------------------------------------------------
+# Every exchange ever added, kept in files instead of memory, for 
+# communities with years of exchanges. Pass it as the history parameter in
+# place of a list, and add each accepted result to it. Files in the folder
+# at path (made when it doesn't exist):
+#	records.bin = one record per assignment, in the order added: giver and
+#		receiver (index in ids), exchange number (from 0), and the record 
+#		of the giver's assignment before it (-1 for none), 4 int32s
+#	ids.jsonl = every uniqueID, one per line, in the order first added
+#	index.bin = _MAGIC, then the number of exchanges, records and ids, 
+#		then the last record of each id as a giver (-1 for none), int64s
+# records.bin and index.bin are read through mmap, so looking up a giver's
+# recent recipients only reads their last few records (each one leading 
+# to the one before), not the whole history. Only ids.jsonl is loaded.
+#	- adding an exchange appends its records and ids, then writes a new 
+#		index in place of the old one, O(users). Anything a crash leaves
+#		past what the index counts is ignored, and written over next time.
+#	- numbers are in the byte order of the machine that made the files
+#	- uniqueIDs must be numbers or strings
+#	- one process may add exchanges at a time. Others see them once they
+#		open the archive again.
+class HistoryArchive():
+	_MAGIC = 0x3156484354584647 # also tells apart the byte order
+	_RECORD = 4 # int32s per record
+	_HEADER = 4 # int64s before the last records
+
+	def __init__ (self, path):
+		import os
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+		if not os.path.exists(self._file('index.bin')):
+			for name in ('records.bin', 'ids.jsonl'):
+				open(self._file(name), 'ab').close()
+			with open(self._file('index.bin'), 'wb') as file:
+				array('q', [self._MAGIC, 0, 0, 0]).tofile(file)
+		# ids[i] = uniqueID, idIndexes = the reverse
+		self.ids = []
+		self.idIndexes = {}
+		# bytes of ids.jsonl read so far
+		self.idsSize = 0
+		self._maps = []
+		self.index = self.records = None
+		self._open()
+
+	# Builds an archive from a history list (most recent exchange first)
+	@classmethod
+	def fromHistory(cls, path, history):
+		archive = cls(path)
+		archive.addExchanges(list(reversed(history)))
+		return archive
+
+	def _file(self, name):
+		import os
+		return os.path.join(self.path, name)
+
+	# Maps the files, and reads the ids added since the last time
+	def _open(self):
+		import json
+		self.index = self._map('index.bin', 'q')
+		if len(self.index) < self._HEADER or self.index[0] != self._MAGIC:
+			self.close()
+			raise ValidationError(f'{self.path} isn\'t a HistoryArchive (or was made on a '
+				+ 'machine with a different byte order)')
+		self.exchangeCount, self.recordCount, idCount = self.index[1:self._HEADER]
+		self.records = self._map('records.bin', 'i')
+		with open(self._file('ids.jsonl'), 'rb') as file:
+			file.seek(self.idsSize)
+			while len(self.ids) < idCount:
+				userID = json.loads(file.readline())
+				self.idIndexes[userID] = len(self.ids)
+				self.ids.append(userID)
+			self.idsSize = file.tell()
+
+	def _map(self, name, typecode):
+		import mmap
+		with open(self._file(name), 'rb') as file:
+			file.seek(0, 2)
+			if file.tell() == 0: # empty files can't be mapped
+				return memoryview(b'').cast(typecode)
+			mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		self._maps.append(mapped)
+		# up to a whole number of items (a crash may leave part of a record)
+		view = memoryview(mapped)
+		size = len(view) - len(view) % array(typecode).itemsize
+		return view[:size].cast(typecode)
+
+	def close(self):
+		for view in (self.index, self.records):
+			if view is not None:
+				view.release()
+		self.index = self.records = None
+		for mapped in self._maps:
+			mapped.close()
+		self._maps = []
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *exception):
+		self.close()
+
+	# Same as HistoryIndex.recentRecipients, position 0 = most recent exchange
+	def recentRecipients(self, userID, historyLimit, history_ParticipationRequired):
+		recent = []
+		giver = self.idIndexes.get(userID)
+		if giver is None:
+			return recent
+		records = self.records
+		record = self.index[self._HEADER + giver]
+		while record >= 0 and len(recent) < historyLimit:
+			i = record * self._RECORD
+			position = self.exchangeCount - 1 - records[i + 2]
+			if not history_ParticipationRequired and position >= historyLimit:
+				break
+			recent.append((position, self.ids[records[i + 1]]))
+			record = records[i + 3]
+		return recent
+
+	# Adds an accepted exchange, same format as the results of GiftExchange
+	def addExchange(self, results):
+		self.addExchanges([results])
+
+	# Adds the exchanges, oldest first, writing the index once
+	def addExchanges(self, exchanges):
+		import json
+		import os
+		# new IDs are checked before anything changes
+		newIDs = {}
+		for results in exchanges:
+			for pair in results.items():
+				for userID in pair:
+					if userID not in self.idIndexes and userID not in newIDs:
+						line = json.dumps(userID)
+						if isinstance(userID, bool) or json.loads(line) != userID:
+							raise ValidationError('The uniqueIDs of a HistoryArchive must be '
+								+ f'numbers or strings, not {userID!r}')
+						newIDs[userID] = line
+
+		last = array('q', self.index[self._HEADER:self._HEADER + len(self.ids)])
+		for userID in newIDs:
+			self.idIndexes[userID] = len(self.ids)
+			self.ids.append(userID)
+			last.append(-1)
+		records = array('i')
+		recordCount = self.recordCount
+		exchangeCount = self.exchangeCount
+		for results in exchanges:
+			for giverID, receiverID in results.items():
+				giver = self.idIndexes[giverID]
+				records.extend((giver, self.idIndexes[receiverID], exchangeCount, last[giver]))
+				last[giver] = recordCount
+				recordCount += 1
+			exchangeCount += 1
+
+		self.close()
+		try:
+			with open(self._file('records.bin'), 'r+b') as file:
+				file.truncate(self.recordCount * self._RECORD * records.itemsize)
+				file.seek(0, 2)
+				records.tofile(file)
+			with open(self._file('ids.jsonl'), 'r+b') as file:
+				file.truncate(self.idsSize)
+				file.seek(0, 2)
+				file.write(''.join(x + '\n' for x in newIDs.values()).encode('utf-8'))
+				self.idsSize = file.tell()
+			with open(self._file('index.new'), 'wb') as file:
+				array('q', [self._MAGIC, exchangeCount, recordCount, len(self.ids)]).tofile(file)
+				last.tofile(file)
+				file.flush()
+				os.fsync(file.fileno())
+			os.replace(self._file('index.new'), self._file('index.bin'))
+		finally:
+			self._open()
+
+# Restriction Rules -----------------------------------------------------
+# Alternative to f_restriction that doesn't need a lambda called for every
+# pair of users: users are grouped by one attribute, once, and restricted
+# by group. Used with GiftExchange(restrictionRules=[...]).
+#	f_attribute = lambda returning the attribute of a user (ex: lambda x: x.team)
+#	same = True, restricts users with the same value from each other
+#		   False, restricts users with different values from each other
+#	name = used to drop the rule when relaxing (see GiftExchange's relaxOrder)
+class AttributeRestriction():
+	def __init__ (self, f_attribute, same=True, name=None):
+		if not callable(f_attribute):
+			raise ValidationError('Parameter, f_attribute, must be a lambda function')
+		self.f_attribute = f_attribute
+		self.same = same
+		self.name = name
+
+# Rule Providers --------------------------------------------------------
+# Alternative to f_restriction and f_compatibility for rules kept in a 
+# database or a dataframe, answering for many pairs of users with one call
+# instead of one call per pair. GiftExchange(ruleProvider=...) takes any 
+# object with one or both of these methods:
+#	restrictionsFor(givers) = iterable of the (giverID, receiverID) pairs
+#		(uniqueIDs) the givers (users) are restricted from. Called once 
+#		with every user, pairs of IDs that aren't users are left out.
+#	weightsRow(giver) = sequence of the giver's weights (see 
+#		f_compatibility), one per user in the same order as users. Called
+#		when the search first needs the giver's receivers.
+# Example, with a dataframe of who can't give to who:
+#	class Rules():
+#		def restrictionsFor(self, givers):
+#			return blocked[['giver', 'receiver']].itertuples(index=False)
+# restrictionsFor works alongside f_restriction and restrictionRules, and 
+# is dropped by the name 'ruleProvider' when relaxing (see relaxOrder). 
+# weightsRow takes the place of f_compatibility or compatibilityWeights.
+
+# Restriction Matrix ----------------------------------------------------
+# Which receivers each giver is restricted from, one bit per receiver 
+# (packed 8 to a byte), so checking a pair is O(1) during the search.
+#	- restrictionRules are compiled up front. Givers with the same 
+#		attribute values share the same row of bits.
+#	- f_restriction results are saved the first time a pair is checked,
+#		so the lambda is never called twice for the same pair. A giver's
+#		results are kept in a dictionary until there are more than 
+#		sparseLimit, then as bits, so a big exchange where each giver only
+#		checks a few receivers isn't O(users^2) memory.
+#	- pairs listed by a ruleProvider (see Rule Providers) are kept as each
+#		giver's receivers, the same way as giverHistory
+class RestrictionMatrix():
+	def __init__ (self, users, f_restriction=None, restrictionRules=(), listedPairs=None):
+		self.users = users
+		self.f_restriction = f_restriction
+		# listed[giver] = receivers listed for them (see _historySet), None
+		# without listedPairs
+		self.listed = None
+		if listedPairs is not None:
+			self.listPairs(listedPairs)
+		self.byteCount = (len(users) + 7) // 8
+		self.sparseLimit = max(8, self.byteCount // 32)
+		# ruleRows[giver] = bits restricted by restrictionRules, None if none
+		self.ruleRows = [None] * len(users)
+		# f_restriction results, None until the giver checks one:
+		#	checked = { receiver: restricted }, restricted = None
+		#	or as bits, checked = pair has been worked out,
+		#	restricted = f_restriction returned True
+		self.checked = [None] * len(users)
+		self.restricted = [None] * len(users)
+
+		# compiledRules = (rule, each user's value, bits of the users holding
+		# each value) for every rule. Kept so rules can be dropped, see without
+		self.compiledRules = []
+		for rule in restrictionRules:
+			values = [ rule.f_attribute(x) for x in users ]
+			self.compiledRules.append((rule, values, self._valueRows(values)))
+		self._combineRules()
+
+	# bits of the users holding each value
+	def _valueRows(self, values):
+		rows = {}
+		for i_user, value in enumerate(values):
+			if value not in rows:
+				rows[value] = bytearray(self.byteCount)
+			rows[value][i_user >> 3] |= 1 << (i_user & 7)
+		return rows
+
+	def _combineRules(self):
+		self.ruleRows = [None] * len(self.users)
+		# sharedRows[key] = the row of givers with those values (key = 
+		# their value for each rule), ruleKeys[giver] = their key
+		self.sharedRows = {}
+		self.ruleKeys = []
+		if not self.compiledRules:
+			return
+		for i_user in range(len(self.users)):
+			key = tuple(values[i_user] for rule, values, rows in self.compiledRules)
+			if key not in self.sharedRows:
+				self.sharedRows[key] = self._combinedRow(key)
+			self.ruleKeys.append(key)
+			row = self.sharedRows[key]
+			self.ruleRows[i_user] = row if any(row) else None
+
+	def _combinedRow(self, key):
+		everyone = bytes([0xFF]) * self.byteCount
+		row = bytearray(self.byteCount)
+		for (rule, values, rows), value in zip(self.compiledRules, key):
+			ruleRow = rows[value] if rule.same else _invertBits(rows[value], everyone)
+			row = bytearray(a | b for a, b in zip(row, ruleRow))
+		return row
+
+	# Restricts the (giver, receiver) pairs (index in users), in place of
+	# the pairs listed before
+	def listPairs(self, pairs):
+		byGiver = {}
+		for giver, receiver in pairs:
+			byGiver.setdefault(giver, []).append(receiver)
+		self.listed = [_NO_HISTORY] * len(self.users)
+		for giver, receivers in byGiver.items():
+			self.listed[giver] = _historySet(receivers)
+
+	# Copy without the restrictionRules given, without f_restriction when
+	# dropFunction, and without the listed pairs when dropListed. Nothing 
+	# is worked out again: the attribute values and f_restriction results
+	# already found are shared.
+	def without(self, restrictionRules=(), dropFunction=False, dropListed=False):
+		import copy
+		matrix = copy.copy(self)
+		matrix.compiledRules = [ x for x in self.compiledRules if x[0] not in restrictionRules ]
+		if dropFunction:
+			matrix.f_restriction = None
+		if dropListed:
+			matrix.listed = None
+		matrix._combineRules()
+		return matrix
+
+	# The same restrictions for only the users at the indexes given (user i
+	# of the new matrix = indexes[i]). The attribute values already worked
+	# out are reused, f_restriction results aren't.
+	def subset(self, indexes):
+		listedPairs = None
+		if self.listed is not None:
+			local = dict((g, i) for i, g in enumerate(indexes))
+			listedPairs = [ (i, local[r]) for i, g in enumerate(indexes) 
+				for r in self.listed[g] if r in local ]
+		matrix = RestrictionMatrix([ self.users[i] for i in indexes ], self.f_restriction,
+			listedPairs=listedPairs)
+		for rule, values, rows in self.compiledRules:
+			values = [ values[i] for i in indexes ]
+			matrix.compiledRules.append((rule, values, matrix._valueRows(values)))
+		matrix._combineRules()
+		return matrix
+
+	# Adds the last of users, working out only their row and their bit in
+	# every other row. See CompiledExchange.
+	def addUser(self):
+		i_user = len(self.users) - 1
+		user = self.users[i_user]
+		if i_user >> 3 == self.byteCount:
+			self.byteCount += 1
+			self.sparseLimit = max(8, self.byteCount // 32)
+			for row in self._allRows():
+				row.append(0)
+		self.checked.append(None)
+		self.restricted.append(None)
+		if self.listed is not None:
+			self.listed.append(_NO_HISTORY)
+		if not self.compiledRules:
+			self.ruleRows.append(None)
+			return
+
+		key = []
+		for rule, values, rows in self.compiledRules:
+			value = rule.f_attribute(user)
+			values.append(value)
+			if value not in rows:
+				rows[value] = bytearray(self.byteCount)
+			_setBit(rows[value], i_user, True)
+			key.append(value)
+		key = tuple(key)
+		# the new user's bit in the rows already made
+		for sharedKey, row in self.sharedRows.items():
+			restricted = any((value == sharedValue) == rule.same
+				for (rule, values, rows), value, sharedValue in zip(self.compiledRules, key, sharedKey))
+			if restricted and not any(row):
+				# was empty, so the givers with it have None
+				for i_giver, giverKey in enumerate(self.ruleKeys):
+					if giverKey == sharedKey:
+						self.ruleRows[i_giver] = row
+			_setBit(row, i_user, restricted)
+		if key not in self.sharedRows:
+			self.sharedRows[key] = self._combinedRow(key)
+		self.ruleKeys.append(key)
+		row = self.sharedRows[key]
+		self.ruleRows.append(row if any(row) else None)
+
+	# Removes the user at i_user, with the last user moving into their
+	# place (users must already be changed). See CompiledExchange.
+	def removeUser(self, i_user):
+		i_last = len(self.users)
+		for rows in (self.ruleRows, self.checked, self.restricted, self.ruleKeys):
+			if rows:
+				rows[i_user] = rows[i_last]
+				rows.pop()
+		for rule, values, rows in self.compiledRules:
+			values[i_user] = values[i_last]
+			values.pop()
+		for row in self._allRows():
+			_moveBit(row, i_last, i_user)
+		for checked in self.checked:
+			if checked.__class__ is dict:
+				checked.pop(i_user, None)
+				if i_last in checked:
+					checked[i_user] = checked.pop(i_last)
+		if self.listed is not None:
+			moved = lambda i: i_user if i == i_last else i
+			self.listed[i_user] = self.listed[i_last]
+			self.listed.pop()
+			self.listPairs([ (giver, moved(r)) for giver, receivers in enumerate(self.listed)
+				for r in receivers if r != i_user ])
+
+	def _allRows(self):
+		rows = [ row for rule, values, valueRows in self.compiledRules for row in valueRows.values() ]
+		rows += self.sharedRows.values()
+		for checked, restricted in zip(self.checked, self.restricted):
+			if checked is not None and checked.__class__ is not dict:
+				rows += (checked, restricted)
+		return rows
+
+	def isRestricted(self, giver, receiver):
+		i_byte = receiver >> 3
+		bit = 1 << (receiver & 7)
+		row = self.ruleRows[giver]
+		if row is not None and row[i_byte] & bit:
+			return True
+		if self.listed is not None and receiver in self.listed[giver]:
+			return True
+		if self.f_restriction is None:
+			return False
+		checked = self.checked[giver]
+		if checked is None:
+			checked = self.checked[giver] = {}
+		if checked.__class__ is dict:
+			restricted = checked.get(receiver)
+			if restricted is None:
+				restricted = checked[receiver] = bool(
+					self.f_restriction(self.users[giver], self.users[receiver]))
+				if len(checked) > self.sparseLimit:
+					self._toBits(giver)
+			return restricted
+		if checked[i_byte] & bit:
+			return bool(self.restricted[giver][i_byte] & bit)
+		checked[i_byte] |= bit
+		if self.f_restriction(self.users[giver], self.users[receiver]):
+			self.restricted[giver][i_byte] |= bit
+			return True
+		return False
+
+	# Moves a giver's f_restriction results from the dictionary to bits
+	def _toBits(self, giver):
+		checked = bytearray(self.byteCount)
+		restricted = bytearray(self.byteCount)
+		for receiver, isRestricted in self.checked[giver].items():
+			_setBit(checked, receiver, True)
+			_setBit(restricted, receiver, isRestricted)
+		self.checked[giver] = checked
+		self.restricted[giver] = restricted
+
+	# The receivers the giver isn't restricted from, in the same order.
+	# Long lists are checked against the row unpacked to a byte per receiver.
+	def unrestricted(self, giver, receivers):
+		row = self.ruleRows[giver]
+		if row is not None and len(receivers) > len(row):
+			flags = b''.join(map(_UNPACKED_BITS.__getitem__, row))
+			receivers = [ r for r in receivers if not flags[r] ]
+		elif row is not None:
+			receivers = [ r for r in receivers if not row[r >> 3] & (1 << (r & 7)) ]
+		if self.listed is not None and self.listed[giver]:
+			listed = self.listed[giver]
+			receivers = [ r for r in receivers if r not in listed ]
+		if self.f_restriction is not None:
+			receivers = [ r for r in receivers if not self.isRestricted(giver, r) ]
+		return receivers
+
+def _invertBits(row, everyone):
+	return bytes(a ^ b for a, b in zip(row, everyone))
+
+def _setBit(row, i, value):
+	if value:
+		row[i >> 3] |= 1 << (i & 7)
+	else:
+		row[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+# bit source moves to target, leaving source clear (cleared if the same)
+def _moveBit(row, source, target):
+	value = source != target and row[source >> 3] & (1 << (source & 7))
+	_setBit(row, source, False)
+	_setBit(row, target, value)
+
+# _UNPACKED_BITS[byte] = its 8 bits, one byte each (lowest bit first)
+_UNPACKED_BITS = [ bytes((byte >> i) & 1 for i in range(8)) for byte in range(256) ]
+
+# Tracing -------------------------------------------------------------
+# GiftExchange(trace=...) calls trace(event, details) as the search runs.
+# Nothing is built for tracing unless a trace callback is provided.
+#	event = name of what happened, one of:
+#		'history'         - a giver's prior recipient was read from history
+#		'giver_order'     - the randomized order givers are assigned in
+#		'receiver_orders' - each giver's randomized list of receivers
+#		'attempt'         - a giver is trying a receiver
+#		'skip'            - the receiver was rejected, see details['reason']
+#							'taken', 'closed_loop', 'self', 'history', 'restriction'
+#							'dead_end' = leaves another giver with no receivers 
+#							('forward' engine)
+#		'assign'          - the giver was assigned the receiver
+#		'backtrack'       - the giver ran out of receivers, stepping back
+#							details['jump_to'] = position jumped back to ('forward' engine)
+#		'relax'           - no assignments were found, so a rule was relaxed
+#							details = {'historyLimit': new limit} or {'dropped': rule name}
+#		'result'          - the final assignments (user indexes)
+#	details = dictionary of user indexes describing the event
+# Example, collecting every event into a list:
+#	events = []
+#	GiftExchange(users, trace=lambda event, details: events.append((event, details)))
+SKIP_REASONS = ('taken', 'closed_loop', 'self', 'history', 'restriction', 'dead_end')
+
+def LoggingTrace(event, details):
+	logger = _logger()
+	if not logger.isEnabledFor(20): # logging.INFO
+		return
+	if event in ('attempt', 'skip', 'assign', 'backtrack'):
+		prefix = f' {ordinal(details["position"] + 1)} G'
+	if event == 'history':
+		logger.info(f' -- Exchange [{details["exchange"]}] : giver {details["giver"]}'
+			+ f' gave to {details["recipient"]}')
+	elif event == 'giver_order':
+		logger.info(f' ----- GIVER ORDER: {details["givers"]}')
+	elif event == 'receiver_orders':
+		logger.info(f' ----- RECEIVER ORDERS: {details["receivers_byGiver"]}')
+	elif event == 'attempt':
+		logger.info(f'{prefix}:{ordinal(details["attempt"] + 1)} R - Attempting'
+			+ f' g{details["giver"]}:r{details["receiver"]}')
+	elif event == 'skip':
+		logger.info(f'{prefix} - SKIPPING Receiver index {details["receiver"]}'
+			+ f' - {details["reason"]}')
+	elif event == 'assign':
+		logger.info(f'{prefix} - ASSIGNING Receiver g{details["giver"]}:r{details["receiver"]}')
+	elif event == 'backtrack':
+		logger.info(f'{prefix} - Giving up on Giver {details["giver"]}')
+	elif event == 'result':
+		logger.info(f' Final Results (user indexes) - {details["assignedUsers"]}')
+
+VALIDATE_MODES = ('full', 'fast', 'off')
+
 # Validate the paramters of the gift_exchange function are in working order
 def ValidateParameters(
 		users, 
@@ -36,11 +1003,38 @@ def ValidateParameters(
 		f_restriction,
 		minUsers,
 		maxUsers,
+		trace=None,
+		engine='backtrack',
+		precheck=False,
+		compatibilityWeights=None,
+		restrictionRules=[],
+		workers=1,
+		timeout=None,
+		maxAttempts=None,
+		restarts=None,
+		relax=False,
+		relaxOrder=[],
+		stats=False,
+		topology='cycles',
+		minCycleLength=3,
+		blockSize=None,
+		ruleProvider=None,
+		validate='full',
 		):
 	errors = ''
 	stop = False
 	numberTypes = (int, float, complex)
 
+	# validate = 'full' checks everything, including calling the lambdas on
+	# sample users. 'fast' only checks the parameters themselves, leaving
+	# out the calls (unique IDs are checked by PreparedExchange instead).
+	# 'off' checks nothing.
+	if validate == 'off':
+		return errors
+	if validate not in VALIDATE_MODES:
+		return f'Parameter, validate, must be one of: {", ".join(VALIDATE_MODES)}'
+	full = validate == 'full'
+
 	# --------------------------------------------------------------------
 	# Validating Parameters for USERS
 	#	- List of users 
@@ -62,18 +1056,19 @@ def ValidateParameters(
 	elif len(users) > maxUsers:
 		errors += '\n' + f'The max number of users is {maxUsers}.'
 
-	if callable(f_uniqueID) and f_uniqueID.__name__ == '<lambda>':
-		try:
-			userIDs = [f_uniqueID(x) for x in users]
-			if len(set(userIDs)) != len(userIDs): 
-				errors += '\n' + 'List of Users must be unique by ID.'
-		except Exception as e: 
-			errors += ('\n' + 'Function f_uniqueID encounters error when ' 
-					+ f'getting IDs. Error is: {e}'
-					)
-			return errors[1:] # Remove leading new-line
+	if callable(f_uniqueID):
+		if full:
+			try:
+				userIDs = [f_uniqueID(x) for x in users]
+				if len(set(userIDs)) != len(userIDs): 
+					errors += '\n' + 'List of Users must be unique by ID.'
+			except Exception as e: 
+				errors += ('\n' + 'Function f_uniqueID encounters error when ' 
+						+ f'getting IDs. Error is: {e}'
+						)
+				return errors[1:] # Remove leading new-line
 	else:
-		errors += '\n' + 'Parameter, f_uniqueID, must be a lambda function'
+		errors += '\n' + 'Parameter, f_uniqueID, must be a function'
 		return errors[1:] # Remove leading new-line
 	
 	# --------------------------------------------------------------------
@@ -81,7 +1076,11 @@ def ValidateParameters(
 	#	- history variable
 	#	- historyLimit
 	#	- history_ParticipationRequired
-	if history:
+	if isinstance(history, HistoryStore):
+		if isinstance(historyLimit, int) and historyLimit > history.historyLimit:
+			errors += ('\n' + f'Parameter, historyLimit, is larger than the'
+					+ f' {history.historyLimit} exchanges kept by the HistoryStore')
+	elif history and not isinstance(history, (HistoryIndex, HistoryArchive)):
 		if isinstance(history, list):
 			assignment_history = history[0]
 			if isinstance(assignment_history, dict):
@@ -105,19 +1104,20 @@ def ValidateParameters(
 	# 	- can get a user's compatibility for assignment
 	#	- can restrict a user properly from being assigned to another
 	if f_restriction:
-		if callable(f_restriction) and f_restriction.__name__ == '<lambda>':
+		if not callable(f_restriction):
+			errors += '\n' + 'Parameter, f_restriction, must be a function'
+		elif full:
 			try:
 				temp_restriction = f_restriction(users[0], users[1])
 				if not isinstance(temp_restriction, bool): 
 					errors += '\n' + 'The Result of f_restriction, must be a boolean'
 			except Exception as e: 
 				errors += '\n' + 'Function f_restriction encounters error when ' 
-						
-		else:
-			errors += '\n' + 'Parameter, f_restriction, must be a lambda function'
 	
 	if f_compatibility:
-		if callable(f_compatibility) and f_compatibility.__name__ == '<lambda>':
+		if not callable(f_compatibility):
+			errors += '\n' + 'Parameter, f_compatibility, must be a function'
+		elif full:
 			try:
 				temp_compatibility = f_compatibility(users[0], users[1])
 				if not isinstance(temp_compatibility, numberTypes): 
@@ -126,112 +1126,468 @@ def ValidateParameters(
 				errors += ('\n' + 'Function f_compatibility encounters error when '
 						+ f'running, error is: {e}'
 						)
-		else:
-			errors += '\n' + 'Parameter, f_compatibility, must be a lambda function'
+
+	if ruleProvider is not None:
+		f_restrictionsFor = getattr(ruleProvider, 'restrictionsFor', None)
+		f_providedRow = getattr(ruleProvider, 'weightsRow', None)
+		if f_restrictionsFor is None and f_providedRow is None:
+			errors += ('\n' + 'Parameter, ruleProvider, must have a restrictionsFor or'
+					+ ' weightsRow method')
+		if f_restrictionsFor is not None and not callable(f_restrictionsFor):
+			errors += '\n' + 'ruleProvider.restrictionsFor must be a method'
+		if f_providedRow is not None:
+			if not callable(f_providedRow):
+				errors += '\n' + 'ruleProvider.weightsRow must be a method'
+			elif f_compatibility or compatibilityWeights is not None:
+				errors += ('\n' + 'Use only one of f_compatibility, compatibilityWeights'
+						+ ' and ruleProvider.weightsRow')
+			elif full and users:
+				try:
+					if len(f_providedRow(users[0])) != len(users):
+						errors += ('\n' + 'The Result of ruleProvider.weightsRow, must have'
+								+ ' a weight for every user')
+				except Exception as e:
+					errors += ('\n' + 'Method ruleProvider.weightsRow encounters error when '
+							+ f'running, error is: {e}')
 	
+	if trace is not None and not callable(trace):
+		errors += '\n' + 'Parameter, trace, must be a function'
+
+	if isinstance(engine, str):
+		if engine not in ENGINES:
+			errors += '\n' + f'Parameter, engine, must be one of: {", ".join(ENGINES)}'
+	elif not callable(engine):
+		errors += '\n' + 'Parameter, engine, must be the name of an engine or a function'
+
+	if not isinstance(precheck, bool):
+		errors += '\n' + 'Parameter, precheck, must be a Boolean'
+
+	if compatibilityWeights is not None:
+		if f_compatibility:
+			errors += '\n' + 'Use only one of f_compatibility and compatibilityWeights'
+		elif not isinstance(compatibilityWeights, FeatureWeights):
+			try:
+				if (len(compatibilityWeights) != len(users) 
+						or any(len(row) != len(users) for row in compatibilityWeights)):
+					errors += ('\n' + 'Parameter, compatibilityWeights, must have a row'
+							+ ' and column for every user')
+			except TypeError:
+				errors += ('\n' + 'Parameter, compatibilityWeights, must be a grid of'
+						+ ' numbers or FeatureWeights')
+
+	if (not isinstance(restrictionRules, list) 
+			or not all(isinstance(x, AttributeRestriction) for x in restrictionRules)):
+		errors += '\n' + 'Parameter, restrictionRules, must be a list of AttributeRestriction'
+	elif full:
+		for rule in restrictionRules:
+			try:
+				hash(rule.f_attribute(users[0]))
+			except Exception as e:
+				errors += ('\n' + 'Function f_attribute of restrictionRules encounters'
+						+ f' error when running, error is: {e}')
+
+	if not isinstance(workers, int) or isinstance(workers, bool) or workers < 1:
+		errors += '\n' + 'Parameter, workers, must be a positive Integer'
+
+	if timeout is not None and (not isinstance(timeout, (int, float)) 
+			or isinstance(timeout, bool) or timeout <= 0):
+		errors += '\n' + 'Parameter, timeout, must be a positive number of seconds'
+
+	if maxAttempts is not None and (not isinstance(maxAttempts, int) 
+			or isinstance(maxAttempts, bool) or maxAttempts < 1):
+		errors += '\n' + 'Parameter, maxAttempts, must be a positive Integer'
+
+	if restarts not in (None, 'luby', 'geometric'):
+		errors += '\n' + "Parameter, restarts, must be 'luby', 'geometric' or None"
+
+	if not isinstance(relax, bool):
+		errors += '\n' + 'Parameter, relax, must be a Boolean'
+
+	if not isinstance(relaxOrder, list):
+		errors += '\n' + 'Parameter, relaxOrder, must be a list of rule names'
+	else:
+		ruleNames = set()
+		if isinstance(restrictionRules, list):
+			ruleNames = set(getattr(x, 'name', None) for x in restrictionRules)
+		if f_restriction:
+			ruleNames.add('f_restriction')
+		if getattr(ruleProvider, 'restrictionsFor', None) is not None:
+			ruleNames.add('ruleProvider')
+		for name in relaxOrder:
+			if name is None or name not in ruleNames:
+				errors += ('\n' + f'Parameter, relaxOrder, names {name!r} but no rule'
+						+ ' has that name')
+
+	if not isinstance(stats, bool):
+		errors += '\n' + 'Parameter, stats, must be a Boolean'
+
+	if topology not in TOPOLOGIES:
+		errors += '\n' + f'Parameter, topology, must be one of: {", ".join(TOPOLOGIES)}'
+	if not isinstance(minCycleLength, int) or isinstance(minCycleLength, bool) or minCycleLength < 3:
+		errors += '\n' + 'Parameter, minCycleLength, must be an Integer, at least 3'
+	if blockSize is not None and (not isinstance(blockSize, int) or isinstance(blockSize, bool) 
+			or blockSize < 3):
+		errors += '\n' + 'Parameter, blockSize, must be None or an Integer, at least 3'
+
 	return errors[1:] # Remove leading new-line
 	
 
-def GiftExchange (
-		users, 
-		f_uniqueID=lambda x: x,
-		history=[], 
-		historyLimit=0, 
-		history_ParticipationRequired=False,
-		f_compatibility=None,
-		f_restriction=None,
-		minUsers=3,
-		maxUsers=50,
-		):
-	# validate input---------------------------------------------
-	errors = ValidateParameters(**locals())
+# Search Limits ---------------------------------------------------------
+# Keeps a search from running forever (GiftExchange's timeout, maxAttempts
+# and restarts parameters). Engines call attempt() for every receiver they 
+# try, which raises SearchLimitError when a limit is used up, or 
+# _RestartSearch when it's time to start over with a new random order.
+# Work that doesn't try receivers one at a time (checking which pairs are
+# allowed, MaximumMatching, ExplainNoResults) calls check() as it goes.
+# Also counts how the search went (see stats), which is all it does when
+# there are no limits (GiftExchange's stats).
+#	timeout = seconds, None for no limit
+#	maxAttempts = receivers tried, over every restart, None for no limit
+#	restarts = 'luby', 'geometric' or None (never restart)
+#	cancelled = threading.Event, stops the search once it's set (see 
+#		GiftExchangeAsync), None when it can't be cancelled
+# A search that runs out of receivers before its restart comes around 
+# still tried every combination, so its ResultError stands.
+class SearchLimits():
+	# Attempts before the first restart, per user
+	restartUnit = 4
+	# 'geometric': each restart waits this many times longer than the last
+	restartGrowth = 1.5
 
-	if errors:
-		raise ValidationError(errors)
-	
-	#------------------------------------------------------------
-	# history_ParticipationRequired == TRUE, exchange focused
-	#	Regardless of a user's participation in prior Exchanges
-	#	the historyLimit relates to the number of exchanges that occurred
-	# history_ParticipationRequired == FALSE, user focused
-	# 	Tracks the history of the user ONLY for the times they participated.
-	#	Meaning user's who don't participate often are still 
-	#	not assigned people they've given to in the last X exchanges
-	#	where x == historyLimit
-	
-	# Create a list of empty lists, one for each user to represent their
-	# prior exchanges. 
-	giverHistory = [ [] for _ in enumerate(users) ]
-	
-	if historyLimit >0:
-		# Dictionary of users in current exchanges
-		#	key = index of that user in Users parameter
-		#	value = the user's uniqueID
-		giversNeedingHistory = dict((i,f_uniqueID(v)) for i, v in enumerate(users))
+	def __init__ (self, userCount, timeout=None, maxAttempts=None, restarts=None, 
+			cancelled=None):
+		self.userCount = userCount
+		self.cancelled = cancelled
+		self.started = time.monotonic()
+		self.timeout = timeout
+		self.deadline = None if timeout is None else self.started + timeout
+		self.maxAttempts = maxAttempts
+		self.restarts = restarts
+		# progress, reported by SearchLimitError
+		self.attempts = 0
+		self.backtracks = 0
+		self.backtrackDepth = 0
+		self.restartCount = 0
+		self.mostAssigned = 0
+		# skips[reason] = receivers rejected (see 'skip' in Tracing), by the
+		# engines and by ExchangeProblem.allowedReceiver
+		self.skips = dict.fromkeys(SKIP_REASONS, 0)
+		# attempts in the current search, and when it restarts
+		self.searchAttempts = 0
+		self.restartAfter = self._restartAfter()
 
-		userIDs = [ f_uniqueID(x) for x in users ]
-		# giversNeedingHistory = userIDs.copy()
+	def _restartAfter(self):
+		unit = max(100, self.restartUnit * self.userCount)
+		if self.restarts == 'luby':
+			return unit * _luby(self.restartCount + 1)
+		if self.restarts == 'geometric':
+			return int(unit * self.restartGrowth ** self.restartCount)
+		return None
+
+	# assigned = givers assigned so far, in the engine's current search
+	def attempt(self, assigned):
+		if assigned > self.mostAssigned:
+			self.mostAssigned = assigned
+		if self.maxAttempts is not None and self.attempts >= self.maxAttempts:
+			raise SearchLimitError(f'no assignment found in {self.maxAttempts} attempts', 
+				self.stats())
+		self.attempts += 1
+		self.searchAttempts += 1
+		# the clock (and cancelled) is only read every 256 attempts
+		if not self.attempts & 255:
+			self.check()
+		if self.restartAfter is not None and self.searchAttempts > self.restartAfter:
+			raise _RestartSearch
+
+	# Raises SearchLimitError when the timeout is up, or the search was cancelled
+	def check(self):
+		if self.deadline is not None and time.monotonic() > self.deadline:
+			raise SearchLimitError(f'no assignment found in {self.timeout} seconds', 
+				self.stats())
+		self.checkCancelled()
+
+	def checkCancelled(self):
+		if self.cancelled is not None and self.cancelled.is_set():
+			raise SearchLimitError('the search was cancelled', self.stats())
+
+	# Called when the search steps back, leaving this many givers assigned
+	def backtrack(self, assigned):
+		self.backtracks += 1
+		if self.mostAssigned - assigned > self.backtrackDepth:
+			self.backtrackDepth = self.mostAssigned - assigned
+
+	# Called when the search starts over
+	def restart(self):
+		self.restartCount += 1
+		self.searchAttempts = 0
+		self.restartAfter = self._restartAfter()
+
+	# A copy with the same limits and none of the counts, for a search in
+	# another process (see PreparedExchange.blockSolve), added back with 
+	# addCounts
+	def fork(self):
+		import copy
+		limits = copy.copy(self)
+		limits.attempts = limits.backtracks = limits.backtrackDepth = 0
+		limits.restartCount = limits.mostAssigned = 0
+		limits.skips = dict.fromkeys(SKIP_REASONS, 0)
+		return limits
+
+	def addCounts(self, other):
+		self.attempts += other.attempts
+		self.backtracks += other.backtracks
+		self.restartCount += other.restartCount
+		self.backtrackDepth = max(self.backtrackDepth, other.backtrackDepth)
+		self.mostAssigned = max(self.mostAssigned, other.mostAssigned)
+		for reason, count in other.skips.items():
+			self.skips[reason] += count
+
+	# cancelled stays behind when the limits are sent from a worker process
+	def __getstate__(self):
+		return dict(self.__dict__, cancelled=None)
+
+	def stats(self):
+		return {
+			'attempts': self.attempts,
+			'backtracks': self.backtracks,
+			'backtrackDepth': self.backtrackDepth,
+			'restarts': self.restartCount,
+			'mostAssigned': self.mostAssigned,
+			'users': self.userCount,
+			'seconds': time.monotonic() - self.started,
+			'skips': dict(self.skips),
+			}
+
+# i-th number (from 1) of the Luby sequence: 1,1,2,1,1,2,4,1,1,2,1,1,2,4,8,...
+# Reference: Luby, Sinclair & Zuckerman, "Optimal Speedup of Las Vegas 
+#	Algorithms" (1993)
+def _luby(i):
+	while True:
+		k = 1
+		while (1 << k) - 1 < i:
+			k += 1
+		if i == (1 << k) - 1:
+			return 1 << (k - 1)
+		i -= (1 << (k - 1)) - 1
+
+class _RestartSearch(Exception):
+	pass
+
+# Exchange Stats --------------------------------------------------------
+# Where the time of a GiftExchange call went, and how its searches went
+# (GiftExchange's stats). Nothing is counted or timed without it.
+#	- time is split between phases with a stopwatch: switch() ends the
+#		current phase and starts the next, so phases never overlap
+#	- the lambdas given to GiftExchange are wrapped to count their calls
+#	- each search's SearchLimits is added once the search is over
+# stats() returns everything as a dictionary of numbers, see the README.
+class ExchangeStats():
+	def __init__ (self):
+		# seconds[phase] = time spent in it, phase = None while stopped
+		self.seconds = {}
+		self.phase = None
+		self.since = None
+		# lambdaCalls[name] = calls to the lambda given as that parameter
+		self.lambdaCalls = {}
+		self.searches = 0
+		self.attempts = 0
+		self.backtracks = 0
+		self.backtrackDepth = 0
+		self.restarts = 0
+		self.mostAssigned = 0
+		self.skips = dict.fromkeys(SKIP_REASONS, 0)
+
+	# Starts timing the phase (None to stop), returns the phase it ended
+	def switch(self, phase):
+		now = time.perf_counter()
+		previous = self.phase
+		if previous is not None:
+			self.seconds[previous] = self.seconds.get(previous, 0) + now - self.since
+		self.phase = phase
+		self.since = now
+		return previous
+
+	# f, counting its calls in lambdaCalls[name]
+	def counted(self, name, f):
+		calls = self.lambdaCalls
+		calls.setdefault(name, 0)
+		def counting(*args):
+			calls[name] += 1
+			return f(*args)
+		return counting
+
+	def addSearch(self, limits):
+		self.searches += 1
+		self.attempts += limits.attempts
+		self.backtracks += limits.backtracks
+		self.backtrackDepth = max(self.backtrackDepth, limits.backtrackDepth)
+		self.restarts += limits.restartCount
+		self.mostAssigned = max(self.mostAssigned, limits.mostAssigned)
+		for reason, count in limits.skips.items():
+			self.skips[reason] += count
+
+	def stats(self):
+		return {
+			'seconds': dict(self.seconds),
+			'searches': self.searches,
+			'attempts': self.attempts,
+			'backtracks': self.backtracks,
+			'backtrackDepth': self.backtrackDepth,
+			'restarts': self.restarts,
+			'mostAssigned': self.mostAssigned,
+			'skips': dict(self.skips),
+			'lambdaCalls': dict(self.lambdaCalls),
+			}
+
+# giverHistory of the users without any
+_NO_HISTORY = ()
+
+# giverHistory of one giver, from their receivers: a tuple when there are
+# only a few (a set of a few takes several times the memory, and isn't any
+# faster to look through), otherwise a frozenset
+def _historySet(receivers):
+	receivers = tuple(dict.fromkeys(receivers))
+	if not receivers:
+		return _NO_HISTORY
+	return receivers if len(receivers) <= 8 else frozenset(receivers)
+
+# Exchange Problem ------------------------------------------------------
+# Everything a search engine needs, prepared once by GiftExchange
+#	users = parameter of GiftExchange
+#	userIDs = uniqueID of each user, from f_uniqueID
+#	givers = randomized order of givers (index in users)
+#	receivers_byGiver = for each giver, randomized order of receivers to try
+#	giverHistory = for each giver, receivers from prior exchanges (see _historySet)
+#	restrictions = RestrictionMatrix, from f_restriction, restrictionRules and ruleProvider
+#	trace = parameter of GiftExchange
+#	f_weightsRow = lambda returning a giver's compatibility weights, 
+#		weights[receiver], None without f_compatibility or compatibilityWeights
+#	limits = SearchLimits, None when the search has no limits
+# An engine is a function that takes an ExchangeProblem and returns 
+# assignedUsers, a list where assignedUsers[giver] = receiver (index in 
+# users), or raises ResultError when there are no assignment combinations.
+class ExchangeProblem():
+	def __init__ (self, users, userIDs, givers, receivers_byGiver, giverHistory, 
+			restrictions=None, trace=None, limits=None, f_weightsRow=None):
+		self.users = users
+		self.userIDs = userIDs
+		self.givers = givers
+		self.receivers_byGiver = receivers_byGiver
+		self.giverHistory = giverHistory
+		self.restrictions = restrictions
+		self.trace = trace
+		self.limits = limits
+		self.f_weightsRow = f_weightsRow
+		# Assignments MaximumMatching starts from, None for its own quick 
+		# first pass. Every assignment must be allowed.
+		self.startMatching = None
+		# Filled in as they're needed, see allowedReceiver and MaximumMatching.
+		# allowed[giver] = array('i') of the receivers found allowed so far,
+		# 4 bytes each, None until the giver's first is asked for
+		self.allowed = None
+		self.scanned = None
+		self.matching = None
+
+	# Reason the giver can never be assigned the receiver, None when it can.
+	# Only covers the rules that don't depend on other assignments
+	# (see 'skip' in Tracing for the full list of reasons)
+	def skipReason(self, giver, receiver):
+		if receiver == giver:
+			return 'self'
+		if receiver in self.giverHistory[giver]:
+			return 'history'
+		if self.restrictions and self.restrictions.isRestricted(giver, receiver):
+			return 'restriction'
+		return None
+
+	# SearchLimits.check, for work outside of SearchLimits.attempt
+	def checkLimits(self):
+		if self.limits:
+			self.limits.check()
+
+	# The k-th receiver (0 = first) the giver may be assigned, going through
+	# receivers_byGiver[giver] in order. None when there are no more.
+	# Pairs are only checked when they're asked for, and only once. They're
+	# checked in batches, twice as many as before each time.
+	def allowedReceiver(self, giver, k):
+		if self.allowed is None:
+			self.allowed = [None] * len(self.users)
+			self.scanned = array('i', [0]) * len(self.users)
+		allowed = self.allowed[giver]
+		if allowed is None:
+			allowed = self.allowed[giver] = array('i')
+		elif k < len(allowed):
+			return allowed[k]
+		receivers = self.receivers_byGiver[giver]
+		scanned = self.scanned[giver]
+		history = self.giverHistory[giver]
+		while len(allowed) <= k and scanned < len(receivers):
+			stop = min(len(receivers), max(8, 2 * scanned, scanned + k + 1 - len(allowed)))
+			allowed.extend(self._allowedIn(giver, receivers[scanned:stop], history))
+			scanned = stop
+		self.scanned[giver] = scanned
+		return allowed[k] if k < len(allowed) else None
+
+	# Every receiver the giver may be assigned
+	def allowedReceivers(self, giver):
+		self.allowedReceiver(giver, 0)
+		allowed = self.allowed[giver]
+		receivers = self.receivers_byGiver[giver]
+		scanned = self.scanned[giver]
+		if scanned < len(receivers):
+			allowed.extend(self._allowedIn(giver, receivers[scanned:], self.giverHistory[giver]))
+			self.scanned[giver] = len(receivers)
+		return allowed
+
+	# The receivers in the list the giver may be assigned, in the same order.
+	# The others are counted in limits.skips. Checking the pairs is most of
+	# the work before the search (precheck, engines), so the limits are 
+	# checked here too.
+	def _allowedIn(self, giver, receivers, history):
+		self.checkLimits()
+		skips = self.limits.skips if self.limits else None
+		checked = len(receivers)
+		if history:
+			receivers = [ r for r in receivers if r not in history ]
+			if skips is not None:
+				skips['history'] += checked - len(receivers)
+		if giver in receivers:
+			receivers.remove(giver)
+			if skips is not None:
+				skips['self'] += 1
+		if self.restrictions:
+			checked = len(receivers)
+			receivers = self.restrictions.unrestricted(giver, receivers)
+			if skips is not None:
+				skips['restriction'] += checked - len(receivers)
+		return receivers
+
+# Backtrack Engine ------------------------------------------------------
+# Default engine. Goes through the givers in order, each trying their 
+# receivers in order, stepping back to the previous giver when one runs out.
+def BacktrackEngine(problem):
+	users = problem.users
+	givers = problem.givers
+	receivers_byGiver = problem.receivers_byGiver
+	trace = problem.trace
+	limits = problem.limits
 
-		logging.info(' ----- Building History')
-		for i_hist, historicExchange in enumerate(history):
-			logging.info(f' -- Exchange [{i_hist}] : {historicExchange}')
-			# Doing this instead of Enumerate because we're changing
-			#	the size of the dictionary mid-iteration, which 
-			#	causes an error otherwise
-			for i_user in list(giversNeedingHistory): # Get's the dict keys
-				userID = giversNeedingHistory[i_user]
-				logging.info(f'checking user {userID=}, inx={i_user}') 
-				if userID in historicExchange.keys():
-					# Check if the recipient of the prior exchange is in  
-					# list of users for the current exchange
-					recipientID = historicExchange[userID]
-					try: 
-						recipient_in_current_users = userIDs.index(recipientID)
-						logging.info(f'checking user {userID=}, inx={i_user}') 
-					except:
-						recipient_in_current_users = None
-					giverHistory[i_user].append(recipient_in_current_users)
-				elif not history_ParticipationRequired:
-					giverHistory[i_user].append(None)
-				
-				if len(giverHistory[i_user]) >= historyLimit:
-					giversNeedingHistory.pop(i_user)
-			if not giversNeedingHistory:
-				break
-	
 	#------------------------------------------------------------
 	# ex: assignedUser[0] = 3, means 1st user is assigned to the 4th user
 	# value meaning: 
 	#		None = it has no assigned partner yet
 	assignedUsers = []
 	assignedUsers = [None] * len(users)
+	# Search state kept alongside assignedUsers so each attempt is O(1)
+	#	receiverTaken[i] = 1 when user i is already someone's receiver
+	#	unassignedGivers = count of None values in assignedUsers
+	receiverTaken = bytearray(len(users))
+	unassignedGivers = len(users)
 	
-	givers = list(range(0,len(users)))
-	shuffle(givers)
-	logging.info(f' ----- GIVER ORDER: {givers}')
-
-	# List
-	# - the list index matches that of the index of a giver in the list of Users
-	# - each item in this list, is a randomized list of receivers (their index in the list of Users)
-	if f_compatibility:
-		# make empty multi-dimensional array
-		receivers_byGiver = [ [] for _ in range(len(users))] 
-		weights_byGiver = [ [] for _ in range(len(users))] 
-		for i in range(len(users)):
-			giver_user = users[i]
-			weights_of_current_giver = [ f_compatibility(giver_user, users[receiver]) for receiver in range(len(users))]
-			# Bigger = more likely (heavier weight)
-			receivers_byGiver[i] = weighted_shuffle(range(len(users)), weights_of_current_giver)
-			weights_byGiver[i] = weights_of_current_giver
-	else:
-		receivers_byGiver = [ sorted( range(len(users)), key=lambda k: random()) for x in range(len(users)) ]
-
-	logging.info(f' ----- RECEIVER ORDERS: {receivers_byGiver}')
 	# Dictionary 
 	# - Index = Index of user that is the giver
 	# - value = keeping track of number of Receivers we've tried so far. Used as Index in receivers_byGiver[key/givgiversAssigneder]
 	attemptTracking = [-1] * len(users) # dict.fromkeys(list(range(0,len(users))), 0)
-	logging.info(f' ----- PRE-PROCESSED ATTEMPT COUNTS: {attemptTracking}')
 
 	# initialize
 	escapable = False
@@ -239,14 +1595,12 @@ def GiftExchange (
 	initialize_Exchange = True
 	givingUsers_Index = -1 
 	giver = givers[0] 
-	receiverAttempt = attemptTracking[giver]
-	receiver = receivers_byGiver[giver][receiverAttempt]
 
 	while not escapable: 
 		# Putting this check here for the case of Skips
 		# --------------------------------------------------
 		# the number of givers used matches the count of total users
-		if None not in assignedUsers:
+		if unassignedGivers == 0:
 			escapable = True
 			continue
 		if givingUsers_Index <= 0: # index compared to count
@@ -259,7 +1613,11 @@ def GiftExchange (
 		# well, the attempts of Receivers has 
 		elif attemptTracking[giver] >= len(users) - 1: # index compared to count
 			if not receiversExhausted:
-				logging.info(f' Giving up on - Giver #{givingUsers_Index + 1} as {giver}\n')
+				if trace:
+					trace('backtrack', {'position': givingUsers_Index, 'giver': giver})
+				if limits:
+					# the previous giver is about to give up their receiver
+					limits.backtrack(len(users) - unassignedGivers - 1)
 				
 				# Reset count of Receivers tried for this level of Giver
 				attemptTracking[giver] = -1
@@ -272,9 +1630,12 @@ def GiftExchange (
 
 		if receiversExhausted:
 			givingUsers_Index += 1
-			giverAttempt_orginal = ordinal(givingUsers_Index + 1)
 			giver = givers[givingUsers_Index]
-			givingUsersLeft = sorted(givers[givingUsers_Index + 1:])
+			# Stepping back to a prior giver: free up the receiver it had
+			if assignedUsers[giver] is not None:
+				receiverTaken[assignedUsers[giver]] = 0
+				assignedUsers[giver] = None
+				unassignedGivers += 1
 			receiversExhausted = False
 
 		# This is in case we gave up on a Giver, but the previous giver was also at it's max
@@ -282,42 +1643,2335 @@ def GiftExchange (
 			continue
 		attemptTracking[giver] += 1
 		receiverAttempt = attemptTracking[giver]
-		receiverAttempt_ordinal = ordinal(receiverAttempt + 1)
 		receiver = receivers_byGiver[giver][receiverAttempt]
-		receivingUsersLeft = sorted(receivers_byGiver[giver][receiverAttempt + 1:])
+		if limits:
+			limits.attempt(len(users) - unassignedGivers)
 
-		logging.info(f' current attemtps counters {attemptTracking}') 
-		logging.info(f' {giverAttempt_orginal}:{receiverAttempt_ordinal} - Attempting g{giver}:r{receiver} -- GL{givingUsersLeft}:RL{receivingUsersLeft}') 
+		if trace:
+			trace('attempt', {'position': givingUsers_Index, 'giver': giver,
+				'attempt': receiverAttempt, 'receiver': receiver})
 
-		if receiver in assignedUsers:
-			logging.info(f' {giverAttempt_orginal} G - SKIPPING Receiver index {receiver} - Receiver is already assigned to someone')
-			continue
+		# Reason the receiver can't be used, None when it can
+		skipReason = None
+		if receiverTaken[receiver]:
+			skipReason = 'taken'
 		elif assignedUsers[receiver] == giver:
-			logging.info(f' {giverAttempt_orginal} G - SKIPPING Receiver index {receiver} - Creates closed loop')
+			skipReason = 'closed_loop'
+		else:
+			skipReason = problem.skipReason(giver, receiver)
+
+		if skipReason:
+			if trace:
+				trace('skip', {'position': givingUsers_Index, 'giver': giver,
+					'receiver': receiver, 'reason': skipReason})
+			if limits:
+				limits.skips[skipReason] += 1
+			continue
+		
+		assignedUsers[giver] = receiver
+		receiverTaken[receiver] = 1
+		unassignedGivers -= 1
+		receiversExhausted = True
+		if trace:
+			trace('assign', {'position': givingUsers_Index, 'giver': giver, 'receiver': receiver})
+
+	return assignedUsers
+
+# Forward Checking Engine -----------------------------------------------
+# For tightly restricted exchanges (ex: two teams, long historyLimit) where
+# the BacktrackEngine can spend a very long time before giving up.
+#	- every giver keeps count of the receivers they could still be 
+#		assigned, watching only the first few in their randomized order 
+#		(see watchCount), so nothing is kept for every pair of users
+#	- the giver with the fewest receivers left is assigned next
+#	- assigning a receiver takes it from the givers watching it, and 
+#		takes the giver from the receiver (closed loop)
+#	- when that leaves a giver with no receivers, the receiver is skipped 
+#		right away instead of finding out later in the search
+#	- the givers not assigned yet are kept matched with receivers they 
+#		could still be assigned (see MaximumMatching), one receiver each. 
+#		When one can't be matched again after an assignment, a group of 
+#		givers has fewer receivers left between them than there are givers 
+#		(Hall's condition), and the receiver is skipped too, even though 
+#		each giver still has receivers of their own.
+#	- when a giver runs out of receivers, the search jumps back to the 
+#		latest giver responsible, instead of just the previous one
+# Reference: Prosser, "Hybrid Algorithms for the Constraint Satisfaction 
+#	Problem" (1993), FC-CBJ. Régin, "A Filtering Algorithm for Constraints
+#	of Difference in CSPs" (1994), for the matching.
+def ForwardCheckingEngine(problem):
+	userCount = len(problem.users)
+	givers = problem.givers
+	trace = problem.trace
+	limits = problem.limits
+	# allowedReceiver(giver, k) = k-th receiver the giver may be assigned,
+	# in the giver's randomized order, None past the last one
+	allowedReceiver = problem.allowedReceiver
+
+	# matchedTo[giver] = receiver the unassigned giver is matched with, 
+	# matchOf[receiver] = the reverse. Givers left without one are unmatched,
+	# and receivers neither taken nor matched are free.
+	matchedTo = MaximumMatching(problem)
+	if None in matchedTo:
+		raise ResultError(report=ExplainNoResults(problem, matchedTo))
+	matchOf = [None] * userCount
+	for g, r in enumerate(matchedTo):
+		matchOf[r] = g
+	unmatched = set()
+	free = set()
+
+	assignedUsers = [None] * userCount
+	# takenBy[receiver] = giver assigned to that receiver, None if available
+	takenBy = [None] * userCount
+	# Givers only watch their first receivers, as many as it takes to have 
+	# watchCount left, so the search doesn't keep users^2 pairs (and check
+	# them all) for the givers that have plenty.
+	#	watched[giver] = how many of its receivers the giver watches
+	#	watchedAll[giver] = 1 once that's every receiver the giver has
+	#	liveCounts[giver] = receivers the giver watches that aren't taken 
+	#		and don't create a closed loop. Exact once watchedAll, otherwise 
+	#		there are at least watchCount.
+	#	watchers[receiver] = array of the givers watching it, None if none are
+	watchCount = 12
+	watched = array('i', [0]) * userCount
+	watchedAll = bytearray(userCount)
+	liveCounts = array('i', [0]) * userCount
+	watchers = [None] * userCount
+	# Number of receivers tried so far, used as k in allowedReceiver
+	attemptTracking = array('i', [0]) * userCount
+	# conflicts[giver] = earlier givers whose assignments ruled out receivers 
+	# for this giver. Used to decide how far back to jump.
+	conflicts = [None] * userCount
+	# Givers in the order they were picked, and each one's position in it
+	stack = []
+	depthOf = [None] * userCount
+	# Givers not picked yet, as (fewest receivers left, position in givers,
+	# giver). Entries aren't removed when the giver's count changes, a new
+	# one is added, and the old ones skipped when they come up.
+	positionOf = array('i', [0]) * userCount
+	for i, g in enumerate(givers):
+		positionOf[g] = i
+	queue = []
+
+	# Watches more of the giver's receivers, until it has watchCount left
+	def watchMore(giver):
+		k = watched[giver]
+		while liveCounts[giver] < watchCount:
+			if allowedReceiver(giver, k) is None:
+				watchedAll[giver] = 1
+				break
+			# the receivers allowedReceiver has found so far
+			allowed = problem.allowed[giver]
+			while k < len(allowed) and liveCounts[giver] < watchCount:
+				receiver = allowed[k]
+				k += 1
+				if watchers[receiver] is None:
+					watchers[receiver] = array('i')
+				watchers[receiver].append(giver)
+				if takenBy[receiver] is None and assignedUsers[receiver] != giver:
+					liveCounts[giver] += 1
+		watched[giver] = k
+
+	# Adds the giver to the queue again after its count changed
+	def requeue(giver):
+		if depthOf[giver] is None and liveCounts[giver] <= watchCount:
+			heapq.heappush(queue, (liveCounts[giver], positionOf[giver], giver))
+
+	# Whether the receiver watches the giver, so the giver taking it closes a loop
+	def watches(receiver, giver):
+		return watchers[giver] is not None and receiver in watchers[giver]
+
+	# Returns the first giver left without receivers, None if all is well
+	def assign(giver, receiver):
+		wipedOut = None
+		takenBy[receiver] = giver
+		changed = [ other for other in watchers[receiver] or () 
+			if assignedUsers[receiver] != other ]
+		assignedUsers[giver] = receiver
+		if takenBy[giver] is None and watches(receiver, giver):
+			changed.append(receiver)
+		for other in changed:
+			liveCounts[other] -= 1
+			if assignedUsers[other] is None:
+				if liveCounts[other] < watchCount and not watchedAll[other]:
+					watchMore(other)
+				if liveCounts[other] == 0 and wipedOut is None:
+					wipedOut = other
+				requeue(other)
+		return wipedOut
+
+	# Exact reverse of assign(), the giver's match is found later (see rematch)
+	def unassign(giver):
+		if matchedTo[giver] is None:
+			unmatched.add(giver)
+		receiver = assignedUsers[giver]
+		if matchOf[receiver] is None:
+			free.add(receiver)
+		if takenBy[giver] is None and watches(receiver, giver):
+			liveCounts[receiver] += 1
+			requeue(receiver)
+		assignedUsers[giver] = None
+		takenBy[receiver] = None
+		for other in watchers[receiver] or ():
+			if assignedUsers[receiver] != other:
+				liveCounts[other] += 1
+				requeue(other)
+
+	# After assign(): matches the givers whose match the assignment took, 
+	# and any left unmatched before it. Returns None when they all are, 
+	# otherwise a group of givers with fewer receivers left than givers.
+	def updateMatching(giver, receiver):
+		unmatched.discard(giver)
+		free.discard(receiver)
+		if matchedTo[giver] is not None:
+			matchOf[matchedTo[giver]] = None
+			if takenBy[matchedTo[giver]] is None:
+				free.add(matchedTo[giver])
+			matchedTo[giver] = None
+		other = matchOf[receiver]
+		if other is not None:
+			matchOf[receiver] = matchedTo[other] = None
+			unmatched.add(other)
+		# closed loop: the receiver can't give to the giver now
+		if assignedUsers[receiver] is None and matchedTo[receiver] == giver:
+			matchOf[giver] = matchedTo[receiver] = None
+			unmatched.add(receiver)
+			if takenBy[giver] is None:
+				free.add(giver)
+		for g in list(unmatched):
+			group = rematch(g)
+			if group is not None:
+				return group
+			unmatched.discard(g)
+		return None
+
+	# Looks for a chain of givers, starting with the unmatched root, that 
+	# can each pass their match down the line until the last one reaches a
+	# receiver nobody is matched with (see MaximumMatching). Returns None 
+	# once the root is matched, otherwise the givers the chain could reach.
+	# Every receiver left to them is matched with one of them, so there's
+	# one receiver too few.
+	# There are only as many free receivers as unmatched givers (a few), so
+	# each giver on the way checks those first, instead of going through 
+	# its receivers to find them.
+	def rematch(root):
+		reached = [root]
+		seen = {root}
+		# path of (giver, k of the next receiver to try in allowedReceiver),
+		# via[i] = receiver path[i] would take from path[i + 1]
+		path = [(root, 0)]
+		via = []
+		steps = 0
+		while path:
+			giver, k = path[-1]
+			descended = False
+			if k == 0:
+				for receiver in free:
+					if (takenBy[receiver] is None and assignedUsers[receiver] != giver
+							and problem.skipReason(giver, receiver) is None):
+						via.append(receiver)
+						break
+			while len(via) < len(path):
+				receiver = allowedReceiver(giver, k)
+				if receiver is None:
+					break
+				k += 1
+				if takenBy[receiver] is not None or assignedUsers[receiver] == giver:
+					continue
+				other = matchOf[receiver]
+				if other is None:
+					via.append(receiver)
+					break
+				if other not in seen:
+					seen.add(other)
+					reached.append(other)
+					path[-1] = (giver, k)
+					path.append((other, 0))
+					via.append(receiver)
+					descended = True
+					break
+			if len(via) == len(path):
+				free.discard(via[-1])
+				for (g, _), r in zip(path, via):
+					matchedTo[g] = r
+					matchOf[r] = g
+				return None
+			steps += 1
+			if not steps & 255:
+				problem.checkLimits()
+			if not descended:
+				path.pop()
+				if via:
+					via.pop()
+		return reached
+
+	# Givers whose assignments ruled out the receivers of this giver. Only
+	# asked of givers whose receivers have all been gone through.
+	def culprits(giver):
+		found = set()
+		for r in problem.allowedReceivers(giver):
+			if takenBy[r] is not None:
+				found.add(takenBy[r])
+			elif assignedUsers[r] == giver:
+				found.add(r)
+		return found
+
+	# Giver with the fewest receivers left, ties go to the randomized order
+	def pushNextGiver():
+		while True:
+			count, position, best = heapq.heappop(queue)
+			if depthOf[best] is None and count == min(liveCounts[best], watchCount):
+				break
+		depthOf[best] = len(stack)
+		stack.append(best)
+		conflicts[best] = set()
+		return best
+
+	# culprits() of every giver in the group, and the receivers left to 
+	# them between them
+	def groupCulprits(group):
+		found = set()
+		left = set()
+		for g in group:
+			for r in problem.allowedReceivers(g):
+				if takenBy[r] is not None:
+					found.add(takenBy[r])
+				elif assignedUsers[r] == g:
+					found.add(r)
+				else:
+					left.add(r)
+		return found, left
+
+	# Groups of givers (see rematch) that need every receiver they have 
+	# left, so any other giver taking one of them is a dead end: 
+	# (depth, givers, receivers, culprits). Each stands until the search
+	# steps back past the giver at that depth in the stack.
+	tightGroups = []
+
+	# The tight group the receiver belongs to, None when the giver may take it
+	def tightGroupOf(giver, receiver):
+		for tight in tightGroups:
+			if receiver in tight[2] and giver not in tight[1]:
+				return tight
+		return None
+
+	for g in givers:
+		watchMore(g)
+		queue.append((min(liveCounts[g], watchCount), positionOf[g], g))
+	heapq.heapify(queue)
+
+	giver = pushNextGiver()
+	while True:
+		assigned = False
+		while True:
+			receiver = allowedReceiver(giver, attemptTracking[giver])
+			if receiver is None:
+				break
+			attemptTracking[giver] += 1
+			if limits:
+				limits.attempt(len(stack) - 1)
+			if trace:
+				trace('attempt', {'position': depthOf[giver], 'giver': giver,
+					'attempt': attemptTracking[giver] - 1, 'receiver': receiver})
+
+			skipReason = None
+			if takenBy[receiver] is not None:
+				skipReason = 'taken'
+			elif assignedUsers[receiver] == giver:
+				skipReason = 'closed_loop'
+			elif tightGroups and tightGroupOf(giver, receiver):
+				conflicts[giver] |= tightGroupOf(giver, receiver)[3]
+				skipReason = 'dead_end'
+			else:
+				group = None
+				wipedOut = assign(giver, receiver)
+				if wipedOut is None:
+					group = updateMatching(giver, receiver)
+					if group is None:
+						assigned = True
+						break
+				else:
+					conflicts[giver] |= culprits(wipedOut)
+				unassign(giver)
+				if group is not None:
+					found, left = groupCulprits(group)
+					conflicts[giver] |= found
+					# The group had just as many receivers as givers before 
+					# the receiver was taken. (Unless the giver was one of 
+					# them, and the receiver one of the group, then it may
+					# only be because of the closed loop.)
+					if giver not in left or receiver not in group:
+						tightGroups.append((depthOf[giver], set(group), left, found))
+				skipReason = 'dead_end'
+			if trace:
+				trace('skip', {'position': depthOf[giver], 'giver': giver,
+					'receiver': receiver, 'reason': skipReason})
+			if limits:
+				limits.skips[skipReason] += 1
+
+		if assigned:
+			if trace:
+				trace('assign', {'position': depthOf[giver], 'giver': giver, 'receiver': receiver})
+			if len(stack) == userCount:
+				return assignedUsers
+			giver = pushNextGiver()
 			continue
-		elif receiver == giver:
-			logging.info(f' {giverAttempt_orginal} G - SKIPPING Receiver index {receiver} - Giver and receiver must not be the same user')
+
+		# Out of receivers: jump back to the latest giver responsible
+		conflict = (conflicts[giver] | culprits(giver)) - {giver}
+		if not conflict:
+			raise ResultError
+		target = max(conflict, key=lambda g: depthOf[g])
+		if trace:
+			trace('backtrack', {'position': depthOf[giver], 'giver': giver, 
+				'jump_to': depthOf[target]})
+		if limits:
+			limits.backtrack(depthOf[target])
+		while tightGroups and tightGroups[-1][0] > depthOf[target]:
+			tightGroups.pop()
+		while stack[-1] != target:
+			g = stack.pop()
+			if assignedUsers[g] is not None:
+				unassign(g)
+			depthOf[g] = None
+			attemptTracking[g] = 0
+			conflicts[g] = None
+			if liveCounts[g] < watchCount and not watchedAll[g]:
+				watchMore(g)
+			heapq.heappush(queue, (min(liveCounts[g], watchCount), positionOf[g], g))
+		unassign(target)
+		if liveCounts[target] < watchCount and not watchedAll[target]:
+			watchMore(target)
+		conflicts[target] |= conflict - {target}
+		giver = target
+
+# Maximum Matching ------------------------------------------------------
+# Leaving closed loops aside, an exchange is a perfect matching of givers
+# to receivers. Hopcroft-Karp finds the largest matching possible in 
+# polynomial time, so when it isn't perfect there's no exchange at all.
+#	- receivers are considered in each giver's randomized order, so the
+#		results vary the same way they do with the other engines
+#	- closed loops are avoided where it's easy, but may be left over
+# Returns assignedUsers, with None for givers that couldn't be matched.
+# The result is kept on the problem, so it's only worked out once.
+# Reference: Hopcroft & Karp, "An n^5/2 Algorithm for Maximum Matchings 
+#	in Bipartite Graphs" (1973)
+def MaximumMatching(problem):
+	if problem.matching is not None:
+		return list(problem.matching)
+	userCount = len(problem.users)
+	givers = problem.givers
+	edge = problem.allowedReceiver
+	# steps of the searches below, for checking the limits every so often
+	steps = 0
+
+	# assignedUsers[giver] = receiver, giverOf[receiver] = giver
+	assignedUsers = [None] * userCount
+	giverOf = [None] * userCount
+	if problem.startMatching is not None:
+		for giver, receiver in enumerate(problem.startMatching):
+			if receiver is not None:
+				assignedUsers[giver] = receiver
+				giverOf[receiver] = giver
+
+	# Quick first pass, avoiding closed loops where it can
+	for giver in givers:
+		k = 0
+		while assignedUsers[giver] is None and edge(giver, k) is not None:
+			receivers = problem.allowed[giver]
+			for receiver in receivers[k:]:
+				if giverOf[receiver] is None and assignedUsers[receiver] != giver:
+					assignedUsers[giver] = receiver
+					giverOf[receiver] = giver
+					break
+			k = len(receivers)
+
+	# Hopcroft-Karp phases, each finding a set of augmenting paths: chains
+	# of givers that can each pass their receiver down the line until the
+	# last one reaches a receiver nobody has
+	while True:
+		freeGivers = [ g for g in givers if assignedUsers[g] is None ]
+		if not freeGivers:
+			break
+
+		# Breadth first: layer[giver] = steps from the nearest free giver.
+		# Stops as soon as a free receiver is in reach.
+		layer = [-1] * userCount
+		for g in freeGivers:
+			layer[g] = 0
+		queue = list(freeGivers)
+		i_queue = 0
+		found = False
+		while i_queue < len(queue) and not found:
+			giver = queue[i_queue]
+			i_queue += 1
+			steps += 1
+			if not steps & 255:
+				problem.checkLimits()
+			# edge() checks more of the giver's receivers, then the ones
+			# it added to problem.allowed are gone through directly
+			k = 0
+			while not found and edge(giver, k) is not None:
+				receivers = problem.allowed[giver]
+				for receiver in receivers[k:]:
+					other = giverOf[receiver]
+					if other is None:
+						found = True
+						break
+					if layer[other] == -1:
+						layer[other] = layer[giver] + 1
+						queue.append(other)
+				k = len(receivers)
+		if not found:
+			break
+
+		# Depth first, along the layers, from every free giver
+		position = [0] * userCount
+		for root in freeGivers:
+			path = [root]
+			# via[i] = receiver path[i] takes from path[i + 1]
+			via = []
+			while path:
+				steps += 1
+				if not steps & 255:
+					problem.checkLimits()
+				giver = path[-1]
+				receiver = edge(giver, position[giver])
+				if receiver is None:
+					# Dead end for the rest of this phase
+					layer[giver] = -1
+					path.pop()
+					if via:
+						via.pop()
+					continue
+				position[giver] += 1
+				other = giverOf[receiver]
+				if other is None:
+					via.append(receiver)
+					for g, r in zip(path, via):
+						assignedUsers[g] = r
+						giverOf[r] = g
+					break
+				if layer[other] == layer[giver] + 1:
+					path.append(other)
+					via.append(receiver)
+
+	problem.matching = assignedUsers
+	return list(assignedUsers)
+
+# Precheck --------------------------------------------------------------
+# Runs before the search (GiftExchange(precheck=True)) to find exchanges
+# that can't work, in polynomial time instead of searching every combination.
+# Raises ResultError with a report of the users and rules that block the
+# exchange. Only a maximum matching is needed when the exchange can work,
+# the checks below only run when it can't.
+#	- givers with no receivers allowed, and receivers no giver can have
+#	- two groups (ex: teams) that can only give to each other, but aren't
+#		the same size
+#	- a group of givers with fewer receivers allowed between them than 
+#		there are givers (Hall's condition)
+def Precheck(problem):
+	assignedUsers = MaximumMatching(problem)
+	if None not in assignedUsers:
+		return
+	raise ResultError(report=ExplainNoResults(problem, assignedUsers))
+
+# Lists users by uniqueID for a report, shortening long lists
+def _describeUsers(problem, indexes, limit=10):
+	indexes = sorted(indexes)
+	described = ', '.join(repr(problem.userIDs[i]) for i in indexes[:limit])
+	if len(indexes) > limit:
+		described += f' and {len(indexes) - limit} more'
+	return described
+
+# Works out why a maximum matching (assignedUsers) isn't perfect.
+# Returns a list of lines describing it.
+def ExplainNoResults(problem, assignedUsers):
+	userCount = len(problem.users)
+	report = []
+	giverOf = [None] * userCount
+	for g, r in enumerate(assignedUsers):
+		if r is not None:
+			giverOf[r] = g
+
+	# Only givers and receivers left out of the matching can have nobody
+	# allowed, the others were matched with someone
+	for g in range(userCount):
+		if assignedUsers[g] is None and problem.allowedReceiver(g, 0) is None:
+			problem.checkLimits()
+			reasons = {}
+			for r in range(userCount):
+				reason = problem.skipReason(g, r)
+				reasons[reason] = reasons.get(reason, 0) + 1
+			reasons = ', '.join(f'{reason}: {count}' for reason, count in reasons.items())
+			report.append(f'Giver {problem.userIDs[g]!r} has no receivers allowed ({reasons})')
+	if report:
+		# a pair at a time, instead of every giver's receivers
+		def hasGiver(r):
+			problem.checkLimits()
+			return not all(problem.skipReason(g, r) for g in range(userCount))
+	else:
+		# every giver's receivers are needed below anyway
+		allowedReceivers = set()
+		for g in range(userCount):
+			allowedReceivers.update(problem.allowedReceivers(g))
+		hasGiver = allowedReceivers.__contains__
+	for r in range(userCount):
+		if giverOf[r] is None and not hasGiver(r):
+			report.append(f'Receiver {problem.userIDs[r]!r} has no givers allowed')
+	# the checks below would only repeat these users
+	if report:
+		return report
+
+	# Hall's condition: starting from a giver left out of the matching, 
+	# follow its allowed receivers to the givers matched with them, and so
+	# on. Those givers have one less receiver between them than needed.
+	root = assignedUsers.index(None)
+	givers = [root]
+	reached = {root}
+	receivers = set()
+	i_giver = 0
+	while i_giver < len(givers):
+		problem.checkLimits()
+		for r in problem.allowedReceivers(givers[i_giver]):
+			if r not in receivers:
+				receivers.add(r)
+				other = giverOf[r]
+				if other is not None and other not in reached:
+					reached.add(other)
+					givers.append(other)
+		i_giver += 1
+
+	# Two groups that only give to each other: the receivers above, and
+	# everyone else who can only give to them. Each group can only give to
+	# the other, and nobody outside gives to either.
+	# (checking the limits along the way, as each giver's receivers are 
+	# gone through a few times)
+	def receiversOf(g):
+		problem.checkLimits()
+		return problem.allowedReceivers(g)
+	group = [ g for g in range(userCount) 
+		if g not in receivers and receivers.issuperset(receiversOf(g)) ]
+	groupSet = set(group)
+	if (all(groupSet.issuperset(receiversOf(g)) for g in receivers)
+			and all(groupSet.isdisjoint(receiversOf(g)) 
+				and receivers.isdisjoint(receiversOf(g))
+				for g in range(userCount) if g not in groupSet and g not in receivers)):
+		report.append(
+			'Users can only give to the other of two groups (ex: teams),'
+			+ f' but the groups are different sizes: {len(group)}'
+			+ f' ({_describeUsers(problem, group)}) and {len(receivers)}'
+			+ f' ({_describeUsers(problem, receivers)})'
+			)
+
+	report.append(
+		f'These {len(givers)} givers can only give to {len(receivers)} receivers'
+		+ f' between them: givers ({_describeUsers(problem, givers)}),'
+		+ f' receivers ({_describeUsers(problem, receivers)})'
+		)
+	return report
+
+# Matching Engine -------------------------------------------------------
+# For large exchanges (thousands of users). Uses MaximumMatching, raising
+# ResultError right away (with a report) when there's no perfect matching.
+# Closed loops left in the matching are repaired afterwards by swapping
+# receivers with another giver. If a closed loop can't be repaired, the
+# ForwardCheckingEngine finishes the job.
+def MatchingEngine(problem):
+	givers = problem.givers
+	skipReason = problem.skipReason
+	trace = problem.trace
+
+	assignedUsers = MaximumMatching(problem)
+	if None in assignedUsers:
+		raise ResultError(report=ExplainNoResults(problem, assignedUsers))
+
+	# Repair closed loops (a -> b -> a) by joining them with another giver
+	# c -> d, into a -> d, c -> b, b -> a (or the same with a and b swapped)
+	for a in givers:
+		b = assignedUsers[a]
+		if assignedUsers[b] != a:
 			continue
-		elif receiver in giverHistory[giver]:
-			logging.info(f' {giverAttempt_orginal} G - SKIPPING Receiver index {receiver} - Receiver is restricted via Giver History Limit')
+		repaired = False
+		for c in givers:
+			if c == a or c == b:
+				continue
+			d = assignedUsers[c]
+			for first, second in ((a, b), (b, a)):
+				if (assignedUsers[d] != first and skipReason(first, d) is None 
+						and skipReason(c, second) is None):
+					assignedUsers[first] = d
+					assignedUsers[c] = second
+					repaired = True
+					break
+			if repaired:
+				break
+		if not repaired:
+			return ForwardCheckingEngine(problem)
+
+	if trace:
+		for position, giver in enumerate(givers):
+			trace('assign', {'position': position, 'giver': giver, 
+				'receiver': assignedUsers[giver]})
+	return assignedUsers
+
+# Optimal Engine --------------------------------------------------------
+# Uses the compatibility weights as costs, and finds the assignments with
+# the smallest total (f_compatibility: smaller = more likely), instead of
+# only using them to order the receivers. Self, history and restricted 
+# pairs are never used.
+#	- solved as a min-cost assignment: SciPy's linear_sum_assignment when
+#		it's installed, otherwise shortest augmenting paths (Jonker-
+#		Volgenant), done with NumPy when it's installed
+#	- closed loops the assignment leaves are repaired by swapping 
+#		receivers with the giver that raises the total the least. If one 
+#		can't be repaired, the ForwardCheckingEngine finishes the job.
+#	- without weights, every allowed pair costs the same
+#	- noise = adds up to this fraction of the weights' range to every pair
+#		at random, for variety. Ties are always broken at random.
+# Choose noise with a lambda: GiftExchange(engine=lambda p: OptimalEngine(p, noise=0.1))
+# Reference: Jonker & Volgenant, "A Shortest Augmenting Path Algorithm for
+#	Dense and Sparse Linear Assignment Problems" (1987)
+def OptimalEngine(problem, noise=0):
+	userCount = len(problem.users)
+	givers = problem.givers
+	trace = problem.trace
+	numpy = _numpy()
+
+	# costs[giver][receiver], forbidden pairs cost infinity
+	costs = _assignmentCosts(problem, noise, numpy)
+	# Rows in giver order and columns in a random order, so ties are 
+	# broken differently every time
+	columns = list(range(userCount))
+	shuffle(columns)
+	if numpy is not None:
+		cost = costs[numpy.ix_(givers, columns)]
+	else:
+		cost = [ [ costs[g][r] for r in columns ] for g in givers ]
+	try:
+		picked = _minCostAssignment(cost, numpy)
+	except ValueError:
+		picked = None
+	if picked is None:
+		assignedUsers = MaximumMatching(problem)
+		raise ResultError(report=ExplainNoResults(problem, assignedUsers) 
+			if None in assignedUsers else None)
+	assignedUsers = [None] * userCount
+	for row, column in enumerate(picked):
+		assignedUsers[givers[row]] = columns[column]
+
+	# Repair closed loops (a -> b -> a) by joining them with another giver
+	# c -> d, into a -> d, c -> b, b -> a (or the same with a and b swapped),
+	# picking the c that adds the least to the total
+	infinity = float('inf')
+	if numpy is not None:
+		receivers = numpy.asarray(assignedUsers)
+		current = costs[numpy.arange(userCount), receivers]
+	for a in givers:
+		b = assignedUsers[a]
+		if assignedUsers[b] != a:
 			continue
-		elif f_restriction:
-			giver_user = users[giver]
-			receiver_User = users[receiver]
-			if f_restriction(giver_user, receiver_User):
-				logging.info(f' {giverAttempt_orginal} G - SKIPPING Receiver index {receiver} - restricted')
+		best = None
+		for first, second in ((a, b), (b, a)):
+			if numpy is not None:
+				# added[c], for every giver c at once
+				added = (costs[first, receivers] + costs[:, second] 
+					- costs[first, second] - current)
+				added[[a, b]] = infinity
+				added[receivers[receivers] == first] = infinity
+				c = int(added.argmin())
+				if added[c] < infinity and (best is None or added[c] < best[0]):
+					best = (added[c], first, second, c, int(receivers[c]))
 				continue
-		
+			for c in givers:
+				d = assignedUsers[c]
+				if c == a or c == b or assignedUsers[d] == first:
+					continue
+				added = (costs[first][d] + costs[c][second] 
+					- costs[first][second] - costs[c][d])
+				if added < infinity and (best is None or added < best[0]):
+					best = (added, first, second, c, d)
+		if best is None:
+			return ForwardCheckingEngine(problem)
+		added, first, second, c, d = best
+		assignedUsers[first] = d
+		assignedUsers[c] = second
+		if numpy is not None:
+			receivers[first] = d
+			receivers[c] = second
+			current[first] = costs[first, d]
+			current[c] = costs[c, second]
+
+	if trace:
+		for position, giver in enumerate(givers):
+			trace('assign', {'position': position, 'giver': giver, 
+				'receiver': assignedUsers[giver]})
+	return assignedUsers
+
+# costs[giver][receiver] for OptimalEngine, infinity for forbidden pairs
+def _assignmentCosts(problem, noise, numpy):
+	userCount = len(problem.users)
+	f_weightsRow = problem.f_weightsRow
+	infinity = float('inf')
+	if numpy is None:
+		cost = []
+		for giver in range(userCount):
+			weights = f_weightsRow(giver) if f_weightsRow else None
+			cost.append([ infinity if problem.skipReason(giver, receiver) 
+				else (float(weights[receiver]) if weights is not None else 0.0) 
+				for receiver in range(userCount) ])
+		if noise:
+			finite = [ x for row in cost for x in row if x < infinity ]
+			spread = (max(finite) - min(finite)) if finite else 0
+			cost = [ [ x + noise * (spread or 1) * random() for x in row ] for row in cost ]
+		return cost
+
+	if f_weightsRow:
+		cost = numpy.array([ numpy.asarray(f_weightsRow(g), dtype=float) 
+			for g in range(userCount) ])
+	else:
+		cost = numpy.zeros((userCount, userCount))
+	# which pairs are allowed, in user order
+	allowed = numpy.ones((userCount, userCount), dtype=bool)
+	numpy.fill_diagonal(allowed, False)
+	for giver, history in enumerate(problem.giverHistory):
+		if history:
+			allowed[giver, list(history)] = False
+	restrictions = problem.restrictions
+	if restrictions:
+		for giver in range(userCount):
+			row = restrictions.ruleRows[giver]
+			if row is not None:
+				bits = numpy.unpackbits(numpy.frombuffer(bytes(row), dtype=numpy.uint8), 
+					bitorder='little')[:userCount]
+				allowed[giver] &= bits == 0
+			if restrictions.listed is not None and restrictions.listed[giver]:
+				allowed[giver, list(restrictions.listed[giver])] = False
+			if restrictions.f_restriction is not None:
+				for receiver in numpy.flatnonzero(allowed[giver]).tolist():
+					if restrictions.isRestricted(giver, receiver):
+						allowed[giver, receiver] = False
+	if noise and allowed.any():
+		spread = numpy.ptp(cost[allowed]) or 1
+		cost = cost + noise * spread * numpy.random.default_rng(getrandbits(64)).random(cost.shape)
+	cost[~allowed] = infinity
+	return cost
+
+# Columns picked for each row, with the smallest total cost. Raises 
+# ValueError when every assignment uses a pair that costs infinity.
+def _minCostAssignment(cost, numpy):
+	if numpy is not None:
+		try:
+			from scipy.optimize import linear_sum_assignment
+		except ImportError:
+			linear_sum_assignment = None
+		if linear_sum_assignment is not None:
+			rows, picked = linear_sum_assignment(cost)
+			return picked.tolist()
+	size = len(cost)
+	infinity = float('inf')
+	# row and column potentials (dual), kept so that reduced costs
+	# cost[i][j] - u[i] - v[j] are never negative
+	u = [0.0] * size
+	if numpy is not None:
+		v = cost.min(axis=0)
+		v[v == infinity] = 0
+		columnForRow = numpy.full(size, -1)
+		rowForColumn = numpy.full(size, -1)
+		# free rows first take a column that costs nothing extra
+		for row, column in enumerate((cost - v).argmin(axis=1).tolist()):
+			if rowForColumn[column] == -1 and cost[row, column] - v[column] == 0:
+				rowForColumn[column] = row
+				columnForRow[row] = column
+	else:
+		v = [ min(cost[i][j] for i in range(size)) for j in range(size) ]
+		v = [ 0 if x == infinity else x for x in v ]
+		columnForRow = [-1] * size
+		rowForColumn = [-1] * size
+		for row in range(size):
+			reduced = [ cost[row][j] - v[j] for j in range(size) ]
+			column = min(range(size), key=reduced.__getitem__)
+			if rowForColumn[column] == -1 and reduced[column] == 0:
+				rowForColumn[column] = row
+				columnForRow[row] = column
+
+	# every other row: shortest augmenting path (Dijkstra over the reduced
+	# costs) from the row to a free column
+	for start in [ i for i in range(size) if columnForRow[i] == -1 ]:
+		row = start
+		lowest = 0.0
+		visitedRows = []
+		visitedColumns = []
+		if numpy is not None:
+			shortest = numpy.full(size, infinity)
+			path = numpy.full(size, -1)
+			remaining = numpy.ones(size, dtype=bool)
+		else:
+			shortest = [infinity] * size
+			path = [-1] * size
+			remaining = set(range(size))
+		while True:
+			visitedRows.append(row)
+			if numpy is not None:
+				reduced = lowest + cost[row] - u[row] - v
+				better = remaining & (reduced < shortest)
+				shortest[better] = reduced[better]
+				path[better] = row
+				candidates = numpy.where(remaining, shortest, infinity)
+				column = int(candidates.argmin())
+				lowest = candidates[column]
+				if lowest == infinity:
+					raise ValueError('no assignment possible')
+				if rowForColumn[column] != -1:
+					# a free column at the same distance ends the path sooner
+					ties = numpy.flatnonzero(candidates == lowest)
+					free = ties[rowForColumn[ties] == -1]
+					if len(free):
+						column = int(free[0])
+				remaining[column] = False
+			else:
+				for j in remaining:
+					reduced = lowest + cost[row][j] - u[row] - v[j]
+					if reduced < shortest[j]:
+						shortest[j] = reduced
+						path[j] = row
+				column = min(remaining, key=lambda j: (shortest[j], rowForColumn[j] != -1))
+				lowest = shortest[column]
+				if lowest == infinity:
+					raise ValueError('no assignment possible')
+				remaining.discard(column)
+			visitedColumns.append(column)
+			if rowForColumn[column] == -1:
+				break
+			row = rowForColumn[column]
+
+		# update the potentials, then flip the path
+		u[start] += lowest
+		for row in visitedRows[1:]:
+			u[row] += lowest - shortest[columnForRow[row]]
+		for j in visitedColumns:
+			v[j] -= lowest - shortest[j]
+		while True:
+			row = path[column]
+			rowForColumn[column] = row
+			column, columnForRow[row] = columnForRow[row], column
+			if row == start:
+				break
+	return [ int(x) for x in columnForRow ]
+
+# Engines that can be chosen by name, using GiftExchange(engine=...)
+ENGINES = {
+	'backtrack': BacktrackEngine,
+	'forward': ForwardCheckingEngine,
+	'matching': MatchingEngine,
+	'optimal': OptimalEngine,
+	}
+
+# Cycles ----------------------------------------------------------------
+# Every exchange is made of cycles (a -> b -> c -> a). The engines only rule
+# out the shortest, closed loops (a -> b -> a), so GiftExchange's topology
+# and minCycleLength are worked out from their assignments afterwards.
+TOPOLOGIES = ('cycles', 'single_cycle')
+
+# topology 'single_cycle' without history, restrictions or weights: the
+# givers' random order is the cycle, O(users)
+def SingleCycle(problem, minCycleLength=3):
+	givers = problem.givers
+	if len(givers) < minCycleLength:
+		raise ResultError
+	assignedUsers = [None] * len(givers)
+	for position, giver in enumerate(givers):
+		assignedUsers[giver] = givers[(position + 1) % len(givers)]
+		if problem.trace:
+			problem.trace('assign', {'position': position, 'giver': giver, 
+				'receiver': assignedUsers[giver]})
+	return assignedUsers
+
+# Joins the cycles of assignedUsers until none are shorter than 
+# minCycleLength, and only one is left when singleCycle. The shortest
+# cycle left is joined with another by a giver in it swapping receivers:
+#	- with a giver in another cycle: a -> b, c -> d becomes a -> d, c -> b
+#		(two cycles become one)
+#	- otherwise with two givers in another cycle: a -> b, c -> d, e -> f 
+#		becomes a -> d, c -> f, e -> b, which takes d to e into the cycle 
+#		and leaves the rest of the other cycle as it's own
+# Receivers are tried in each giver's randomized order. Every swap counts 
+# as an attempt in problem.limits.
+# A single cycle with rules may not be found even when one exists (it's
+# NP-hard): ResultError after maxSwaps swaps, or when no swap is allowed.
+def JoinCycles(problem, assignedUsers, minCycleLength=3, singleCycle=False, maxSwaps=None):
+	userCount = len(assignedUsers)
+	skipReason = problem.skipReason
+	limits = problem.limits
+	trace = problem.trace
+	if maxSwaps is None:
+		maxSwaps = 100 + 4 * userCount
+	assignedUsers = list(assignedUsers)
+	giverOf = [None] * userCount
+	for g, r in enumerate(assignedUsers):
+		giverOf[r] = g
+
+	# cycleOf[giver] = id of their cycle (one of its givers), 
+	# cycles[id] = the cycle's givers
+	# lengths = heap of (length, id), with old ones left in it
+	cycleOf = [None] * userCount
+	cycles = {}
+	lengths = []
+	def newCycle(members):
+		for g in members:
+			cycleOf[g] = members[0]
+		cycles[members[0]] = members
+		heapq.heappush(lengths, (len(members), members[0]))
+	for giver in problem.givers:
+		if cycleOf[giver] is None:
+			newCycle(_cycleOf(assignedUsers, giver))
+
+	def give(giver, receiver):
 		assignedUsers[giver] = receiver
-		receiversExhausted = True
-		logging.info(f' {giverAttempt_orginal} G - ASSIGNING Receiver  g{giver}:r{receiver}, current assignments: {assignedUsers}\n')
+		giverOf[receiver] = giver
+		if trace:
+			trace('assign', {'position': problem.givers.index(giver), 'giver': giver, 
+				'receiver': receiver})
 
-	#------------------------------------------------------------
+	# Swaps the shortest cycle into another one, False when no swap is allowed
+	def join(cycle):
+		# a -> d, c -> b
+		for a in cycle:
+			b = assignedUsers[a]
+			k = 0
+			d = problem.allowedReceiver(a, k)
+			while d is not None:
+				c = giverOf[d]
+				if cycleOf[c] != cycleOf[a] and skipReason(c, b) is None:
+					give(a, d)
+					give(c, b)
+					small, big = sorted((cycleOf[a], cycleOf[c]), key=lambda x: len(cycles[x]))
+					for g in cycles[small]:
+						cycleOf[g] = big
+					cycles[big] += cycles.pop(small)
+					heapq.heappush(lengths, (len(cycles[big]), big))
+					return True
+				k += 1
+				d = problem.allowedReceiver(a, k)
+		# a -> d, c -> f, e -> b
+		for a in cycle:
+			b = assignedUsers[a]
+			k = 0
+			d = problem.allowedReceiver(a, k)
+			while d is not None:
+				c = giverOf[d]
+				if cycleOf[c] != cycleOf[a]:
+					for e in cycles[cycleOf[c]]:
+						f = assignedUsers[e]
+						if e != c and skipReason(e, b) is None and skipReason(c, f) is None:
+							give(a, d)
+							give(c, f)
+							give(e, b)
+							# c -> f ... -> c is left, the rest joins a's cycle
+							other = cycles.pop(cycleOf[c])
+							left = _cycleOf(assignedUsers, c)
+							leftSet = set(left)
+							taken = [ g for g in other if g not in leftSet ]
+							for g in taken:
+								cycleOf[g] = cycleOf[a]
+							cycles[cycleOf[a]] += taken
+							heapq.heappush(lengths, (len(cycles[cycleOf[a]]), cycleOf[a]))
+							newCycle(left)
+							return True
+				k += 1
+				d = problem.allowedReceiver(a, k)
+		return False
+
+	for _ in range(maxSwaps):
+		length, cycleID = lengths[0]
+		while cycleID not in cycles or len(cycles[cycleID]) != length:
+			heapq.heappop(lengths)
+			length, cycleID = lengths[0]
+		if length >= minCycleLength and not (singleCycle and len(cycles) > 1):
+			return assignedUsers
+		cycle = cycles[cycleID]
+		if limits:
+			limits.attempt(userCount)
+		if len(cycle) == userCount or not join(cycle):
+			break
+	what = 'a single cycle' if singleCycle else f'cycles of at least {minCycleLength} users'
+	raise ResultError(report=[f'The assignments could not be joined into {what}'])
+
+# Joins cycles of assignedUsers at random, so givers aren't only assigned
+# receivers from their own part of the exchange (see 
+# PreparedExchange.blockSolve). Each giver gets one try at swapping 
+# receivers with a random giver in another cycle (a -> b, c -> d becomes 
+# a -> d, c -> b), when both are allowed. Joining never makes a cycle 
+# shorter, so topology and minCycleLength still hold.
+def MixCycles(problem, assignedUsers):
+	userCount = len(assignedUsers)
+	skipReason = problem.skipReason
+	# cycleOf[giver] = a giver in their cycle, before any were joined
+	cycleOf = [None] * userCount
+	for giver in range(userCount):
+		if cycleOf[giver] is None:
+			for g in _cycleOf(assignedUsers, giver):
+				cycleOf[g] = giver
+	# joined[cycle] = cycle it was joined into (union-find)
+	joined = list(range(userCount))
+	def find(cycle):
+		while joined[cycle] != cycle:
+			joined[cycle] = joined[joined[cycle]]
+			cycle = joined[cycle]
+		return cycle
+
+	for a in problem.givers:
+		c = int(random() * userCount)
+		first = find(cycleOf[a])
+		second = find(cycleOf[c])
+		if first == second:
+			continue
+		b = assignedUsers[a]
+		d = assignedUsers[c]
+		if skipReason(a, d) is None and skipReason(c, b) is None:
+			assignedUsers[a] = d
+			assignedUsers[c] = b
+			joined[first] = second
+	return assignedUsers
+
+# The givers in the cycle that includes the giver, in order
+def _cycleOf(assignedUsers, giver):
+	cycle = [giver]
+	receiver = assignedUsers[giver]
+	while receiver != giver:
+		cycle.append(receiver)
+		receiver = assignedUsers[receiver]
+	return cycle
+
+# Prepared Exchange -----------------------------------------------------
+# Everything GiftExchange works out before searching, kept so more than one
+# search can share it (see GiftExchangeBatch). Takes the same parameters as
+# GiftExchange, which must already be validated.
+class PreparedExchange():
+	def __init__ (self, 
+			users, 
+			f_uniqueID,
+			history, 
+			historyLimit, 
+			history_ParticipationRequired,
+			f_compatibility,
+			f_restriction,
+			trace,
+			engine,
+			precheck,
+			compatibilityWeights,
+			restrictionRules,
+			workers,
+			timeout,
+			maxAttempts,
+			restarts,
+			relax,
+			relaxOrder,
+			stats,
+			topology,
+			minCycleLength,
+			blockSize,
+			ruleProvider,
+			validate,
+			**unused
+			):
+		# the ruleProvider's methods (see Rule Providers), None for any it 
+		# doesn't have
+		f_restrictionsFor = getattr(ruleProvider, 'restrictionsFor', None)
+		f_providedRow = getattr(ruleProvider, 'weightsRow', None)
+
+		# ExchangeStats, None when they aren't wanted. The lambdas are
+		# swapped for ones counting their calls.
+		self.stats = None
+		if stats:
+			self.stats = ExchangeStats()
+			self.stats.switch('setup')
+			f_uniqueID = self.stats.counted('f_uniqueID', f_uniqueID)
+			if f_compatibility:
+				f_compatibility = self.stats.counted('f_compatibility', f_compatibility)
+			if f_restriction:
+				f_restriction = self.stats.counted('f_restriction', f_restriction)
+			if f_restrictionsFor:
+				f_restrictionsFor = self.stats.counted('restrictionsFor', f_restrictionsFor)
+			if f_providedRow:
+				f_providedRow = self.stats.counted('weightsRow', f_providedRow)
+			if isinstance(compatibilityWeights, FeatureWeights):
+				compatibilityWeights = FeatureWeights(
+					self.stats.counted('f_feature', compatibilityWeights.f_feature),
+					compatibilityWeights.compare)
+			if restrictionRules:
+				f_attribute = lambda rule: self.stats.counted('f_attribute', rule.f_attribute)
+				restrictionRules = [ AttributeRestriction(f_attribute(x), x.same, x.name) 
+					for x in restrictionRules ]
+
+		self.users = users
+		self.f_uniqueID = f_uniqueID
+		self.workers = workers
+		self.timeout = timeout
+		self.maxAttempts = maxAttempts
+		self.restarts = restarts
+		# SearchLimits of the current search
+		self.limits = None
+		# threading.Event set to stop the search, see GiftExchangeAsync
+		self.cancelled = None
+		self.trace = trace
+		self.engine = ENGINES[engine] if isinstance(engine, str) else engine
+		self.precheck = precheck
+		self.prechecked = False
+		self.topology = topology
+		self.minCycleLength = minCycleLength
+		self.blockSize = blockSize
+		self.history_ParticipationRequired = history_ParticipationRequired
+
+		#------------------------------------------------------------
+		# history_ParticipationRequired == TRUE, exchange focused
+		#	Regardless of a user's participation in prior Exchanges
+		#	the historyLimit relates to the number of exchanges that occurred
+		# history_ParticipationRequired == FALSE, user focused
+		# 	Tracks the history of the user ONLY for the times they participated.
+		#	Meaning user's who don't participate often are still 
+		#	not assigned people they've given to in the last X exchanges
+		#	where x == historyLimit
+		
+		self.userIDs = userIDs = [ f_uniqueID(x) for x in users ]
+
+		# Dictionary of users in current exchanges
+		#	key = the user's uniqueID
+		#	value = index of that user in Users parameter
+		self.userIndexes = dict((v, i) for i, v in enumerate(userIDs))
+		# left to here by validate='fast', as the IDs are worked out anyway
+		if validate == 'fast' and len(self.userIndexes) != len(userIDs):
+			raise ValidationError('List of Users must be unique by ID.')
+
+		# For each user, the receivers (index in users) they gave to in
+		# prior exchanges, see _historySet
+		self.giverHistory = [_NO_HISTORY] * len(users)
+		# Same, as array('i') of how recent, receiver, how recent, ... 
+		# (0 = most recent). Used to lower the historyLimit without looking
+		# through the history again.
+		self.historyRanks = [_NO_HISTORY] * len(users)
+		# historyWindows[giver] = their recent recipients, as given by 
+		# history.recentRecipients (IDs, whether they're users or not)
+		self.historyWindows = [()] * len(users)
+
+		# history = the history parameter, None without one. A list isn't 
+		# indexed, only looked through as far as it's needed (see _recentInList)
+		self._phase('history')
+		self.history = history or None
+		
+		if historyLimit >0 and history:
+			for i_user, recent in enumerate(self.recentRecipients(userIDs, historyLimit)):
+				if recent:
+					self.historyWindows[i_user] = recent
+				if trace:
+					for i_hist, recipientID in recent:
+						trace('history', {'exchange': i_hist, 'giver': i_user,
+							'recipient': self.userIndex(recipientID)})
+				self._resolveHistory(i_user)
+
+		#------------------------------------------------------------
+		# f_weightsRow = lambda returning a giver's weights, weights[receiver] 
+		# f_weight = lambda returning the weight of one giver/receiver pair
+		#	Smaller = more likely (see f_compatibility)
+		#	features = each user's f_feature, with FeatureWeights
+		#	f_newRow = with f_compatibility or ruleProvider.weightsRow, 
+		#		lambda working out a giver's weights (see weightsRow)
+		#	weightRows = the rows from f_newRow, kept once they're worked 
+		#		out, None when they aren't kept (see keepWeightRows)
+		self._phase('weights')
+		self.compatibilityWeights = compatibilityWeights
+		self.f_weightsRow = None
+		self.f_weight = None
+		self.features = None
+		self.f_newRow = None
+		self.weightRows = None
+		if f_compatibility:
+			self.f_newRow = lambda giver: [ f_compatibility(users[giver], x) for x in users ]
+		elif isinstance(compatibilityWeights, FeatureWeights):
+			self.features = [ compatibilityWeights.f_feature(x) for x in users ]
+			self.f_weightsRow = compatibilityWeights.rows(users, self.features)
+			self.f_weight = compatibilityWeights.pairs(users, self.features)
+		elif compatibilityWeights is not None:
+			self.f_weightsRow = lambda giver: compatibilityWeights[giver]
+			self.f_weight = lambda giver, receiver: compatibilityWeights[giver][receiver]
+		elif f_providedRow:
+			self.f_newRow = lambda giver: f_providedRow(users[giver])
+		if self.f_newRow is not None:
+			self.f_weightsRow = self.weightsRow
+			self.f_weight = lambda giver, receiver: self.weightsRow(giver)[receiver]
+
+		self._phase('restrictions')
+		self.f_restrictionsFor = f_restrictionsFor
+		self.f_providedRow = f_providedRow
+		self.restrictions = None
+		if f_restriction or restrictionRules or f_restrictionsFor:
+			self.restrictions = RestrictionMatrix(users, f_restriction, restrictionRules,
+				self.listedPairs() if f_restrictionsFor else None)
+		self._phase('setup')
+
+		# Relaxing (see relaxedSolve): what's left to relax, and what has been
+		self.relax = relax
+		self.relaxSteps = []
+		if relax:
+			self.relaxSteps = [ ('historyLimit', x) for x in range(historyLimit - 1, -1, -1) ]
+			self.relaxSteps += [ ('dropped', name) for name in relaxOrder ]
+		self.historyLimit = historyLimit
+		self.droppedRules = []
+
+		# Filled in as they're needed
+		self.historyGaps = None
+		self._phase(None)
+
+	# Works out giverHistory and historyRanks of the giver from their
+	# historyWindows, only keeping the recipients that are users
+	def _resolveHistory(self, giver):
+		ranks = array('i')
+		for i_recent, (i_hist, recipientID) in enumerate(self.historyWindows[giver]):
+			recipient = self.userIndex(recipientID)
+			if recipient is not None:
+				rank = i_recent if self.history_ParticipationRequired else i_hist
+				ranks.extend((rank, recipient))
+		self.historyRanks[giver] = ranks or _NO_HISTORY
+		self.giverHistory[giver] = _historySet(ranks[1::2])
+
+	# The giver's row of weights from f_newRow. Only worked out the first
+	# time it's asked for once keepWeightRows has been called, otherwise 
+	# every time, so a single search doesn't keep users x users weights.
+	def weightsRow(self, giver):
+		if self.weightRows is None:
+			return self.f_newRow(giver)
+		row = self.weightRows[giver]
+		if row is None:
+			row = self.weightRows[giver] = self.f_newRow(giver)
+		return row
+
+	# Keeps the rows from f_newRow from now on: every search after the 
+	# first (GiftExchangeBatch) and score() use the same rows, instead of 
+	# calling f_compatibility for every pair (or ruleProvider.weightsRow for
+	# every giver) again. Takes users x users memory once every giver's row
+	# is drawn, the same as a compatibilityWeights grid.
+	def keepWeightRows(self):
+		if self.f_newRow is not None and self.weightRows is None:
+			self.weightRows = [None] * len(self.users)
+
+	# Each user's recent recipients (see HistoryIndex.recentRecipients),
+	# the windows lined up with userIDs
+	def recentRecipients(self, userIDs, historyLimit):
+		if isinstance(self.history, (HistoryIndex, HistoryStore, HistoryArchive)):
+			return [ self.history.recentRecipients(userID, historyLimit, 
+				self.history_ParticipationRequired) for userID in userIDs ]
+		return _recentInList(self.history, userIDs, historyLimit, 
+			self.history_ParticipationRequired)
+
+	# The ruleProvider's restricted pairs, as (giver, receiver) indexes in 
+	# users, leaving out the IDs that aren't users
+	def listedPairs(self):
+		pairs = []
+		for giverID, receiverID in self.f_restrictionsFor(self.users):
+			giver = self.userIndex(giverID)
+			receiver = self.userIndex(receiverID)
+			if giver is not None and receiver is not None:
+				pairs.append((giver, receiver))
+		return pairs
+
+	# Starts timing the phase (None to stop), when there are stats
+	def _phase(self, phase):
+		if self.stats:
+			return self.stats.switch(phase)
+
+	# Index in users of the uniqueID, None if it isn't one of the users
+	def userIndex(self, userID):
+		try: 
+			return self.userIndexes.get(userID)
+		except TypeError: # ID can't be hashed
+			return None
+
+	# A new ExchangeProblem, with its own random order of givers and receivers
+	def newProblem(self):
+		previous = self._phase('shuffle')
+		givers = array('i', range(len(self.users)))
+		shuffle(givers)
+		if self.trace:
+			self.trace('giver_order', {'givers': list(givers)})
+
+		# ReceiverOrders (acts like a list)
+		# - the list index matches that of the index of a giver in the list of Users
+		# - each item in this list, is a randomized list of receivers (their index in the list of Users)
+		#	drawn as they're needed
+		receivers_byGiver = ReceiverOrders(len(self.users), self.f_weightsRow, self.stats)
+		if self.trace:
+			self.trace('receiver_orders', {'receivers_byGiver': [ list(x) for x in receivers_byGiver ]})
+
+		self._phase(previous)
+		return ExchangeProblem(self.users, self.userIDs, givers, receivers_byGiver, 
+			self.giverHistory, restrictions=self.restrictions, trace=self.trace,
+			limits=self.limits, f_weightsRow=self.f_weightsRow)
+
+	# Finds one set of assignments (assignedUsers, see ExchangeProblem)
+	#	problem = ExchangeProblem to search, None for a new one
+	def solve(self, problem=None):
+		self.limits = None
+		if (self.timeout is not None or self.maxAttempts is not None or self.restarts 
+				or self.stats or self.cancelled is not None):
+			self.limits = SearchLimits(len(self.users), self.timeout, self.maxAttempts, 
+				self.restarts, self.cancelled)
+		if problem is None:
+			problem = self.newProblem()
+		problem.limits = self.limits
+		try:
+			split = self._split(problem)
+			if (self.precheck and not self.prechecked and not split 
+					and not self._anySingleCycle(problem)):
+				self._phase('precheck')
+				Precheck(problem)
+				# whether an exchange is possible doesn't change between searches
+				self.prechecked = True
+			if self.limits:
+				self.limits.checkCancelled()
+			self._phase('search')
+			if split:
+				return self.blockSolve(problem)
+			if self.workers > 1 and _canFork():
+				return self.race()
+			return self.search(problem)
+		finally:
+			if self.stats:
+				self.stats.switch(None)
+				self.stats.addSearch(self.limits)
+
+	def search(self, problem):
+		while True:
+			try:
+				assignedUsers = self.assign(problem)
+				break
+			except _RestartSearch:
+				# start over with a new random order
+				self.limits.restart()
+				problem = self.newProblem()
+		if self.trace:
+			self.trace('result', {'assignedUsers': list(assignedUsers)})
+		return assignedUsers
+
+	# The engine's assignments for the problem, in the topology and 
+	# minCycleLength asked for (see Cycles)
+	def assign(self, problem):
+		singleCycle = self.topology == 'single_cycle'
+		if self._anySingleCycle(problem):
+			return SingleCycle(problem, self.minCycleLength)
+		assignedUsers = self.engine(problem)
+		if singleCycle or self.minCycleLength > 3:
+			assignedUsers = JoinCycles(problem, assignedUsers, self.minCycleLength, singleCycle)
+		return assignedUsers
+
+	# topology 'single_cycle' without history, restrictions or weights: 
+	# any order of the givers will do, so there's nothing to search or check
+	def _anySingleCycle(self, problem):
+		return (self.topology == 'single_cycle' and problem.restrictions is None 
+			and problem.f_weightsRow is None and not any(problem.giverHistory))
+
+	# Whether the problem is split into blocks (GiftExchange's blockSize)
+	def _split(self, problem):
+		return (self.blockSize is not None and len(self.users) > self.blockSize
+			and not self._anySingleCycle(problem))
+
+	# The users split into blocks of about blockSize users, the sizes 
+	# differing by one at most. Givers with the same restrictionRules 
+	# values (ex: a team) are dealt out to the blocks in turn, so every 
+	# block gets its share of each and can be solved on its own.
+	def blocks(self, problem):
+		count = -(-len(self.users) // self.blockSize)
+		order = list(problem.givers)
+		if problem.restrictions and problem.restrictions.ruleKeys:
+			ruleKeys = problem.restrictions.ruleKeys
+			groups = {}
+			for giver in order:
+				groups.setdefault(ruleKeys[giver], []).append(giver)
+			order = [ giver for group in groups.values() for giver in group ]
+		return [ order[i::count] for i in range(count) ]
+
+	# Splits the exchange into blocks (see blocks), finds assignments for
+	# each block on its own (in worker processes, with workers), then joins
+	# their cycles so givers can have receivers from other blocks (see 
+	# MixCycles, or JoinCycles for a single cycle).
+	# A block without assignments is merged with the next one and tried 
+	# again, so there's no exchange only once every block is merged into one.
+	# Blocks aren't traced, only the result.
+	def blockSolve(self, problem):
+		blocks = self.blocks(problem)
+		if self.workers > 1 and _canFork():
+			answers = self._forkBlocks(problem, blocks)
+		else:
+			answers = [ self._tryBlock(problem, block) for block in blocks ]
+		i_block = 0
+		while i_block < len(blocks):
+			if not isinstance(answers[i_block], ResultError):
+				i_block += 1
+				continue
+			if len(blocks) == 1:
+				raise answers[0]
+			i_block = min(i_block, len(blocks) - 2)
+			blocks[i_block:i_block + 2] = [blocks[i_block] + blocks[i_block + 1]]
+			answers[i_block:i_block + 2] = [self._tryBlock(problem, blocks[i_block])]
+
+		assignedUsers = [None] * len(self.users)
+		for block, receivers in zip(blocks, answers):
+			for giver, receiver in zip(block, receivers):
+				assignedUsers[giver] = receiver
+		if self.topology == 'single_cycle':
+			assignedUsers = JoinCycles(problem, assignedUsers, self.minCycleLength, True)
+		else:
+			assignedUsers = MixCycles(problem, assignedUsers)
+		if self.trace:
+			self.trace('result', {'assignedUsers': list(assignedUsers)})
+		return assignedUsers
+
+	# Receivers (index in users) of the block's givers, in the same order,
+	# or the ResultError when the block has no assignments
+	def _tryBlock(self, problem, block):
+		while True:
+			blockProblem = self._blockProblem(problem, block)
+			try:
+				if self.precheck:
+					Precheck(blockProblem)
+				return [ block[r] for r in self.assign(blockProblem) ]
+			except _RestartSearch:
+				self.limits.restart()
+			except SearchLimitError:
+				raise
+			except ResultError as e:
+				return e
+
+	# ExchangeProblem of only the users in the block (user i = block[i]),
+	# with a new random order
+	def _blockProblem(self, problem, block):
+		local = dict((g, i) for i, g in enumerate(block))
+		giverHistory = [ _historySet(local[r] for r in problem.giverHistory[g] if r in local)
+			for g in block ]
+		restrictions = problem.restrictions.subset(block) if problem.restrictions else None
+		f_weightsRow = None
+		if problem.f_weightsRow:
+			def f_weightsRow(giver, f_row=problem.f_weightsRow):
+				row = f_row(block[giver])
+				return [ row[r] for r in block ]
+		givers = array('i', range(len(block)))
+		shuffle(givers)
+		return ExchangeProblem([ self.users[g] for g in block ], 
+			[ self.userIDs[g] for g in block ], givers, 
+			ReceiverOrders(len(block), f_weightsRow, self.stats), giverHistory, 
+			restrictions=restrictions, limits=self.limits, f_weightsRow=f_weightsRow)
+
+	# _tryBlock for every block, shared between worker processes (forked,
+	# the same as race). Their counts
+	# (see stats) are added to this process's.
+	def _forkBlocks(self, problem, blocks):
+		global _blockExchange
+		_blockExchange = (self, problem, blocks)
+		import multiprocessing
+		context = multiprocessing.get_context('fork')
+		workers = []
+		lambdaCalls = dict(self.stats.lambdaCalls) if self.stats else None
+		answers = [None] * len(blocks)
+		try:
+			processes = min(self.workers, len(blocks))
+			for i_worker in range(processes):
+				reader, writer = context.Pipe(duplex=False)
+				worker = context.Process(target=_blockSearch, 
+					args=(getrandbits(64), range(i_worker, len(blocks), processes), writer), 
+					daemon=True)
+				worker.start()
+				writer.close()
+				workers.append((worker, reader))
+			for worker, reader in workers:
+				self._wait([reader])
+				try:
+					found, failed, limits, calls = reader.recv()
+				except EOFError: # the worker ended without answering
+					raise ResultError('Error: a block ended without an answer.')
+				if failed is not None:
+					raise failed
+				for i_block, answer in found:
+					answers[i_block] = answer
+				if limits is not None:
+					self.limits.addCounts(limits)
+				if self.stats:
+					for name, count in calls.items():
+						self.stats.lambdaCalls[name] = (self.stats.lambdaCalls.get(name, 0) 
+							+ count - lambdaCalls.get(name, 0))
+			return answers
+		finally:
+			for worker, reader in workers:
+				worker.terminate()
+				worker.join()
+				reader.close()
+			_blockExchange = None
+
+	# Same as solve, but when there are no assignment combinations, relaxes
+	# the rules one step at a time until there are (GiftExchange's relax):
+	#	- historyLimit, one exchange at a time down to 0
+	#	- then the rules named in relaxOrder, dropped in that order
+	# Each step keeps the same random order, restrictions compiled so far,
+	# and the assignments the precheck matched (rules only get looser, so 
+	# they're still allowed), so only the difference is worked out again.
+	# Relaxed rules stay relaxed for later calls, see historyLimit and 
+	# droppedRules.
+	def relaxedSolve(self):
+		problem = self.newProblem()
+		while True:
+			try:
+				return self.solve(problem)
+			except SearchLimitError:
+				raise
+			except ResultError:
+				if not self.relaxSteps:
+					raise
+			self._phase('relax')
+			kind, value = self.relaxSteps.pop(0)
+			if kind == 'historyLimit':
+				self.historyLimit = value
+				self.giverHistory = [ 
+					_historySet(r for rank, r in zip(ranks[::2], ranks[1::2]) if rank < value)
+					for ranks in self.historyRanks ]
+			else:
+				self.droppedRules.append(value)
+				dropping = [ rule for rule, values, rows in self.restrictions.compiledRules 
+					if rule.name == value ]
+				self.restrictions = self.restrictions.without(dropping, 
+					dropFunction=value == 'f_restriction', dropListed=value == 'ruleProvider')
+			if self.trace:
+				self.trace('relax', {kind: value})
+			self.prechecked = False
+			relaxed = ExchangeProblem(self.users, self.userIDs, problem.givers, 
+				problem.receivers_byGiver, self.giverHistory, 
+				restrictions=self.restrictions, trace=self.trace, 
+				f_weightsRow=self.f_weightsRow)
+			relaxed.startMatching = problem.matching
+			problem = relaxed
+			self._phase(None)
+
+	# Runs one search per worker process, each with its own random order of
+	# givers and receivers, and keeps whichever finishes first. How long a
+	# search takes depends a lot on its order, so the fastest of several is
+	# far more predictable than any one of them.
+	#	- the worker processes are forked, so they share everything prepared
+	#		so far instead of copying it to each one (lambdas can't be copied)
+	#	- the other searches are stopped as soon as one finishes
+	#	- each worker sends its answer down its own pipe, so stopping the
+	#		others can't leave a lock they share held
+	def race(self):
+		global _racingExchange
+		_racingExchange = self
+		import multiprocessing
+		context = multiprocessing.get_context('fork')
+		workers = []
+		try:
+			for _ in range(self.workers):
+				reader, writer = context.Pipe(duplex=False)
+				worker = context.Process(target=_raceSearch, 
+					args=(getrandbits(64), writer), daemon=True)
+				worker.start()
+				writer.close()
+				workers.append((worker, reader))
+			readers = [ reader for worker, reader in workers ]
+			while readers:
+				for reader in self._wait(readers):
+					readers.remove(reader)
+					try:
+						failed, answer, limits, lambdaCalls = reader.recv()
+					except EOFError: # the worker ended without answering
+						continue
+					# the search's counts (see stats) are the worker's
+					if limits is not None:
+						self.limits = limits
+					if self.stats:
+						self.stats.lambdaCalls.update(lambdaCalls)
+					# a search that fails has tried every combination, so the 
+					# ResultError it raises is the answer for all of them
+					if failed:
+						raise answer
+					return answer
+			raise ResultError('Error: every search ended without an answer.')
+		finally:
+			for worker, reader in workers:
+				worker.terminate()
+				worker.join()
+				reader.close()
+			_racingExchange = None
+
+	# The readers (of worker processes' pipes) with something to read, 
+	# waiting until there's one. Checks every cancelPoll seconds whether 
+	# the search was cancelled, when it can be.
+	cancelPoll = 0.05
+	def _wait(self, readers):
+		import multiprocessing.connection
+		while True:
+			ready = multiprocessing.connection.wait(readers, 
+				None if self.cancelled is None else self.cancelPoll)
+			if ready:
+				return ready
+			self.limits.checkCancelled()
+
+	# assignedUsers as a dictionary of uniqueIDs (output of GiftExchange)
+	def results(self, assignedUsers):
+		previous = self._phase('results')
+		if self.relax:
+			results = RelaxedResults(self.historyLimit, self.droppedRules)
+		elif self.stats:
+			results = ExchangeResults()
+		else:
+			results = {}
+		for giverIndex, recieverIndex in enumerate(assignedUsers):
+			results[self.userIDs[giverIndex]] = self.userIDs[recieverIndex]
+		if self.stats:
+			self.stats.switch(previous)
+			results.stats = self.stats.stats()
+		return results
+
+	# How good assignedUsers is, as a dictionary
+	#	compatibility = total weight of the pairs, None without weights
+	#		(smaller = more likely, see f_compatibility)
+	#	minHistoryGap = fewest exchanges since a giver last had the same 
+	#		receiver, None if no one has had their receiver before.
+	#		Counted the same way as historyLimit: 1 = the last exchange
+	def score(self, assignedUsers):
+		compatibility = None
+		if self.f_weight:
+			self.keepWeightRows()
+			compatibility = sum(self.f_weight(g, r) for g, r in enumerate(assignedUsers))
+
+		if self.historyGaps is None:
+			# historyGaps[giver] = {receiver: exchanges since the giver last had them}
+			self.historyGaps = [ {} for _ in self.users ]
+			if self.history is not None:
+				# Every exchange the history has, not just the historyLimit
+				if isinstance(self.history, HistoryStore):
+					allExchanges = self.history.historyLimit
+				elif isinstance(self.history, HistoryArchive):
+					allExchanges = self.history.exchangeCount
+				elif isinstance(self.history, HistoryIndex):
+					allExchanges = len(self.history.history)
+				else:
+					allExchanges = len(self.history)
+				windows = self.recentRecipients(self.userIDs, allExchanges)
+				for i_user, recent in enumerate(windows):
+					gaps = self.historyGaps[i_user]
+					for i_recent, (i_hist, recipientID) in enumerate(recent):
+						gap = i_recent + 1 if self.history_ParticipationRequired else i_hist + 1
+						recipient = self.userIndex(recipientID)
+						if recipient is not None and recipient not in gaps:
+							gaps[recipient] = gap
+		gaps = [ self.historyGaps[g][r] for g, r in enumerate(assignedUsers) 
+			if r in self.historyGaps[g] ]
+		return {
+			'compatibility': compatibility,
+			'minHistoryGap': min(gaps) if gaps else None,
+			}
+
+# Results of GiftExchange(stats=True): the usual dictionary of assignments
+#	stats = ExchangeStats.stats(), up to and including these results
+class ExchangeResults(dict):
+	stats = None
+
+# Results of GiftExchange(relax=True): the usual dictionary of assignments,
+# plus the rules that had to be relaxed to find them
+#	historyLimit = historyLimit the assignments follow
+#	droppedRules = names of the rules dropped (see relaxOrder), in order
+class RelaxedResults(ExchangeResults):
+	def __init__ (self, historyLimit, droppedRules):
+		super().__init__()
+		self.historyLimit = historyLimit
+		self.droppedRules = list(droppedRules)
+
+# Whether worker processes can be forked (see PreparedExchange.race)
+def _canFork():
+	import multiprocessing
+	return 'fork' in multiprocessing.get_all_start_methods()
+
+# PreparedExchange.race: the exchange being raced, and the search run by
+# each worker process. Sends (failed, assignedUsers or the exception, 
+# SearchLimits, lambdaCalls of ExchangeStats).
+_racingExchange = None
+
+# PreparedExchange._forkBlocks: the (exchange, problem, blocks) being 
+# solved, and the blocks (indexes) solved by each worker process. Sends (list of
+# (index of block, answer of _tryBlock), exception that stopped it or None,
+# SearchLimits, lambdaCalls of ExchangeStats).
+_blockExchange = None
+
+def _blockSearch(randomSeed, indexes, connection):
+	seed(randomSeed)
+	exchange, problem, blocks = _blockExchange
+	if exchange.limits:
+		exchange.limits = exchange.limits.fork()
+	found = []
+	failed = None
+	try:
+		for i_block in indexes:
+			found.append((i_block, exchange._tryBlock(problem, blocks[i_block])))
+	except Exception as e:
+		failed = e
+	lambdaCalls = exchange.stats.lambdaCalls if exchange.stats else None
+	connection.send((found, failed, exchange.limits, lambdaCalls))
+	connection.close()
+
+def _raceSearch(randomSeed, connection):
+	seed(randomSeed)
+	exchange = _racingExchange
+	try:
+		answer = (False, exchange.search(exchange.newProblem()))
+	except Exception as e:
+		answer = (True, e)
+	lambdaCalls = exchange.stats.lambdaCalls if exchange.stats else None
+	connection.send(answer + (exchange.limits, lambdaCalls))
+	connection.close()
+
+def GiftExchange (
+		users, 
+		f_uniqueID=lambda x: x,
+		history=[], 
+		historyLimit=0, 
+		history_ParticipationRequired=False,
+		f_compatibility=None,
+		f_restriction=None,
+		minUsers=3,
+		maxUsers=50,
+		trace=None,
+		engine='backtrack',
+		precheck=False,
+		compatibilityWeights=None,
+		restrictionRules=[],
+		workers=1,
+		timeout=None,
+		maxAttempts=None,
+		restarts=None,
+		relax=False,
+		relaxOrder=[],
+		stats=False,
+		topology='cycles',
+		minCycleLength=3,
+		blockSize=None,
+		ruleProvider=None,
+		validate='full',
+		):
+	# validate input---------------------------------------------
+	errors = ValidateParameters(**locals())
+
+	if errors:
+		raise ValidationError(errors)
+	
+	exchange = PreparedExchange(**locals())
+	if relax:
+		return exchange.results(exchange.relaxedSolve())
+	return exchange.results(exchange.solve())
+
+# Finds k sets of assignments, sharing all the work done before the search
+# (validation, history, weights, restrictions), and scores each one.
+#	k = number of exchanges to make
+#	parameters = same as GiftExchange
+# Returns a list of k dictionaries, best first
+#	results = same as the output of GiftExchange
+#	compatibility, minHistoryGap = see PreparedExchange.score
+# Best = biggest minHistoryGap (None, no repeats, is best of all), then the
+# smallest compatibility (more likely pairs, see f_compatibility).
+def GiftExchangeBatch(users, k=10, **parameters):
+	if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+		raise ValidationError('Parameter, k, must be a positive Integer')
+	parameters = _withDefaults(users, parameters)
+	errors = ValidateParameters(**parameters)
+	if errors:
+		raise ValidationError(errors)
+
+	exchange = PreparedExchange(**parameters)
+	exchange.keepWeightRows()
+	candidates = []
+	for _ in range(k):
+		assignedUsers = exchange.relaxedSolve() if exchange.relax else exchange.solve()
+		candidate = { 'results': exchange.results(assignedUsers) }
+		candidate.update(exchange.score(assignedUsers))
+		candidates.append(candidate)
+
+	infinity = float('inf')
+	candidates.sort(key=lambda x: (
+		-(infinity if x['minHistoryGap'] is None else x['minHistoryGap']),
+		x['compatibility'] or 0,
+		))
+	return candidates
+
+GiftExchange.batch = GiftExchangeBatch
+
+# Parameters of GiftExchange, with the defaults for any not given
+def _withDefaults(users, parameters):
+	import inspect
+	bound = inspect.signature(GiftExchange).bind(users, **parameters)
+	bound.apply_defaults()
+	return dict(bound.arguments)
+
+# Async Exchange --------------------------------------------------------
+# GiftExchange for asyncio (ex: a web backend), without holding up the 
+# event loop. The providers are awaited first, then everything else 
+# (validating, preparing and searching) runs in the executor. Cancelling 
+# the task awaiting it raises CancelledError straight away, and the work in
+# the executor stops at its next check of the SearchLimits (every 256 
+# receivers tried, and as the precheck and engines check pairs).
+#	users, parameters = same as GiftExchange
+#	executor = concurrent.futures.ThreadPoolExecutor to run in, None for 
+#		the event loop's default
+#	restrictionProvider = async function taking users, returning the 
+#		(giverID, receiverID) pairs that are restricted. Works alongside 
+#		f_restriction.
+#	compatibilityProvider = async function taking users, returning the
+#		compatibilityWeights grid, in place of f_compatibility
+# Each provider is awaited once, both at the same time, so a database or 
+# service can answer for the whole exchange instead of once per pair.
+async def GiftExchangeAsync(users, executor=None, restrictionProvider=None, 
+		compatibilityProvider=None, **parameters):
+	import asyncio
+	import threading
+	errors = ''
+	if restrictionProvider is not None and not callable(restrictionProvider):
+		errors += '\n' + 'Parameter, restrictionProvider, must be an async function'
+	if compatibilityProvider is not None:
+		if not callable(compatibilityProvider):
+			errors += '\n' + 'Parameter, compatibilityProvider, must be an async function'
+		if parameters.get('f_compatibility') or parameters.get('compatibilityWeights') is not None:
+			errors += ('\n' + 'Use only one of f_compatibility, compatibilityWeights '
+				+ 'and compatibilityProvider')
+	if errors:
+		raise ValidationError(errors)
+
+	async def nothing():
+		return None
+	restricted, weights = await asyncio.gather(
+		restrictionProvider(users) if restrictionProvider else nothing(),
+		compatibilityProvider(users) if compatibilityProvider else nothing(),
+		)
+	parameters = _withDefaults(users, parameters)
+	if restrictionProvider:
+		restricted = set(map(tuple, restricted))
+		f_uniqueID = parameters['f_uniqueID']
+		f_restriction = parameters['f_restriction'] or (lambda giver, receiver: False)
+		parameters['f_restriction'] = lambda giver, receiver: (
+			(f_uniqueID(giver), f_uniqueID(receiver)) in restricted 
+			or f_restriction(giver, receiver))
+	if compatibilityProvider:
+		parameters['compatibilityWeights'] = weights
+
+	cancelled = threading.Event()
+	def run():
+		if cancelled.is_set(): # before the executor got to it
+			return None
+		errors = ValidateParameters(**parameters)
+		if errors:
+			raise ValidationError(errors)
+		exchange = PreparedExchange(**parameters)
+		exchange.cancelled = cancelled
+		if cancelled.is_set(): # while it was being prepared
+			return None
+		if exchange.relax:
+			return exchange.results(exchange.relaxedSolve())
+		return exchange.results(exchange.solve())
+
+	try:
+		return await asyncio.get_running_loop().run_in_executor(executor, run)
+	except asyncio.CancelledError:
+		cancelled.set()
+		raise
+
+# Compiled Exchange -----------------------------------------------------
+# A PreparedExchange for running the same exchange again and again while
+# its users change a few at a time (ex: someone joins or leaves a weekly
+# exchange). The parameters are validated once, and adding or removing a
+# user only works out their ID, history, weights and restrictions, and 
+# their place in everyone else's, instead of preparing it all again.
+#	users = same as GiftExchange, copied (see addUser and removeUser)
+#	parameters = same as GiftExchange
+# A compatibilityWeights grid (or ruleProvider.weightsRow) can't follow the
+# users, so addUser and removeUser raise ValidationError with one (use 
+# FeatureWeights instead). ruleProvider.restrictionsFor is called again,
+# with every user, each time a user is added.
+class CompiledExchange(PreparedExchange):
+	def __init__ (self, users, **parameters):
+		if isinstance(users, list):
+			users = list(users)
+		parameters = _withDefaults(users, parameters)
+		errors = ValidateParameters(**parameters)
+		if errors:
+			raise ValidationError(errors)
+		super().__init__(**parameters)
+		self.minUsers = parameters['minUsers']
+		self.maxUsers = parameters['maxUsers']
+		# windowsByRecipient[recipientID] = IDs of the users with the 
+		# recipient in their historyWindows, made by the first change
+		self.windowsByRecipient = None
+
+	# Finds one set of assignments, the same output as GiftExchange. 
+	# Rules relaxed to find them (see relax) are only relaxed for this run.
+	def run(self):
+		rules = (self.restrictions, self.giverHistory, self.historyLimit, list(self.relaxSteps))
+		try:
+			assignedUsers = self.relaxedSolve() if self.relax else self.solve()
+			return self.results(assignedUsers)
+		finally:
+			if self.droppedRules or self.historyLimit != rules[2]:
+				self.restrictions, self.giverHistory, self.historyLimit, self.relaxSteps = rules
+				self.droppedRules = []
+				self.prechecked = False
+
+	# Adds the user after the others. Raises ValidationError when their 
+	# uniqueID is already taken, or there'd be more than maxUsers.
+	def addUser(self, user):
+		self._checkWeights()
+		if len(self.users) >= self.maxUsers:
+			raise ValidationError(f'The max number of users is {self.maxUsers}.')
+		userID = self.f_uniqueID(user)
+		if self.userIndex(userID) is not None:
+			raise ValidationError('List of Users must be unique by ID.')
+		i_user = len(self.users)
+		self.users.append(user)
+		self.userIDs.append(userID)
+		self.userIndexes[userID] = i_user
+
+		self.giverHistory.append(_NO_HISTORY)
+		self.historyRanks.append(())
+		self.historyWindows.append(())
+		if self.history is not None and self.historyLimit > 0:
+			windows = self._windowsByRecipient()
+			recent = self.recentRecipients([userID], self.historyLimit)[0]
+			if recent:
+				self.historyWindows[i_user] = recent
+			for i_hist, recipientID in recent:
+				windows.setdefault(recipientID, set()).add(userID)
+			self._resolveHistory(i_user)
+			# users who gave to them before
+			for giverID in windows.get(userID, ()):
+				self._resolveHistory(self.userIndexes[giverID])
+
+		if self.features is not None:
+			self.features.append(self.compatibilityWeights.f_feature(user))
+		if self.restrictions:
+			self.restrictions.addUser()
+			if self.f_restrictionsFor:
+				self.restrictions.listPairs(self.listedPairs())
+		self._changed()
+
+	# Removes the user with the uniqueID, the last user taking their index.
+	# Raises ValidationError when there's no such user, or there'd be fewer
+	# than minUsers.
+	def removeUser(self, userID):
+		self._checkWeights()
+		i_user = self.userIndex(userID)
+		if i_user is None:
+			raise ValidationError(f'There is no user with the uniqueID {userID!r}.')
+		if len(self.users) <= self.minUsers:
+			raise ValidationError(f'There must be least {self.minUsers} users.')
+		windows = self._windowsByRecipient()
+		for i_hist, recipientID in self.historyWindows[i_user]:
+			windows[recipientID].discard(userID)
+
+		i_last = len(self.users) - 1
+		lastID = self.userIDs[i_last]
+		moving = [self.users, self.userIDs, self.giverHistory, self.historyRanks, 
+			self.historyWindows]
+		if self.features is not None:
+			moving.append(self.features)
+		for values in moving:
+			values[i_user] = values[i_last]
+			values.pop()
+		del self.userIndexes[userID]
+		if i_user != i_last:
+			self.userIndexes[lastID] = i_user
+		# users who gave to either of them before
+		for giverID in windows.get(userID, set()) | windows.get(lastID, set()):
+			self._resolveHistory(self.userIndexes[giverID])
+
+		if self.restrictions:
+			self.restrictions.removeUser(i_user)
+		self._changed()
+
+	def _checkWeights(self):
+		if self.compatibilityWeights is not None and self.features is None:
+			raise ValidationError('Users can\'t be added or removed with a '
+				+ 'compatibilityWeights grid, use FeatureWeights')
+		if self.f_providedRow:
+			raise ValidationError('Users can\'t be added or removed with '
+				+ 'ruleProvider.weightsRow, use FeatureWeights')
+
+	def _windowsByRecipient(self):
+		if self.windowsByRecipient is None:
+			self.windowsByRecipient = {}
+			for userID, window in zip(self.userIDs, self.historyWindows):
+				for i_hist, recipientID in window:
+					self.windowsByRecipient.setdefault(recipientID, set()).add(userID)
+		return self.windowsByRecipient
+
+	# What was worked out from all the users has to be worked out again
+	def _changed(self):
+		if self.weightRows is not None:
+			self.weightRows = [None] * len(self.users)
+		if self.features is not None:
+			self.f_weightsRow = self.compatibilityWeights.rows(self.users, self.features)
+			self.f_weight = self.compatibilityWeights.pairs(self.users, self.features)
+		self.prechecked = False
+		self.historyGaps = None
+
+# Command Line ----------------------------------------------------------
+# python -m gift_exchange ROSTER [options], see the README or --help.
+# Streams the roster and history from JSON Lines or CSV files, and writes
+# the assignments the same way, one per line:
+#	roster = one user per line, a JSON object or a CSV row (with a 
+#		header). uniqueIDs are the --id field, as text.
+#	history = one exchange per line, oldest first, as a JSON object of 
+#		{ giverID: receiverID }. Or a CSV with exchange, giver and receiver
+#		columns, the rows of each exchange one after another. Read from the
+#		end, so only the exchanges within historyLimit are parsed.
+#	rules = Python expressions of the users' fields: giver and receiver
+#		(--restrict, --compatibility) or user (--same, --different). Fields
+#		can be read as giver.team or giver['team']. CSV values that look
+#		like numbers are numbers.
+# Returns the exit code: 0, 1 when there are no assignments (ResultError),
+# 2 when the input isn't right (ValidationError).
+def CommandLine(arguments=None):
+	import argparse
+	import sys
+	parser = argparse.ArgumentParser(prog='python -m gift_exchange', 
+		description='Assigns every user in the roster someone to give a gift to')
+	parser.add_argument('roster', help='JSON Lines or CSV file of users, - for stdin')
+	parser.add_argument('--history', help='JSON Lines or CSV file of past exchanges')
+	parser.add_argument('--output', default='-', help='file to write the assignments to')
+	parser.add_argument('--format', choices=('jsonl', 'csv'),
+		help='format of stdin and stdout (default jsonl), files go by their extension')
+	parser.add_argument('--id', default='id', help='field with the uniqueID of a user')
+	parser.add_argument('--history-limit', type=int, default=0, dest='historyLimit')
+	parser.add_argument('--participation-required', action='store_true', 
+		dest='history_ParticipationRequired')
+	parser.add_argument('--restrict', action='append', default=[], metavar='EXPRESSION',
+		help='restricted when true, ex: "giver.team == receiver.team"')
+	parser.add_argument('--same', action='append', default=[], metavar='EXPRESSION',
+		help='users with the same value are restricted, ex: team or "user.team"')
+	parser.add_argument('--different', action='append', default=[], metavar='EXPRESSION',
+		help='users with different values are restricted')
+	parser.add_argument('--compatibility', metavar='EXPRESSION',
+		help='smaller = more likely, ex: "abs(giver.age - receiver.age)"')
+	parser.add_argument('--engine', default='backtrack', choices=list(ENGINES))
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--timeout', type=float)
+	parser.add_argument('--topology', default='cycles', choices=TOPOLOGIES)
+	parser.add_argument('--min-cycle-length', type=int, default=3, dest='minCycleLength')
+	parser.add_argument('--block-size', type=int, dest='blockSize')
+	parser.add_argument('--validate', default='full', choices=VALIDATE_MODES)
+	parser.add_argument('--seed', type=int, help='random seed, for the same results again')
+	options = parser.parse_args(arguments)
+
+	try:
+		idField = options.id
+		users = list(_readRows(options.roster, options.format))
+		parameters = dict(
+			f_uniqueID=lambda user: str(user[idField]),
+			maxUsers=max(len(users), 3),
+			historyLimit=options.historyLimit,
+			history_ParticipationRequired=options.history_ParticipationRequired,
+			restrictionRules=
+				[ AttributeRestriction(_userExpression(x, '--same'), True, x) for x in options.same ]
+				+ [ AttributeRestriction(_userExpression(x, '--different'), False, x) 
+					for x in options.different ],
+			engine=options.engine,
+			workers=options.workers,
+			timeout=options.timeout,
+			topology=options.topology,
+			minCycleLength=options.minCycleLength,
+			blockSize=options.blockSize,
+			validate=options.validate,
+			)
+		if options.restrict:
+			f_restrict = _pairExpression(' or '.join(f'({x})' for x in options.restrict), 
+				'--restrict')
+			parameters['f_restriction'] = lambda giver, receiver: bool(f_restrict(giver, receiver))
+		if options.compatibility:
+			parameters['f_compatibility'] = _pairExpression(options.compatibility, 
+				'--compatibility')
+		if options.history and options.historyLimit > 0:
+			parameters['history'] = _readHistory(options.history, options.historyLimit, 
+				options.history_ParticipationRequired, 
+				set(parameters['f_uniqueID'](x) for x in users))
+		if options.seed is not None:
+			seed(options.seed)
+		results = GiftExchange(users, **parameters)
+	except ValidationError as e:
+		print(f'error: {e}', file=sys.stderr)
+		return 2
+	except ResultError as e:
+		print(e, file=sys.stderr)
+		return 1
+	except (OSError, KeyError, ValueError) as e:
+		print(f'error: {e!r}', file=sys.stderr)
+		return 2
+	_writeResults(options.output, options.format, results)
+	return 0
+
+# A user from the roster. Its fields can be read as attributes, for the 
+# rule expressions (fields named like a dict method, ex: items, need [])
+class _Row(dict):
+	__slots__ = ()
+	def __getattr__(self, name):
+		try:
+			return self[name]
+		except KeyError:
+			raise AttributeError(name) from None
+
+# Format of the file: 'csv' or 'jsonl', from its extension (or format for
+# stdin and stdout)
+def _fileFormat(path, format):
+	if path == '-':
+		return format or 'jsonl'
+	return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+# A CSV value, as a number when it looks like one
+def _csvValue(value):
+	for kind in (int, float):
+		try:
+			return kind(value)
+		except ValueError:
+			pass
+	return value
+
+# The roster's users, one line at a time
+def _readRows(path, format):
+	import sys
+	file = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8', newline='')
+	try:
+		if _fileFormat(path, format) == 'csv':
+			import csv
+			for row in csv.DictReader(file):
+				yield _Row((k, _csvValue(v)) for k, v in row.items())
+		else:
+			import json
+			for line in file:
+				if line.strip():
+					yield _Row(json.loads(line))
+	finally:
+		if file is not sys.stdin:
+			file.close()
+
+def _writeResults(path, format, results):
+	import sys
+	file = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+	try:
+		if _fileFormat(path, format) == 'csv':
+			import csv
+			writer = csv.writer(file)
+			writer.writerow(['giver', 'receiver'])
+			writer.writerows(results.items())
+		else:
+			import json
+			for giverID, receiverID in results.items():
+				file.write(json.dumps({ 'giver': giverID, 'receiver': receiverID }) + '\n')
+	finally:
+		if file is not sys.stdout:
+			file.close()
+
+# Lambda of the expression, with ValidationError when it isn't one
+def _expression(names, text, option):
+	try:
+		return eval(compile(f'lambda {names}: ({text})', option, 'eval'), {})
+	except SyntaxError as e:
+		raise ValidationError(f'{option} {text!r} is not an expression: {e.msg}')
+
+def _pairExpression(text, option):
+	return _expression('giver, receiver', text, option)
+
+# A field name on its own (ex: team) is the same as user.team
+def _userExpression(text, option):
+	if text.isidentifier() and text != 'user':
+		text = f'user[{text!r}]'
+	return _expression('user', text, option)
+
+# The lines of the binary file from the last to the first, down to the 
+# start offset (ex: after a CSV header), read a block at a time from the
+# end so only the lines used are read
+def _linesBackward(file, start=0, blockSize=1 << 16):
+	file.seek(0, 2)
+	position = file.tell()
+	# pieces of the line being read (longer than a block), last first
+	pieces = []
+	def line():
+		text = b''.join(reversed(pieces)).decode('utf-8').rstrip('\r')
+		return text if text.strip() else None
+	while position > start:
+		size = min(blockSize, position - start)
+		position -= size
+		file.seek(position)
+		parts = file.read(size).split(b'\n')
+		pieces.append(parts.pop())
+		for part in reversed(parts):
+			text = line()
+			if text is not None:
+				yield text
+			pieces = [part]
+	text = line()
+	if text is not None:
+		yield text
+
+# The exchanges of a history file (see CommandLine) within historyLimit,
+# as a HistoryIndex. Read from the last exchange back, stopping after 
+# historyLimit exchanges, or with history_ParticipationRequired, once 
+# every user has historyLimit exchanges they gave in. Only the users' 
+# recent assignments are kept, not the exchanges they came from.
+def _readHistory(path, historyLimit, history_ParticipationRequired, userIDs):
+	index = HistoryIndex([])
+	byGiver = index.byGiver
+	# IDs as the users' own strings, so they aren't kept twice
+	ids = dict((x, x) for x in userIDs)
+	needed = len(ids)
+	exchangeCount = 0
+	def done():
+		if history_ParticipationRequired:
+			return needed == 0
+		return exchangeCount >= historyLimit
+
+	def add(exchange):
+		nonlocal needed, exchangeCount
+		for giverID, receiverID in exchange:
+			giverID = ids.get(str(giverID))
+			if giverID is None:
+				continue
+			recent = byGiver.get(giverID)
+			if recent is None:
+				recent = byGiver[giverID] = []
+			if len(recent) < historyLimit:
+				receiverID = str(receiverID)
+				recent.append((exchangeCount, ids.get(receiverID, receiverID)))
+				if len(recent) == historyLimit:
+					needed -= 1
+		exchangeCount += 1
+
+	with open(path, 'rb') as file:
+		if path.lower().endswith('.csv'):
+			import csv
+			columns = [ x.strip() for x in next(csv.reader([file.readline().decode('utf-8-sig')])) ]
+			i_exchange, i_giver, i_receiver = [ columns.index(x) 
+				for x in ('exchange', 'giver', 'receiver') ]
+			exchange = []
+			current = None
+			for line in _linesBackward(file, file.tell()):
+				row = next(csv.reader([line]))
+				if row[i_exchange] != current:
+					if exchange:
+						add(exchange)
+						if done():
+							break
+					exchange = []
+					current = row[i_exchange]
+				exchange.append((row[i_giver], row[i_receiver]))
+			else:
+				if exchange:
+					add(exchange)
+		else:
+			import json
+			for line in _linesBackward(file):
+				add(json.loads(line).items())
+				if done():
+					break
+	return index
 
-	logging.info(f' Final Results (user indexes) -  {assignedUsers}')
-	results = {}
-	for giverIndex, recieverIndex in enumerate(assignedUsers):
-		giver_UniqueID =  f_uniqueID(users[giverIndex])
-		reciever_UniqueID = f_uniqueID(users[recieverIndex])
-		results[giver_UniqueID] = reciever_UniqueID
-	return results
+if __name__ == '__main__':
+	import sys
+	sys.exit(CommandLine())
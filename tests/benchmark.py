@@ -0,0 +1,259 @@
+# Benchmarks ------------------------------------------------------------
+# Times GiftExchange over a range of exchange sizes and rules, and writes
+# the results as JSON so they can be compared between versions.
+#	python -m tests.benchmark
+#	python -m tests.benchmark --sizes 10,1000 --scenarios none,teams --output bench.json
+#	python -m tests.benchmark --block-size 5000 (split into blocks, see blockSize)
+#	python -m tests.benchmark --startup --sizes 10,10000 (import and first call)
+# Every case runs in its own process, so one that hangs is stopped at
+# --timeout and memory from one case doesn't count towards the next.
+# For each case (scenario, users, engine):
+#	seconds = fastest and median of --repeat runs
+#	usersPerSecond = users / median seconds, to compare with and without 
+#		--block-size
+#	peakMemoryMB = most memory the run allocated (tracemalloc), not
+#		counting the users and history it was given
+#	phases = seconds in each phase, attempts, backtracks, backtrackDepth,
+#		restarts, mostAssigned, skips = see GiftExchange's stats
+#	microsecondsPerAttempt = the search phase over its attempts, None 
+#		without attempts (the 'matching' engine), to see it stay about the
+#		same as the exchanges grow
+#	status = 'ok', 'no_results' (ResultError), 'timeout' or 'error'
+# The same random seed is used for the timed, memory and counting runs,
+# so they all follow the same search.
+# With --startup, times importing gift_exchange and its first call instead,
+# each in a new Python process, for every validate mode (see RunStartup).
+# The first call uses teams (restrictionRules) and the backtrack engine.
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import gift_exchange
+from gift_exchange import GiftExchange, ResultError, AttributeRestriction, FeatureWeights
+
+SIZES = [10, 100, 1000, 5000, 20000]
+DEFAULT_ENGINES = ['backtrack', 'matching']
+
+# Each scenario returns the parameters of GiftExchange for that many users
+#	feasible = whether there are assignments to find
+def _none(userCount):
+	return {}
+
+def _teams(userCount):
+	return { 'restrictionRules': [AttributeRestriction(lambda x: x % 2)] }
+
+def _teamsUneven(userCount):
+	# one team is bigger (by 10%, at least 2 users), so the other team 
+	# can't give to all of them
+	split = userCount // 2 + max(1, userCount // 20)
+	return { 'restrictionRules': [AttributeRestriction(lambda x: x < split)] }
+
+def _blocked(userCount):
+	# user 0 can't give to, or receive from, anyone
+	return { 'restrictionRules': [AttributeRestriction(lambda x: x == 0, same=False)] }
+
+def _restrictionFunction(userCount):
+	# every 7th receiver (counting from the giver) is off limits
+	return { 'f_restriction': lambda x, y: (x - y) % 7 == 0 }
+
+def _history(userCount):
+	# every user's last 5 receivers are off limits
+	exchanges = min(5, userCount - 2)
+	history = [ { g: (g + k) % userCount for g in range(userCount) }
+		for k in range(1, exchanges + 1) ]
+	return { 'history': history, 'historyLimit': exchanges }
+
+def _singleCycle(userCount):
+	return { 'topology': 'single_cycle' }
+
+def _singleCycleHistory(userCount):
+	return dict(_history(userCount), topology='single_cycle')
+
+def _weights(userCount):
+	ages = [ random.randint(18, 80) for _ in range(userCount) ]
+	return { 'compatibilityWeights': FeatureWeights(lambda x: ages[x]) }
+
+SCENARIOS = {
+	'none': (_none, True),
+	'teams': (_teams, True),
+	'teams_uneven': (_teamsUneven, False),
+	'blocked': (_blocked, False),
+	'restriction_function': (_restrictionFunction, True),
+	'history': (_history, True),
+	'weights': (_weights, True),
+	'single_cycle': (_singleCycle, True),
+	'single_cycle_history': (_singleCycleHistory, True),
+	}
+
+# Runs one case in this process, returning its results
+def RunCase(scenario, userCount, engine, repeat, seed=0, blockSize=None):
+	f_parameters, feasible = SCENARIOS[scenario]
+	if scenario == 'teams':
+		userCount -= userCount % 2 # even teams
+	users = list(range(userCount))
+	random.seed(seed)
+	parameters = dict(f_parameters(userCount), maxUsers=max(userCount, 3), engine=engine,
+		blockSize=blockSize)
+	result = { 'scenario': scenario, 'users': userCount, 'engine': engine,
+		'blockSize': blockSize, 'feasible': feasible }
+
+	def run():
+		try:
+			GiftExchange(users, **parameters)
+			return 'ok'
+		except ResultError:
+			return 'no_results'
+
+	times = []
+	for i in range(repeat):
+		random.seed(seed + i)
+		start = time.perf_counter()
+		result['status'] = run()
+		times.append(time.perf_counter() - start)
+	result['seconds'] = { 'min': min(times), 'median': statistics.median(times) }
+	result['usersPerSecond'] = userCount / result['seconds']['median']
+
+	random.seed(seed)
+	tracemalloc.start()
+	run()
+	result['peakMemoryMB'] = tracemalloc.get_traced_memory()[1] / 2**20
+	tracemalloc.stop()
+
+	# Counted with stats. Made with PreparedExchange, so there are counts 
+	# even when there are no results.
+	random.seed(seed)
+	exchange = gift_exchange.PreparedExchange(
+		**gift_exchange._withDefaults(users, dict(parameters, stats=True)))
+	try:
+		exchange.solve()
+	except ResultError:
+		pass
+	stats = exchange.stats.stats()
+	result['phases'] = stats['seconds']
+	for key in ('attempts', 'backtracks', 'backtrackDepth', 'restarts', 'mostAssigned', 'skips'):
+		result[key] = stats[key]
+	result['microsecondsPerAttempt'] = None
+	if stats['attempts']:
+		result['microsecondsPerAttempt'] = stats['seconds']['search'] / stats['attempts'] * 1e6
+	return result
+
+# Importing gift_exchange and its first call, timed in a new process
+# (nothing imported yet), printing them as JSON. The parameters are also
+# validated on their own, to see how much of the call that is.
+STARTUP_CODE = '''
+import json, time
+started = time.perf_counter()
+import gift_exchange
+imported = time.perf_counter()
+parameters = dict(f_uniqueID=lambda x: x, maxUsers=max({userCount}, 3), validate={validate!r},
+	restrictionRules=[gift_exchange.AttributeRestriction(lambda x: x % 2)])
+users = list(range({userCount} - {userCount} % 2))
+gift_exchange.GiftExchange(users, **parameters)
+called = time.perf_counter()
+parameters = gift_exchange._withDefaults(users, parameters)
+validating = time.perf_counter()
+gift_exchange.ValidateParameters(**parameters)
+print(json.dumps([imported - started, called - imported, time.perf_counter() - validating]))
+'''
+
+# Times the start up of --repeat new processes, returning the results
+#	importSeconds, firstCallSeconds, validateSeconds = fastest and median
+def RunStartup(userCount, validate, repeat, root):
+	times = []
+	for _ in range(repeat):
+		done = subprocess.run([sys.executable, '-c', 
+			STARTUP_CODE.format(userCount=userCount, validate=validate)], 
+			cwd=root, capture_output=True, text=True, check=True)
+		times.append(json.loads(done.stdout))
+	result = { 'users': userCount, 'validate': validate }
+	for i, key in enumerate(['importSeconds', 'firstCallSeconds', 'validateSeconds']):
+		seconds = [ x[i] for x in times ]
+		result[key] = { 'min': min(seconds), 'median': statistics.median(seconds) }
+	return result
+
+def _versions():
+	versions = { 'python': platform.python_version(), 'platform': platform.platform() }
+	for module in ('numpy', 'scipy'):
+		try:
+			versions[module] = __import__(module).__version__
+		except ImportError:
+			versions[module] = None
+	return versions
+
+def main(arguments=None):
+	parser = argparse.ArgumentParser(description='Benchmark GiftExchange')
+	parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+		help='comma separated numbers of users')
+	parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+		help='comma separated, from: ' + ', '.join(SCENARIOS))
+	parser.add_argument('--engines', default=','.join(DEFAULT_ENGINES),
+		help='comma separated engine names')
+	parser.add_argument('--repeat', type=int, default=3, help='timed runs per case')
+	parser.add_argument('--timeout', type=float, default=120,
+		help='seconds before a case is stopped')
+	parser.add_argument('--block-size', type=int, dest='blockSize',
+		help='blockSize of GiftExchange, to compare with the whole exchange at once')
+	parser.add_argument('--startup', action='store_true',
+		help='time importing gift_exchange and its first call, for each validate mode')
+	parser.add_argument('--output', help='file to write the JSON to, instead of printing it')
+	# used by main to run a single case in a new process
+	parser.add_argument('--case', nargs=3, metavar=('SCENARIO', 'USERS', 'ENGINE'),
+		help=argparse.SUPPRESS)
+	options = parser.parse_args(arguments)
+
+	if options.case:
+		scenario, userCount, engine = options.case
+		print(json.dumps(RunCase(scenario, int(userCount), engine, options.repeat,
+			blockSize=options.blockSize)))
+		return
+
+	cases = []
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	if options.startup:
+		for userCount in [ int(x) for x in options.sizes.split(',') ]:
+			for validate in gift_exchange.VALIDATE_MODES:
+				cases.append(RunStartup(userCount, validate, options.repeat, root))
+				print(f'startup {userCount} users, validate={validate}:', 
+					cases[-1]['firstCallSeconds']['median'], file=sys.stderr)
+		options.scenarios = ''
+	for scenario in filter(None, options.scenarios.split(',')):
+		for userCount in [ int(x) for x in options.sizes.split(',') ]:
+			for engine in options.engines.split(','):
+				print(f'{scenario} {userCount} users, {engine}', end=': ',
+					file=sys.stderr, flush=True)
+				command = [sys.executable, '-m', 'tests.benchmark', '--repeat',
+					str(options.repeat), '--case', scenario, str(userCount), engine]
+				if options.blockSize:
+					command += ['--block-size', str(options.blockSize)]
+				try:
+					done = subprocess.run(command, cwd=root, capture_output=True,
+						text=True, timeout=options.timeout)
+					if done.returncode == 0:
+						case = json.loads(done.stdout.strip().splitlines()[-1])
+					else:
+						case = { 'scenario': scenario, 'users': userCount, 'engine': engine,
+							'status': 'error', 'error': done.stderr.strip().splitlines()[-1:] }
+				except subprocess.TimeoutExpired:
+					case = { 'scenario': scenario, 'users': userCount, 'engine': engine,
+						'status': 'timeout', 'timeout': options.timeout }
+				print(case['status'], case.get('seconds', {}).get('median', ''),
+					file=sys.stderr)
+				cases.append(case)
+
+	report = { 'versions': _versions(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'cases': cases }
+	if options.output:
+		with open(options.output, 'w') as file:
+			json.dump(report, file, indent=1)
+	else:
+		print(json.dumps(report, indent=1))
+
+if __name__ == '__main__':
+	main()
@@ -1,4 +1,5 @@
 import unittest
+import gift_exchange
 from gift_exchange import *
 import time
 
@@ -42,6 +43,35 @@ def DictDiffTest(dict1, dict2):
 		output = False
 	return output
 
+# This method checks the results are a usable exchange for the given IDs
+#	- every ID gives exactly once and receives exactly once
+#	- no one gives to themselves
+#	- no closed pairs (A gives to B, B gives to A)
+def ValidExchangeTest(results, userIDs):
+	if sorted(results.keys()) != sorted(userIDs):
+		return False
+	if sorted(results.values()) != sorted(userIDs):
+		return False
+	for giver, receiver in results.items():
+		if giver == receiver or results[receiver] == giver:
+			return False
+	return True
+
+# Number of users in each cycle of the results (giver -> receiver -> ...)
+def CycleLengths(results):
+	lengths = []
+	seen = set()
+	for start in results:
+		length = 0
+		giver = start
+		while giver not in seen:
+			seen.add(giver)
+			giver = results[giver]
+			length += 1
+		if length:
+			lengths.append(length)
+	return lengths
+
 # Reference:
 # https://stackoverflow.com/questions/12627118/get-a-function-arguments-default-value
 import inspect
@@ -251,6 +281,47 @@ class Test_Processing(unittest.TestCase):
 					+ ' - Unable to find the only assignment combination,'
 					+ ' given the users and history '
 				)
+	def test_history_index(self):
+		index = HistoryIndex(test_user_history)
+		# giver 1's only exchange is the 2nd one (position 1)
+		self.assertEqual(index.recentRecipients(1, 1, True), [(1, 2)])
+		self.assertEqual(index.recentRecipients(1, 1, False), [])
+		self.assertEqual(index.recentRecipients(1, 2, False), [(1, 2)])
+		self.assertEqual(index.recentRecipients(5, 3, True), [])
+
+		# The same index is reused across calls
+		for i in range(sufficient_test_count):
+			for limit, participation in [(1, True), (3, False)]:
+				results = GiftExchange(
+					test_users, 
+					history=index, 
+					historyLimit=limit,
+					history_ParticipationRequired=participation,
+					f_uniqueID=lambda x: x.id
+					)
+				self.assertTrue(
+					DictDiffTest(results, {0:2,1:0,2:1}),
+					msg=' User History failure (HistoryIndex)'
+						+ ' - Unable to find the only assignment combination,'
+						+ ' given the users and history '
+					)
+
+	def test_history_list_scan(self):
+		# Exchanges past the ones needed are never looked at
+		class Untouched(dict):
+			def __contains__(self, key):
+				raise AssertionError('history read past the historyLimit')
+		history = test_user_history + [Untouched() for _ in range(1000)]
+		index = HistoryIndex(test_user_history)
+		for limit, participation in [(0, True), (0, False), (1, True), (3, False), (5, False)]:
+			prepared = gift_exchange.PreparedExchange(**gift_exchange._withDefaults(
+				[0, 1, 2], dict(history=history, historyLimit=limit,
+				history_ParticipationRequired=participation)))
+			# the same windows as indexing all of it
+			for userID in [0, 1, 2]:
+				self.assertEqual(list(prepared.historyWindows[userID]),
+					index.recentRecipients(userID, limit, participation))
+
 	# Making sure history doesn't play a part when the default 
 	# historyLimit should be 0
 	def test_user_history3(self): 
@@ -312,6 +383,1217 @@ class Test_Processing(unittest.TestCase):
 					+ f' among new_test_users, given {restrictionFunc}'
 				)
 
+	def test_backtracking_state(self):
+		# Two teams of alternating users forces plenty of skipped receivers
+		# and backtracking, exercising the taken/unassigned bookkeeping
+		teams = ['red', 'blue']
+		temp_users = [ example_User(id=i, team=teams[i%2]) for i in range(40) ]
+		for i in range(50):
+			results = GiftExchange(
+				temp_users,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.team == y.team
+				)
+			self.assertTrue(
+				ValidExchangeTest(results, list(range(40))),
+				msg=f'invalid exchange returned: {results}'
+				)
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+
+
+class Test_Engines(unittest.TestCase):
+	def test_forward_history(self):
+		for i in range(sufficient_test_count // 10):
+			results = GiftExchange(
+				test_users, 
+				history=test_user_history, 
+				historyLimit=1,
+				history_ParticipationRequired=True,
+				f_uniqueID=lambda x: x.id,
+				engine='forward'
+				)
+			self.assertTrue(DictDiffTest(results, {0:2,1:0,2:1}))
+
+	def test_forward_restrictions(self):
+		teams = ['red', 'blue']
+		temp_users = [ example_User(id=i, team=teams[i%2]) for i in range(40) ]
+		for i in range(20):
+			results = GiftExchange(
+				temp_users,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.team == y.team,
+				engine='forward'
+				)
+			self.assertTrue(ValidExchangeTest(results, list(range(40))))
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+
+	def test_forward_no_results(self):
+		# 7 red and 5 blue users can't all give to the other team
+		temp_users = [ example_User(id=i, team='red' if i < 7 else 'blue') for i in range(12) ]
+		with self.assertRaises(ResultError):
+			GiftExchange(
+				temp_users,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.team == y.team,
+				engine='forward'
+				)
+
+	def test_forward_tight_groups(self):
+		# Each giver still has receivers after most assignments, but a whole
+		# group of givers can run short of them between them (Hall's 
+		# condition). Without the matching the search thrashes for seconds.
+		users = list(range(30))
+		for f_compatibility in [None, lambda x, y: abs(x - y)]:
+			for i in range(15):
+				results = GiftExchange(users, f_restriction=lambda x, y: (x + y) % 3 == 0,
+					f_compatibility=f_compatibility, engine='forward', timeout=3)
+				self.assertTrue(ValidExchangeTest(results, users))
+				for giver, receiver in results.items():
+					self.assertNotEqual((giver + receiver) % 3, 0)
+
+	def test_forward_checks_few_pairs(self):
+		# givers only keep track of their first few receivers, so a big
+		# exchange doesn't check (or keep) every pair
+		users = list(range(1000))
+		calls = []
+		results = GiftExchange(users, maxUsers=1000, precheck=False, engine='forward',
+			f_restriction=lambda x, y: calls.append((x, y)) or x % 2 == y % 2)
+		self.assertTrue(ValidExchangeTest(results, users))
+		self.assertLess(len(calls), len(users) ** 2 // 4)
+
+	def test_matching_engine(self):
+		for i in range(sufficient_test_count // 10):
+			results = GiftExchange(
+				test_users, 
+				history=test_user_history, 
+				historyLimit=3,
+				f_uniqueID=lambda x: x.id,
+				engine='matching'
+				)
+			self.assertTrue(DictDiffTest(results, {0:2,1:0,2:1}))
+
+		teams = ['red', 'blue']
+		temp_users = [ example_User(id=i, team=teams[i%2]) for i in range(500) ]
+		for i in range(5):
+			results = GiftExchange(
+				temp_users,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.team == y.team,
+				maxUsers=500,
+				engine='matching'
+				)
+			self.assertTrue(ValidExchangeTest(results, list(range(500))))
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+
+	def test_matching_no_results(self):
+		temp_users = [ example_User(id=i, team='red' if i < 7 else 'blue') for i in range(12) ]
+		with self.assertRaises(ResultError):
+			GiftExchange(
+				temp_users,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.team == y.team,
+				engine='matching'
+				)
+
+	def test_optimal_engine(self):
+		# the only assignments that cost nothing: everyone gives to the next user
+		weights = [ [ 0 if r == (g + 1) % 6 else 1 for r in range(6) ] for g in range(6) ]
+		results = GiftExchange(list(range(6)), engine='optimal', compatibilityWeights=weights)
+		self.assertEqual(results, { g: (g + 1) % 6 for g in range(6) })
+		real_numpy = gift_exchange._numpy
+		gift_exchange._numpy = lambda: None
+		try:
+			results = GiftExchange(list(range(6)), engine='optimal', compatibilityWeights=weights)
+			self.assertEqual(results, { g: (g + 1) % 6 for g in range(6) })
+		finally:
+			gift_exchange._numpy = real_numpy
+
+		for i in range(sufficient_test_count // 10):
+			results = GiftExchange(
+				test_users, 
+				history=test_user_history, 
+				historyLimit=3,
+				f_uniqueID=lambda x: x.id,
+				engine='optimal'
+				)
+			self.assertTrue(DictDiffTest(results, {0:2,1:0,2:1}))
+
+	def test_optimal_closed_loops(self):
+		# cheapest is 0 <-> 1 and 2 <-> 3, which have to be repaired
+		ages = [20, 20, 50, 50, 51]
+		for noise in [0, 0.5]:
+			for i in range(20):
+				results = GiftExchange(list(range(5)), 
+					engine=lambda problem: OptimalEngine(problem, noise=noise),
+					f_compatibility=lambda x, y: abs(ages[x] - ages[y]))
+				self.assertTrue(ValidExchangeTest(results, list(range(5))))
+
+	def test_optimal_no_results(self):
+		temp_users = [ example_User(id=i, team='red' if i < 7 else 'blue') for i in range(12) ]
+		for precheck in [True, False]:
+			with self.assertRaises(ResultError):
+				GiftExchange(
+					temp_users,
+					f_uniqueID=lambda x: x.id,
+					f_restriction=lambda x, y: x.team == y.team,
+					engine='optimal',
+					precheck=precheck
+					)
+
+	def test_custom_engine(self):
+		# every giver gives to the next user in the list
+		def next_user(problem):
+			return [ (i + 1) % len(problem.users) for i in range(len(problem.users)) ]
+		results = GiftExchange(['a','b','c','d'], engine=next_user)
+		self.assertEqual(results, {'a':'b', 'b':'c', 'c':'d', 'd':'a'})
+
+	def test_engine_parameter(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], engine='weh')
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], engine=4)
+
+class Test_CompatibilityWeights(unittest.TestCase):
+	# A weight of 0 puts the receiver first in line, so every giver's first
+	# choice is the next user: a -> b -> c -> d -> a
+	temp_users = ['a','b','c','d']
+	grid = [
+		[1, 0, 1, 1],
+		[1, 1, 0, 1],
+		[1, 1, 1, 0],
+		[0, 1, 1, 1],
+		]
+	expected = {'a':'b', 'b':'c', 'c':'d', 'd':'a'}
+
+	def test_grid(self):
+		for i in range(sufficient_test_count // 10):
+			results = GiftExchange(self.temp_users, compatibilityWeights=self.grid)
+			self.assertTrue(DictDiffTest(results, self.expected))
+
+	@unittest.skipUnless(gift_exchange._numpy(), 'NumPy is not installed')
+	def test_numpy_grid(self):
+		numpy = gift_exchange._numpy()
+		for i in range(sufficient_test_count // 10):
+			results = GiftExchange(self.temp_users, compatibilityWeights=numpy.array(self.grid))
+			self.assertTrue(DictDiffTest(results, self.expected))
+
+	def test_without_numpy(self):
+		real_numpy = gift_exchange._numpy
+		gift_exchange._numpy = lambda: None
+		try:
+			results = GiftExchange(self.temp_users, compatibilityWeights=self.grid)
+			weights = FeatureWeights(lambda x: ord(x)).weights(self.temp_users)
+		finally:
+			gift_exchange._numpy = real_numpy
+		self.assertTrue(DictDiffTest(results, self.expected))
+		self.assertEqual(weights[0], [0, 1, 2, 3])
+
+	def test_feature_weights(self):
+		weights = FeatureWeights(lambda x: ord(x), compare='difference').weights(self.temp_users)
+		self.assertEqual([ list(row) for row in weights ][3], [3, 2, 1, 0])
+		weights = FeatureWeights(lambda x: x in 'ab', compare='same').weights(self.temp_users)
+		self.assertEqual([ list(row) for row in weights ][0], [1, 1, 0, 0])
+		results = GiftExchange(self.temp_users, 
+			compatibilityWeights=FeatureWeights(lambda x: ord(x)))
+		self.assertTrue(ValidExchangeTest(results, self.temp_users))
+		with self.assertRaises(ValidationError):
+			FeatureWeights(lambda x: x, compare='weh')
+
+	def test_parameter_errors(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(self.temp_users, compatibilityWeights=self.grid[:3])
+		with self.assertRaises(ValidationError):
+			GiftExchange(self.temp_users, compatibilityWeights=4)
+		with self.assertRaises(ValidationError):
+			GiftExchange(self.temp_users, compatibilityWeights=self.grid,
+				f_compatibility=lambda x, y: 1)
+
+class Test_ReceiverOrders(unittest.TestCase):
+	def check_orders(self, orders):
+		# Drawing receivers a few at a time gives the same order as drawing
+		# them all at once, and every receiver shows up once
+		for giver in range(len(orders)):
+			order = orders[giver]
+			first = [ order[k] for k in range(5) ]
+			self.assertLess(len(order.drawn), len(orders))
+			full = list(order)
+			self.assertEqual(full[:5], first)
+			self.assertEqual(sorted(full), list(range(len(orders))))
+			fresh = ReceiverOrder(orders, giver)
+			self.assertEqual(fresh[:], full)
+
+	def test_lazy_draws(self):
+		for userCount in [30, 200]: # pure Python, and NumPy when installed
+			self.check_orders(ReceiverOrders(userCount))
+			self.check_orders(ReceiverOrders(userCount, lambda giver: [ (x % 7) + 1 for x in range(userCount) ]))
+
+	def test_zero_weights_first(self):
+		for userCount in [30, 200]:
+			weights = [1] * userCount
+			weights[5] = weights[2] = 0
+			orders = ReceiverOrders(userCount, lambda giver: weights)
+			for giver in range(5):
+				self.assertEqual([ orders[giver][0], orders[giver][1] ], [2, 5])
+
+	def test_weighted_distribution(self):
+		# Same weight semantics as weighted_shuffle: position of the first
+		# receiver drawn should show up about as often with both
+		weights = [1, 2, 3, 4, 5]
+		cycles = 4000
+		counts_lazy = [0] * 5
+		counts_shuffle = [0] * 5
+		for i in range(cycles):
+			counts_lazy[ReceiverOrders(5, lambda giver: weights)[0][0]] += 1
+			counts_shuffle[weighted_shuffle(range(5), weights)[0]] += 1
+		for lazy, shuffled in zip(counts_lazy, counts_shuffle):
+			self.assertLess(abs(lazy - shuffled), cycles * 0.05)
+
+class Test_RestrictionRules(unittest.TestCase):
+	def test_attribute_restriction(self):
+		# same as test_restrictions, using a rule instead of a lambda
+		test_userD = example_User(id=3, name='D', team='green')
+		new_test_users = test_users + [test_userD]
+		for i in range(sufficient_test_count // 10):
+			results = GiftExchange(
+				new_test_users, 
+				f_uniqueID=lambda x: x.id, 
+				restrictionRules=[AttributeRestriction(lambda x: x.team)]
+				)
+			if results[0] == 1:
+				test_against = {0:1, 1:3, 2:0, 3:2}
+			else:
+				test_against = {0:2, 1:0, 2:3, 3:1}
+			self.assertTrue(DictDiffTest(results, test_against))
+
+	def test_different_values(self):
+		# only users in the same group may be paired
+		temp_users = [ example_User(id=i, team=['red','blue'][i % 2]) for i in range(8) ]
+		for i in range(50):
+			results = GiftExchange(
+				temp_users, 
+				f_uniqueID=lambda x: x.id, 
+				restrictionRules=[AttributeRestriction(lambda x: x.team, same=False)]
+				)
+			self.assertTrue(ValidExchangeTest(results, list(range(8))))
+			for giver, receiver in results.items():
+				self.assertEqual(giver % 2, receiver % 2)
+
+	def test_restriction_called_once_per_pair(self):
+		calls = {}
+		def restricted(x, y):
+			calls[(x.id, y.id)] = calls.get((x.id, y.id), 0) + 1
+			return x.team == y.team
+		temp_users = [ example_User(id=i, team=['red','blue'][i % 2]) for i in range(30) ]
+		for engine in ENGINES:
+			calls.clear()
+			GiftExchange(
+				temp_users, 
+				f_uniqueID=lambda x: x.id, 
+				f_restriction=lambda x, y: restricted(x, y),
+				engine=engine
+				)
+			# the validation check calls it once for the first two users
+			calls[(0, 1)] -= 1
+			self.assertLessEqual(max(calls.values()), 1, msg=engine)
+
+	def test_matrix(self):
+		temp_users = ['a','b','c','d']
+		matrix = RestrictionMatrix(temp_users, 
+			f_restriction=lambda x, y: y == 'd', 
+			restrictionRules=[AttributeRestriction(lambda x: x in 'ab')])
+		self.assertTrue(matrix.isRestricted(0, 1))
+		self.assertFalse(matrix.isRestricted(0, 2))
+		self.assertTrue(matrix.isRestricted(2, 3))
+		self.assertEqual(matrix.unrestricted(0, [1, 2, 3]), [2])
+		# 'a' and 'b' share the same row of bits
+		self.assertIs(matrix.ruleRows[0], matrix.ruleRows[1])
+
+	def test_parameter_errors(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], restrictionRules=lambda x: x)
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], restrictionRules=[AttributeRestriction(lambda x: x.team)])
+
+class Test_Precheck(unittest.TestCase):
+	def test_unequal_teams(self):
+		temp_users = [ example_User(id=i, team='red' if i < 7 else 'blue') for i in range(12) ]
+		with self.assertRaises(ResultError) as context:
+			GiftExchange(
+				temp_users,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.team == y.team
+				)
+		report = context.exception.report
+		self.assertTrue(any('two groups' in line for line in report), msg=report)
+		self.assertTrue(any('givers can only give to' in line for line in report), msg=report)
+
+	def test_no_receivers(self):
+		with self.assertRaises(ResultError) as context:
+			GiftExchange(['a','b','c','d'], f_restriction=lambda x, y: x == 'a')
+		report = context.exception.report
+		self.assertIn("Giver 'a' has no receivers allowed (self: 1, restriction: 3)", report)
+
+	def test_no_givers(self):
+		with self.assertRaises(ResultError) as context:
+			GiftExchange(['a','b','c','d'], f_restriction=lambda x, y: y == 'd')
+		self.assertIn("Receiver 'd' has no givers allowed", context.exception.report)
+
+	def test_precheck_off(self):
+		with self.assertRaises(ResultError) as context:
+			GiftExchange(['a','b','c','d'], f_restriction=lambda x, y: y == 'd', precheck=False)
+		self.assertEqual(context.exception.report, [])
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], precheck='weh')
+
+class Test_HistoryStore(unittest.TestCase):
+	def test_matches_history_list(self):
+		store = HistoryStore.fromHistory(test_user_history, 3)
+		index = HistoryIndex(test_user_history)
+		for userID in [0, 1, 2, 9, 5]:
+			for limit in [1, 2, 3]:
+				for participation in [True, False]:
+					self.assertEqual(
+						store.recentRecipients(userID, limit, participation),
+						index.recentRecipients(userID, limit, participation)
+						)
+
+		for i in range(sufficient_test_count // 10):
+			for limit, participation in [(1, True), (3, False)]:
+				results = GiftExchange(
+					test_users, 
+					history=store, 
+					historyLimit=limit,
+					history_ParticipationRequired=participation,
+					f_uniqueID=lambda x: x.id
+					)
+				self.assertTrue(DictDiffTest(results, {0:2,1:0,2:1}))
+
+	def test_rolling_window(self):
+		store = HistoryStore(2)
+		store.addExchange({'a':'b', 'b':'c', 'c':'a'})
+		store.addExchange({'a':'c', 'b':'a', 'c':'b'})
+		store.addExchange({'b':'c', 'c':'d', 'd':'b'})
+		# only the 2 most recent of a user's exchanges are kept
+		self.assertEqual(store.recentRecipients('b', 2, True), [(0, 'c'), (1, 'a')])
+		self.assertEqual(len(store.windows['b']), 2)
+		# 'a' sat out the latest exchange
+		self.assertEqual(store.recentRecipients('a', 2, True), [(1, 'c'), (2, 'b')])
+		self.assertEqual(store.recentRecipients('a', 2, False), [(1, 'c')])
+
+	def test_save_load(self):
+		import tempfile
+		import os
+		store = HistoryStore.fromHistory(test_user_history, 2)
+		with tempfile.TemporaryDirectory() as folder:
+			path = os.path.join(folder, 'history.json')
+			store.save(path)
+			loaded = HistoryStore.load(path)
+		self.assertEqual(loaded.historyLimit, store.historyLimit)
+		self.assertEqual(loaded.exchangeCount, store.exchangeCount)
+		self.assertEqual(loaded.windows, store.windows)
+
+	def test_historyLimit_too_large(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(test_users, f_uniqueID=lambda x: x.id,
+				history=HistoryStore(1), historyLimit=2)
+
+class Test_HistoryArchive(unittest.TestCase):
+	def setUp(self):
+		import tempfile
+		import os
+		self.folder = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.folder.name, 'archive')
+
+	def tearDown(self):
+		self.folder.cleanup()
+
+	def test_matches_history_list(self):
+		index = HistoryIndex(test_user_history)
+		with HistoryArchive.fromHistory(self.path, test_user_history) as archive:
+			self.assertEqual(archive.exchangeCount, len(test_user_history))
+			for userID in [0, 1, 2, 9, 5]:
+				for limit in [1, 2, 3, 10]:
+					for participation in [True, False]:
+						self.assertEqual(
+							archive.recentRecipients(userID, limit, participation),
+							index.recentRecipients(userID, limit, participation)
+							)
+
+			for i in range(sufficient_test_count // 10):
+				results = GiftExchange(
+					test_users, 
+					history=archive, 
+					historyLimit=1,
+					f_uniqueID=lambda x: x.id
+					)
+				self.assertTrue(DictDiffTest(results, {0:2,1:0,2:1}))
+
+	def test_add_and_reopen(self):
+		import os
+		archive = HistoryArchive(self.path)
+		archive.addExchange({'a':'b', 'b':'c', 'c':'a'})
+		archive.addExchange({'a':'c', 'b':'a', 'c':'b'})
+		archive.addExchange({'b':'c', 'c':'d', 'd':'b'})
+		archive.close()
+		# what a crash might leave: part of a record, an ID the index doesn't count
+		with open(os.path.join(self.path, 'records.bin'), 'ab') as file:
+			file.write(b'\x01\x02\x03')
+		with open(os.path.join(self.path, 'ids.jsonl'), 'a') as file:
+			file.write('"e"\n')
+
+		with HistoryArchive(self.path) as archive:
+			self.assertEqual(archive.ids, ['a', 'b', 'c', 'd'])
+			self.assertEqual(archive.recentRecipients('b', 2, True), [(0, 'c'), (1, 'a')])
+			# 'a' sat out the latest exchange
+			self.assertEqual(archive.recentRecipients('a', 2, True), [(1, 'c'), (2, 'b')])
+			self.assertEqual(archive.recentRecipients('a', 2, False), [(1, 'c')])
+			self.assertEqual(archive.recentRecipients('e', 2, True), [])
+			archive.addExchange({'e':'a', 'a':'e'})
+			self.assertEqual(archive.recentRecipients('e', 2, True), [(0, 'a')])
+			self.assertEqual(archive.recentRecipients('a', 2, True), [(0, 'e'), (2, 'c')])
+		with HistoryArchive(self.path) as archive:
+			self.assertEqual((archive.exchangeCount, archive.recordCount), (4, 11))
+			self.assertEqual(archive.ids, ['a', 'b', 'c', 'd', 'e'])
+
+	def test_validation(self):
+		import os
+		with HistoryArchive(self.path) as archive:
+			with self.assertRaises(ValidationError):
+				archive.addExchange({'a':'b', ('c', 1):'a'})
+			# nothing was added
+			self.assertEqual((archive.exchangeCount, archive.ids), (0, []))
+		with open(os.path.join(self.path, 'index.bin'), 'wb') as file:
+			file.write(b'not an archive, at least 32 bytes')
+		with self.assertRaises(ValidationError):
+			HistoryArchive(self.path)
+
+class Test_Tracing(unittest.TestCase):
+	def test_trace_events(self):
+		events = []
+		results = GiftExchange(
+			test_users,
+			f_uniqueID=lambda x: x.id,
+			trace=lambda event, details: events.append((event, details))
+			)
+		names = [ event for event, details in events ]
+		self.assertEqual(names[0], 'giver_order')
+		self.assertEqual(names[1], 'receiver_orders')
+		self.assertEqual(names[-1], 'result')
+		self.assertEqual(names.count('assign'), len(test_users))
+		for event, details in events:
+			if event == 'skip':
+				self.assertIn(details['reason'],
+					('taken', 'closed_loop', 'self', 'history', 'restriction'))
+		self.assertEqual(events[-1][1]['assignedUsers'], [ results[i] for i in range(3) ])
+
+	def test_trace_skip_reasons(self):
+		reasons = set()
+		def trace(event, details):
+			if event == 'skip':
+				reasons.add(details['reason'])
+		for i in range(50):
+			GiftExchange(
+				test_users,
+				history=test_user_history,
+				historyLimit=1,
+				f_uniqueID=lambda x: x.id,
+				f_restriction=lambda x, y: x.name == 'A' and y.name == 'B',
+				trace=trace
+				)
+		self.assertIn('self', reasons)
+		self.assertIn('history', reasons)
+
+	def test_trace_parameter_type(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], trace='weh')
+
+	def test_no_logging_configuration(self):
+		# importing the module must leave the host's logging setup alone
+		import subprocess
+		import sys
+		import os
+		output = subprocess.run(
+			[sys.executable, '-c',
+				'import logging, gift_exchange; print(len(logging.getLogger().handlers))'],
+			cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+			capture_output=True, text=True, check=True
+			).stdout
+		self.assertEqual(output.strip(), '0')
+
+	def test_logging_trace(self):
+		import gift_exchange
+		with self.assertLogs(gift_exchange.logger, level='INFO') as logs:
+			GiftExchange(['a','b','c'], trace=LoggingTrace)
+		self.assertTrue(any('Final Results' in line for line in logs.output))
+
+class Test_Workers(unittest.TestCase):
+	def test_workers_results(self):
+		users = list(range(12))
+		for i in range(3):
+			results = GiftExchange(users, workers=3,
+				restrictionRules=[AttributeRestriction(lambda x: x % 2)])
+			self.assertTrue(ValidExchangeTest(results, users))
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+
+	def test_workers_no_results(self):
+		with self.assertRaises(ResultError):
+			GiftExchange(['a','b','c','d'], workers=2, precheck=False,
+				f_restriction=lambda x, y: y == 'd')
+
+	def test_workers_parameter_type(self):
+		for workers in [0, 'weh', True]:
+			with self.assertRaises(ValidationError):
+				GiftExchange(['a','b','c'], workers=workers)
+
+class Test_SearchLimits(unittest.TestCase):
+	# Receiver 9 can't be given to, found only by trying every combination
+	hard = { 'users': list(range(10)), 'precheck': False, 'f_restriction': lambda x, y: y == 9 }
+
+	def test_timeout(self):
+		import time
+		started = time.monotonic()
+		with self.assertRaises(SearchLimitError) as context:
+			GiftExchange(**self.hard, timeout=0.2)
+		self.assertLess(time.monotonic() - started, 1)
+		stats = context.exception.stats
+		self.assertGreater(stats['attempts'], 0)
+		self.assertGreaterEqual(stats['seconds'], 0.2)
+		self.assertEqual(stats['users'], 10)
+		self.assertIsInstance(context.exception, ResultError)
+
+	def test_timeout_before_search(self):
+		import time
+		# uneven teams, with a slow f_restriction: the precheck (and the
+		# forward engine's matching) check every pair before trying a receiver
+		def slow(x, y):
+			time.sleep(0.0001)
+			return (x < 170) == (y < 170)
+		for parameters in [{'precheck': True}, {'precheck': False, 'engine': 'forward'}]:
+			started = time.monotonic()
+			with self.assertRaises(SearchLimitError):
+				GiftExchange(list(range(300)), maxUsers=300, f_restriction=slow, 
+					timeout=0.2, **parameters)
+			self.assertLess(time.monotonic() - started, 1)
+
+	def test_maxAttempts(self):
+		# the forward engine's matching finds out about hard right away, so
+		# it gets more givers than attempts instead
+		forward = { 'users': list(range(600)), 'maxUsers': 600 }
+		for engine, parameters in [('backtrack', self.hard), ('forward', forward)]:
+			with self.assertRaises(SearchLimitError) as context:
+				GiftExchange(**parameters, maxAttempts=500, engine=engine)
+			self.assertEqual(context.exception.stats['attempts'], 500)
+			self.assertEqual(context.exception.stats['restarts'], 0)
+		with self.assertRaises(ResultError) as context:
+			GiftExchange(**self.hard, maxAttempts=500, engine='forward')
+		self.assertNotIsInstance(context.exception, SearchLimitError)
+
+	def test_restarts(self):
+		for restarts in ['luby', 'geometric']:
+			with self.assertRaises(SearchLimitError) as context:
+				GiftExchange(**self.hard, maxAttempts=5000, restarts=restarts)
+			self.assertGreater(context.exception.stats['restarts'], 0)
+
+			users = list(range(30))
+			results = GiftExchange(users, restarts=restarts, 
+				restrictionRules=[AttributeRestriction(lambda x: x % 3)])
+			self.assertTrue(ValidExchangeTest(results, users))
+
+		# definite answers still stand
+		with self.assertRaises(ResultError) as context:
+			GiftExchange(['a','b','c','d'], precheck=False, restarts='luby',
+				f_restriction=lambda x, y: y == 'd')
+		self.assertNotIsInstance(context.exception, SearchLimitError)
+
+	def test_luby(self):
+		import gift_exchange
+		self.assertEqual([ gift_exchange._luby(i) for i in range(1, 16) ],
+			[1,1,2,1,1,2,4,1,1,2,1,1,2,4,8])
+
+	def test_limits_parameter_type(self):
+		for parameters in [{'timeout': 0}, {'timeout': 'weh'}, {'maxAttempts': 1.5}, 
+				{'maxAttempts': 0}, {'restarts': 'weh'}]:
+			with self.assertRaises(ValidationError):
+				GiftExchange(['a','b','c'], **parameters)
+
+class Test_Relax(unittest.TestCase):
+	users = list(range(6))
+	# every giver has had every other user in the last 5 exchanges
+	history = [ { g: (g + k) % 6 for g in range(6) } for k in range(1, 6) ]
+
+	def test_relax_historyLimit(self):
+		for engine in ['backtrack', 'forward', 'matching']:
+			for precheck in [True, False]:
+				results = GiftExchange(self.users, history=self.history, historyLimit=5,
+					relax=True, engine=engine, precheck=precheck)
+				self.assertTrue(ValidExchangeTest(results, self.users))
+				# only the oldest exchange is allowed again
+				self.assertTrue(DictDiffTest(results, self.history[4]))
+				self.assertEqual(results.historyLimit, 4)
+				self.assertEqual(results.droppedRules, [])
+
+		with self.assertRaises(ResultError):
+			GiftExchange(self.users, history=self.history, historyLimit=5)
+
+	def test_relax_rules(self):
+		rules = [
+			AttributeRestriction(lambda x: x < 3, name='team'),
+			AttributeRestriction(lambda x: x % 2, same=False, name='parity'),
+			]
+		results = GiftExchange(self.users, history=self.history, historyLimit=2, 
+			relax=True, restrictionRules=rules, relaxOrder=['parity', 'team'])
+		self.assertTrue(ValidExchangeTest(results, self.users))
+		self.assertEqual(results.historyLimit, 0)
+		self.assertEqual(results.droppedRules, ['parity'])
+		for giver, receiver in results.items():
+			self.assertNotEqual(giver < 3, receiver < 3)
+
+		results = GiftExchange(['a','b','c','d'], relax=True, relaxOrder=['f_restriction'],
+			f_restriction=lambda x, y: y == 'd')
+		self.assertTrue(ValidExchangeTest(results, ['a','b','c','d']))
+		self.assertEqual(results.droppedRules, ['f_restriction'])
+
+	def test_relax_parameter_type(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], relax='weh')
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], relax=True, relaxOrder=['team'])
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], relax=True, relaxOrder=['f_restriction'])
+
+class Test_Batch(unittest.TestCase):
+	def test_batch_results(self):
+		users = list(range(8))
+		candidates = GiftExchange.batch(users, k=20, 
+			f_compatibility=lambda x, y: abs(x - y))
+		self.assertEqual(len(candidates), 20)
+		for candidate in candidates:
+			self.assertTrue(ValidExchangeTest(candidate['results'], users))
+			self.assertEqual(candidate['compatibility'], 
+				sum(abs(g - r) for g, r in candidate['results'].items()))
+			self.assertIsNone(candidate['minHistoryGap'])
+		scores = [ x['compatibility'] for x in candidates ]
+		self.assertEqual(scores, sorted(scores))
+
+	def test_batch_history_gap(self):
+		history = [{'a':'b','b':'c','c':'d','d':'a'}, {'a':'c','b':'d','c':'a','d':'b'}]
+		candidates = GiftExchangeBatch(['a','b','c','d'], k=30, history=history)
+		for candidate in candidates:
+			gaps = [ i + 1 for g, r in candidate['results'].items() 
+				for i, exchange in enumerate(history) if exchange[g] == r ]
+			self.assertEqual(candidate['minHistoryGap'], min(gaps) if gaps else None)
+			self.assertIsNone(candidate['compatibility'])
+		# no repeats first, then the repeats furthest in the past
+		ranks = [ float('inf') if x['minHistoryGap'] is None else x['minHistoryGap'] 
+			for x in candidates ]
+		self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+	def test_batch_shares_restrictions(self):
+		calls = []
+		GiftExchangeBatch(list(range(6)), k=10, 
+			f_restriction=lambda x, y: calls.append((x, y)) or x % 2 == y % 2)
+		# ValidateParameters tries it once on the first two users
+		calls.remove((0, 1))
+		self.assertEqual(len(calls), len(set(calls)))
+
+	def test_batch_shares_weights(self):
+		for k in [1, 10]:
+			calls = []
+			GiftExchangeBatch(list(range(12)), k=k, 
+				f_compatibility=lambda x, y: calls.append((x, y)) or abs(x - y))
+			# ValidateParameters tries it once on the first two users
+			calls.remove((0, 1))
+			# once per pair, by the first search to draw the giver's receivers
+			self.assertEqual(len(calls), len(set(calls)))
+			self.assertEqual(len(calls), 12 * 12)
+		# a single exchange doesn't keep them
+		exchange = gift_exchange.PreparedExchange(**gift_exchange._withDefaults(
+			list(range(12)), dict(f_compatibility=lambda x, y: abs(x - y))))
+		exchange.solve()
+		self.assertIsNone(exchange.weightRows)
+
+	def test_batch_parameters(self):
+		with self.assertRaises(ValidationError):
+			GiftExchangeBatch(['a','b','c'], k=0)
+		with self.assertRaises(ValidationError):
+			GiftExchangeBatch(['a','b','c'], historyLimit='weh')
+		with self.assertRaises(TypeError):
+			GiftExchangeBatch(['a','b','c'], weh=1)
+
+class Test_Stats(unittest.TestCase):
+	def test_stats_counts(self):
+		calls = []
+		users = list(range(20))
+		for engine in ['backtrack', 'forward', 'matching']:
+			calls.clear()
+			results = GiftExchange(users, stats=True, engine=engine,
+				history=[{ g: (g + 1) % 20 for g in users }], historyLimit=1,
+				f_restriction=lambda x, y: calls.append((x, y)) or (x + y) % 5 == 0)
+			self.assertTrue(ValidExchangeTest(results, users))
+			stats = results.stats
+			self.assertEqual(stats['searches'], 1)
+			self.assertGreater(stats['skips']['restriction'], 0)
+			self.assertGreater(stats['skips']['history'], 0)
+			# ValidateParameters' call isn't counted
+			self.assertEqual(stats['lambdaCalls']['f_restriction'], len(calls) - 1)
+			self.assertEqual(stats['lambdaCalls']['f_uniqueID'], len(users))
+			for phase in ['setup', 'history', 'shuffle', 'precheck', 'search', 'results']:
+				self.assertGreaterEqual(stats['seconds'][phase], 0)
+			if engine != 'matching':
+				self.assertGreaterEqual(stats['attempts'], len(users))
+				self.assertEqual(stats['mostAssigned'], len(users) - 1)
+
+	def test_stats_backtracks(self):
+		# receiver 5 can't be given to, found only by trying every combination
+		results = GiftExchange(list(range(6)), stats=True, precheck=False, relax=True,
+			relaxOrder=['f_restriction'], f_restriction=lambda x, y: y == 5)
+		stats = results.stats
+		self.assertEqual(stats['searches'], 2)
+		self.assertGreater(stats['backtracks'], 0)
+		self.assertGreater(stats['backtrackDepth'], 0)
+		self.assertIn('relax', stats['seconds'])
+
+	def test_no_stats(self):
+		results = GiftExchange(['a','b','c'])
+		self.assertIs(type(results), dict)
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a','b','c'], stats='weh')
+
+class Test_Topology(unittest.TestCase):
+	def test_single_cycle(self):
+		users = list(range(200))
+		results = GiftExchange(users, topology='single_cycle', maxUsers=200)
+		self.assertTrue(ValidExchangeTest(results, users))
+		self.assertEqual(CycleLengths(results), [200])
+
+	def test_single_cycle_rules(self):
+		users = list(range(30))
+		history = [{ g: (g + k) % 30 for g in users } for k in range(1, 3)]
+		for engine in ['backtrack', 'forward', 'matching', 'optimal']:
+			results = GiftExchange(users, topology='single_cycle', engine=engine,
+				history=history, historyLimit=2,
+				restrictionRules=[AttributeRestriction(lambda x: x % 2)])
+			self.assertTrue(ValidExchangeTest(results, users))
+			self.assertEqual(CycleLengths(results), [30])
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+				self.assertNotIn(receiver, [(giver + 1) % 30, (giver + 2) % 30])
+
+	def test_min_cycle_length(self):
+		users = list(range(40))
+		for engine in ['backtrack', 'matching']:
+			for _ in range(5):
+				results = GiftExchange(users, minCycleLength=6, engine=engine,
+					f_restriction=lambda x, y: (x + y) % 7 == 0)
+				self.assertTrue(ValidExchangeTest(results, users))
+				self.assertGreaterEqual(min(CycleLengths(results)), 6)
+		with self.assertRaises(ResultError):
+			GiftExchange(['a', 'b', 'c'], minCycleLength=4)
+
+	def test_validation(self):
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a', 'b', 'c'], topology='chain')
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a', 'b', 'c'], minCycleLength=2)
+
+class Test_Blocks(unittest.TestCase):
+	def test_blocks(self):
+		users = list(range(100))
+		rules = [AttributeRestriction(lambda x: x % 3)]
+		for engine in ['backtrack', 'matching']:
+			results = GiftExchange(users, blockSize=10, engine=engine, maxUsers=100,
+				restrictionRules=rules, history=[{ g: (g + 3) % 100 for g in users }], historyLimit=1)
+			self.assertTrue(ValidExchangeTest(results, users))
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 3, receiver % 3)
+				self.assertNotEqual(receiver, (giver + 3) % 100)
+		# teams are dealt out evenly to the blocks
+		exchange = gift_exchange.PreparedExchange(**gift_exchange._withDefaults(users,
+			dict(blockSize=10, maxUsers=100, restrictionRules=rules)))
+		blocks = exchange.blocks(exchange.newProblem())
+		self.assertEqual(sorted(sum(blocks, [])), users)
+		for block in blocks:
+			self.assertEqual(len(block), 10)
+			self.assertTrue(all(3 <= len([ x for x in block if x % 3 == team ]) <= 4 
+				for team in range(3)))
+
+	def test_merged_blocks(self):
+		# blocks of 3 can't follow f_restriction's teams, so they're merged
+		users = list(range(12))
+		for _ in range(5):
+			results = GiftExchange(users, blockSize=3, f_restriction=lambda x, y: x % 2 == y % 2)
+			self.assertTrue(ValidExchangeTest(results, users))
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+		with self.assertRaises(ResultError):
+			GiftExchange(users, blockSize=3, 
+				restrictionRules=[AttributeRestriction(lambda x: x == 0, same=False)])
+
+	def test_block_workers(self):
+		users = list(range(60))
+		results = GiftExchange(users, blockSize=10, workers=3, stats=True, maxUsers=60,
+			f_restriction=lambda x, y: (x + y) % 4 == 0)
+		self.assertTrue(ValidExchangeTest(results, users))
+		self.assertGreater(results.stats['lambdaCalls']['f_restriction'], 0)
+		self.assertGreater(results.stats['attempts'], 0)
+
+	def test_single_cycle_blocks(self):
+		users = list(range(50))
+		results = GiftExchange(users, blockSize=10, topology='single_cycle', maxUsers=50,
+			restrictionRules=[AttributeRestriction(lambda x: x % 2)])
+		self.assertTrue(ValidExchangeTest(results, users))
+		self.assertEqual(CycleLengths(results), [50])
+
+	def test_validation(self):
+		for blockSize in [2, 'big', True]:
+			with self.assertRaises(ValidationError):
+				GiftExchange(['a', 'b', 'c'], blockSize=blockSize)
+
+class Test_CompiledExchange(unittest.TestCase):
+	def test_add_remove(self):
+		history = [{ 0: 5, 1: 6, 2: 7 }, { 0: 6 }]
+		exchange = CompiledExchange(list(range(5)), history=history, historyLimit=2,
+			restrictionRules=[AttributeRestriction(lambda x: x % 2, name='team')],
+			f_restriction=lambda x, y: x + y == 9, maxUsers=20)
+		exchange.addUser(5)
+		exchange.addUser(6)
+		exchange.removeUser(1)
+		exchange.addUser(7)
+		exchange.addUser(9)
+		users = exchange.users
+		self.assertEqual(sorted(users), [0, 2, 3, 4, 5, 6, 7, 9])
+		# the same as preparing it from the start
+		prepared = gift_exchange.PreparedExchange(**gift_exchange._withDefaults(list(users),
+			dict(history=history, historyLimit=2, f_restriction=lambda x, y: x + y == 9,
+			restrictionRules=[AttributeRestriction(lambda x: x % 2)], maxUsers=20)))
+		self.assertEqual(exchange.giverHistory, prepared.giverHistory)
+		for g in range(len(users)):
+			for r in range(len(users)):
+				self.assertEqual(exchange.restrictions.isRestricted(g, r),
+					prepared.restrictions.isRestricted(g, r))
+		for _ in range(10):
+			results = exchange.run()
+			self.assertTrue(ValidExchangeTest(results, users))
+			for giver, receiver in results.items():
+				self.assertNotEqual(giver % 2, receiver % 2)
+				self.assertNotEqual(giver + receiver, 9)
+			self.assertNotIn(results[0], [5, 6])
+			self.assertNotEqual(results[2], 7)
+
+	def test_validation(self):
+		with self.assertRaises(ValidationError):
+			CompiledExchange(['a', 'b'])
+		exchange = CompiledExchange(['a', 'b', 'c'], maxUsers=4)
+		with self.assertRaises(ValidationError):
+			exchange.addUser('a')
+		with self.assertRaises(ValidationError):
+			exchange.removeUser('z')
+		with self.assertRaises(ValidationError):
+			exchange.removeUser('a')
+		exchange.addUser('d')
+		with self.assertRaises(ValidationError):
+			exchange.addUser('e')
+		grid = CompiledExchange(['a', 'b', 'c'], compatibilityWeights=[[0, 1, 1]] * 3)
+		with self.assertRaises(ValidationError):
+			grid.addUser('d')
+
+	def test_relax_each_run(self):
+		# with the rule relaxed, the next run starts from the rule again
+		exchange = CompiledExchange([0, 1, 2], relax=True, relaxOrder=['team'],
+			restrictionRules=[AttributeRestriction(lambda x: x < 2, name='team')])
+		self.assertEqual(exchange.run().droppedRules, ['team'])
+		exchange.addUser(3)
+		results = exchange.run()
+		self.assertEqual(results.droppedRules, [])
+		self.assertTrue(ValidExchangeTest(results, [0, 1, 2, 3]))
+
+	def test_feature_weights(self):
+		exchange = CompiledExchange(list(range(6)), maxUsers=10,
+			compatibilityWeights=FeatureWeights(lambda x: x, compare='same'))
+		exchange.addUser(6)
+		exchange.removeUser(0)
+		self.assertEqual(exchange.features, exchange.users)
+		self.assertTrue(ValidExchangeTest(exchange.run(), exchange.users))
+
+class Test_RuleProvider(unittest.TestCase):
+	class Rules():
+		def __init__ (self, users):
+			self.users = users
+			self.calls = 0
+			self.rowCalls = []
+		def restrictionsFor(self, givers):
+			self.calls += 1
+			# 'z' isn't one of the users
+			return [ (x, y) for x in givers for y in givers if (x + y) % 3 == 0 ] + [(0, 'z')]
+		def weightsRow(self, giver):
+			self.rowCalls.append(giver)
+			return [ abs(giver - x) for x in self.users ]
+
+	def test_restrictions_and_weights(self):
+		users = list(range(30))
+		# restarts: with these weights, the backtrack engine's search can 
+		# take minutes on an unlucky order (about 1 in 100) without them
+		for engine in ['backtrack', 'forward', 'matching', 'optimal']:
+			rules = self.Rules(users)
+			results = GiftExchange(users, ruleProvider=rules, engine=engine, restarts='luby')
+			self.assertTrue(ValidExchangeTest(results, users))
+			for giver, receiver in results.items():
+				self.assertNotEqual((giver + receiver) % 3, 0)
+			self.assertEqual(rules.calls, 1)
+		results = GiftExchange(users, ruleProvider=self.Rules(users), blockSize=10, stats=True,
+			restarts='luby')
+		self.assertEqual(results.stats['lambdaCalls']['restrictionsFor'], 1)
+		for giver, receiver in results.items():
+			self.assertNotEqual((giver + receiver) % 3, 0)
+
+	def test_weights_once(self):
+		# once per giver, however many searches draw from it or score it
+		users = list(range(100))
+		rules = self.Rules(users)
+		GiftExchangeBatch(users, k=5, maxUsers=100, ruleProvider=rules, engine='matching')
+		# ValidateParameters tries it once on the first user
+		rules.rowCalls.remove(0)
+		self.assertEqual(sorted(rules.rowCalls), users)
+
+	def test_relax_and_compiled(self):
+		class Everyone():
+			def restrictionsFor(self, givers):
+				return [ (x, y) for x in givers for y in givers ]
+		results = GiftExchange([0, 1, 2], ruleProvider=Everyone(), relax=True, 
+			relaxOrder=['ruleProvider'])
+		self.assertEqual(results.droppedRules, ['ruleProvider'])
+
+		class Parity():
+			def restrictionsFor(self, givers):
+				return [ (x, y) for x in givers for y in givers if (x + y) % 2 == 0 ]
+		exchange = CompiledExchange(list(range(8)), ruleProvider=Parity(), maxUsers=20)
+		exchange.addUser(8)
+		exchange.addUser(9)
+		exchange.removeUser(2)
+		exchange.addUser(10)
+		prepared = gift_exchange.PreparedExchange(**gift_exchange._withDefaults(
+			list(exchange.users), dict(ruleProvider=Parity(), maxUsers=20)))
+		self.assertEqual(exchange.restrictions.listed, prepared.restrictions.listed)
+		for giver, receiver in exchange.run().items():
+			self.assertEqual((giver + receiver) % 2, 1)
+		with self.assertRaises(ValidationError):
+			CompiledExchange([0, 1, 2], ruleProvider=self.Rules([0, 1, 2])).addUser(3)
+
+	def test_validation(self):
+		users = ['a', 'b', 'c']
+		class NoWeights():
+			def weightsRow(self, giver):
+				return [1]
+		for ruleProvider in [object(), NoWeights()]:
+			with self.assertRaises(ValidationError):
+				GiftExchange(users, ruleProvider=ruleProvider)
+		with self.assertRaises(ValidationError):
+			GiftExchange([0, 1, 2], ruleProvider=self.Rules([0, 1, 2]), 
+				f_compatibility=lambda x, y: 1)
+		# plain functions, not only lambdas
+		def f_restriction(giver, receiver):
+			return receiver == 'a'
+		with self.assertRaises(ResultError):
+			GiftExchange(users, f_restriction=f_restriction)
+		def f_uniqueID(user):
+			return user.upper()
+		results = GiftExchange(users, f_uniqueID=f_uniqueID)
+		self.assertEqual(sorted(results), ['A', 'B', 'C'])
+		with self.assertRaises(ValidationError):
+			GiftExchange(users, f_uniqueID='id')
+		# called directly, the parameters added since only need the ones before
+		self.assertEqual(ValidateParameters(users, f_uniqueID, [], 0, False, 
+			None, f_restriction, 3, 50), '')
+
+class Test_Async(unittest.TestCase):
+	def test_providers(self):
+		import asyncio
+		calls = []
+		async def restrictionProvider(users):
+			calls.append('restrictions')
+			return [ (x, (x + 1) % len(users)) for x in users ]
+		async def compatibilityProvider(users):
+			calls.append('weights')
+			return [ [ abs(x - y) for y in users ] for x in users ]
+		users = list(range(10))
+		results = asyncio.run(GiftExchangeAsync(users, f_restriction=lambda x, y: y == x + 2,
+			restrictionProvider=restrictionProvider, compatibilityProvider=compatibilityProvider))
+		self.assertTrue(ValidExchangeTest(results, users))
+		for giver, receiver in results.items():
+			self.assertNotIn(receiver, [(giver + 1) % 10, giver + 2])
+		# once each, not per pair
+		self.assertEqual(sorted(calls), ['restrictions', 'weights'])
+
+	def test_cancel(self):
+		import asyncio
+		import concurrent.futures
+		executor = concurrent.futures.ThreadPoolExecutor(1)
+		async def cancel():
+			# receiver 9 can't be given to, found only by trying every combination
+			task = asyncio.ensure_future(GiftExchangeAsync(list(range(10)), 
+				executor=executor, precheck=False, f_restriction=lambda x, y: y == 9))
+			await asyncio.sleep(0.2)
+			self.assertFalse(task.done())
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+		asyncio.run(cancel())
+		started = time.monotonic()
+		executor.shutdown(wait=True)
+		self.assertLess(time.monotonic() - started, 1)
+
+	def test_cancel_precheck(self):
+		import asyncio
+		import concurrent.futures
+		executor = concurrent.futures.ThreadPoolExecutor(1)
+		# uneven teams, with a slow f_restriction, so the precheck takes seconds
+		def slow(x, y):
+			time.sleep(0.0001)
+			return (x < 170) == (y < 170)
+		async def cancel():
+			task = asyncio.ensure_future(GiftExchangeAsync(list(range(300)), 
+				executor=executor, maxUsers=300, f_restriction=slow))
+			await asyncio.sleep(0.2)
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+		asyncio.run(cancel())
+		started = time.monotonic()
+		executor.shutdown(wait=True)
+		self.assertLess(time.monotonic() - started, 1)
+
+	def test_validation(self):
+		import asyncio
+		async def weights(users):
+			return [[0] * len(users)] * len(users)
+		for parameters in [{'restrictionProvider': 'weh'}, {'compatibilityProvider': 'weh'},
+				{'compatibilityProvider': weights, 'f_compatibility': lambda x, y: 1},
+				{'maxUsers': 2}]:
+			with self.assertRaises(ValidationError):
+				asyncio.run(GiftExchangeAsync(['a', 'b', 'c'], **parameters))
+
+class Test_Startup(unittest.TestCase):
+	def test_lean_import(self):
+		# only what every call needs is imported with the module
+		import subprocess
+		import sys
+		import os
+		output = subprocess.run(
+			[sys.executable, '-c', 'import sys, gift_exchange; print(sorted(set(sys.modules) & '
+				+ '{"asyncio", "inspect", "json", "logging", "multiprocessing", "numpy"}))'],
+			cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+			capture_output=True, text=True, check=True
+			).stdout
+		self.assertEqual(output.strip(), '[]')
+
+	def test_star_import(self):
+		# the public API, without the module's own imports
+		names = {}
+		exec('from gift_exchange import *', names)
+		for name in gift_exchange.__all__:
+			self.assertIn(name, names)
+		for name in ['time', 'random', 'seed', 'heapq', 'array', 'deque', 'shuffle', 'ordinal']:
+			self.assertNotIn(name, names)
+
+	def test_validate_modes(self):
+		users = ['a', 'b', 'c', 'd']
+		calls = []
+		f_uniqueID = lambda x: calls.append(x) or x
+		for validate, idCalls in [('full', 8), ('fast', 4), ('off', 4)]:
+			calls.clear()
+			results = GiftExchange(users, f_uniqueID=f_uniqueID, validate=validate)
+			self.assertTrue(ValidExchangeTest(results, users))
+			# fast and off don't call the lambdas to check them
+			self.assertEqual(len(calls), idCalls)
+		with self.assertRaises(ValidationError):
+			GiftExchange(users, validate='weh')
+		# fast still checks the parameters, and that the IDs are unique
+		with self.assertRaises(ValidationError):
+			GiftExchange(users, maxUsers='weh', validate='fast')
+		with self.assertRaises(ValidationError):
+			GiftExchange(['a', 'b', 'c', 'c'], validate='fast')
+
+class Test_CommandLine(unittest.TestCase):
+	def setUp(self):
+		import tempfile
+		import json
+		self.folder = tempfile.TemporaryDirectory()
+		self.path = lambda name: self.folder.name + '/' + name
+		with open(self.path('roster.jsonl'), 'w') as file:
+			for i in range(12):
+				file.write(json.dumps({ 'id': i, 'team': i % 3, 'age': 20 + i }) + '\n')
+		with open(self.path('roster.csv'), 'w') as file:
+			file.write('id,team,age\n')
+			file.writelines(f'{i},{i % 3},{20 + i}\n' for i in range(12))
+		# oldest first. The first line isn't JSON, and is never read.
+		with open(self.path('history.jsonl'), 'w') as file:
+			file.write('not json\n')
+			for k in range(1, 6):
+				file.write(json.dumps({ str(g): (g + k) % 12 for g in range(12) }) + '\n')
+		with open(self.path('history.csv'), 'w') as file:
+			file.write('exchange,giver,receiver\n0,"not csv\n')
+			for k in range(1, 6):
+				file.writelines(f'{k},{g},{(g + k) % 12}\n' for g in range(12))
+
+	def tearDown(self):
+		self.folder.cleanup()
+
+	def run_cli(self, *arguments):
+		import json
+		import csv
+		output = self.path('output.csv' if '--csv' in arguments else 'output.jsonl')
+		arguments = [ x for x in arguments if x != '--csv' ]
+		code = CommandLine(arguments + ['--output', output])
+		self.assertEqual(code, 0)
+		with open(output) as file:
+			if output.endswith('.csv'):
+				rows = list(csv.DictReader(file))
+			else:
+				rows = [ json.loads(line) for line in file ]
+		results = dict((row['giver'], row['receiver']) for row in rows)
+		self.assertTrue(ValidExchangeTest(results, [ str(i) for i in range(12) ]))
+		return dict((int(g), int(r)) for g, r in results.items())
+
+	def test_rules_and_history(self):
+		for roster, history in [('roster.jsonl', 'history.jsonl'), ('roster.csv', 'history.csv')]:
+			for _ in range(5):
+				results = self.run_cli(self.path(roster), '--history', self.path(history), 
+					'--history-limit', '3', '--same', 'team', 
+					'--compatibility', 'abs(giver.age - receiver.age)')
+				for giver, receiver in results.items():
+					self.assertNotEqual(giver % 3, receiver % 3)
+					# the last 3 exchanges gave to giver + 3, 4 and 5
+					self.assertNotIn((receiver - giver) % 12, [3, 4, 5])
+
+			results = self.run_cli(self.path(roster), '--csv', 
+				'--restrict', 'giver.team != receiver.team', '--different', 'user.age > 100')
+			for giver, receiver in results.items():
+				self.assertEqual(giver % 3, receiver % 3)
+
+	def test_participation_required(self):
+		# user 0 only gave in the first exchange (k = 1), further back than historyLimit
+		with open(self.path('history.jsonl'), 'a') as file:
+			for k in range(6, 9):
+				file.write('{' + ', '.join(f'"{g}": {(g + k) % 12}' for g in range(1, 12)) + '}\n')
+		for _ in range(5):
+			results = self.run_cli(self.path('roster.jsonl'), '--history', 
+				self.path('history.jsonl'), '--history-limit', '5', '--participation-required')
+			self.assertNotIn(results[0], [1, 2, 3, 4, 5])
+
+	def test_errors(self):
+		import contextlib
+		import io
+		with contextlib.redirect_stderr(io.StringIO()) as errors:
+			self.assertEqual(CommandLine([self.path('roster.jsonl'), '--restrict', 'giver.team ==']), 2)
+			# everyone has the same value, so no one can give to anyone
+			self.assertEqual(CommandLine([self.path('roster.jsonl'), '--same', '1',
+				'--output', self.path('output.jsonl')]), 1)
+			self.assertEqual(CommandLine([self.path('missing.jsonl')]), 2)
+		self.assertIn('no assignment combinations found', errors.getvalue())
 
 class ACTIVE_TESTS(unittest.TestCase):
 	def test_find_ExceptionType(self):